@@ -1,6 +1,8 @@
-from .organize_dem import organize_dem
+from .land_use_cache import LandUseWarpCache
+from .organize_dem import clip_raster_to_tile_core, organize_dem
 from .prepare import AutoRoutePrepare
 from .prepare_multiprocess import (prepare_autoroute_streamflow_single_folder,
                                    prepare_autoroute_single_folder,
                                    prepare_autoroute_multiprocess)
 from .reproject_raster import reproject_lu_raster
+from .stream_info import StreamInfoTable
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+##
+##  footprint.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License BSD 3-Clause
+
+from glob import glob
+import os
+
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+#coordinate transformations by (source WKT, target WKT) in this process
+_COORDINATE_TRANSFORMATIONS = {}
+
+#------------------------------------------------------------------------------
+#Helper Functions
+#------------------------------------------------------------------------------
+def get_coordinate_transformation(src_srs, tgt_srs):
+    ''' Coordinate transformation between the projections
+        (created once per pair of projections in each process).
+
+        @type src_srs:  C{osr.SpatialReference}
+        @param src_srs: OSR SpatialReference object
+        @type tgt_srs:  C{osr.SpatialReference}
+        @param tgt_srs: OSR SpatialReference object
+        @rtype:         C{osr.CoordinateTransformation}
+        @return:        Transformation from src_srs to tgt_srs
+        '''
+    transform_key = (src_srs.ExportToWkt(), tgt_srs.ExportToWkt())
+    if transform_key not in _COORDINATE_TRANSFORMATIONS:
+        _COORDINATE_TRANSFORMATIONS[transform_key] = osr.CoordinateTransformation(src_srs, tgt_srs)
+    return _COORDINATE_TRANSFORMATIONS[transform_key]
+
+def get_densified_extent(gt, cols, rows, num_points_per_edge=21):
+    ''' Coordinates of a closed ring around a raster with points along each
+        edge so the ring follows the edges when reprojected.
+
+        @type gt:                   C{tuple/list}
+        @param gt:                  geotransform
+        @type cols:                 C{int}
+        @param cols:                number of columns in the dataset
+        @type rows:                 C{int}
+        @param rows:                number of rows in the dataset
+        @type num_points_per_edge:  C{int}
+        @param num_points_per_edge: Number of points on each edge (with corners)
+        @rtype:                     C{numpy.ndarray}
+        @return:                    [[x,y],...[x,y]] coordinates (first point repeated last)
+        '''
+    edge_steps = np.linspace(0, 1, max(2, int(num_points_per_edge)))[:-1]
+    #pixel coordinates clockwise from the upper left corner
+    px = np.concatenate([edge_steps * cols, np.full(len(edge_steps), cols),
+                         (1 - edge_steps) * cols, np.zeros(len(edge_steps)), [0]])
+    py = np.concatenate([np.zeros(len(edge_steps)), edge_steps * rows,
+                         np.full(len(edge_steps), rows), (1 - edge_steps) * rows, [0]])
+    return np.column_stack((gt[0] + px*gt[1] + py*gt[2],
+                            gt[3] + px*gt[4] + py*gt[5]))
+
+def transform_coordinates(coords, src_srs, tgt_srs):
+    ''' Reproject an array of x,y coordinates in one call.
+
+        @type coords:   C{numpy.ndarray}
+        @param coords:  [[x,y],...[x,y]] coordinates
+        @type src_srs:  C{osr.SpatialReference}
+        @param src_srs: OSR SpatialReference object
+        @type tgt_srs:  C{osr.SpatialReference}
+        @param tgt_srs: OSR SpatialReference object
+        @rtype:         C{numpy.ndarray}
+        @return:        Transformed [[x,y],...[x,y]] coordinates
+        '''
+    coords = np.asarray(coords, dtype=np.float64)
+    if len(coords) <= 0:
+        return coords.reshape(0, 2)
+    transform = get_coordinate_transformation(src_srs, tgt_srs)
+    transformed_coords = transform.TransformPoints(coords[:, :2].tolist())
+    return np.array(transformed_coords, dtype=np.float64)[:, :2]
+
+def get_footprint_polygon(coords):
+    ''' Polygon from a closed ring of x,y coordinates.
+
+        @type coords:  C{numpy.ndarray}
+        @param coords: [[x,y],...[x,y]] coordinates (first point repeated last)
+        @rtype:        C{ogr.Geometry}
+        @return:       Footprint polygon
+        '''
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for x, y in coords:
+        ring.AddPoint_2D(float(x), float(y))
+    ring.CloseRings()
+    footprint = ogr.Geometry(ogr.wkbPolygon)
+    footprint.AddGeometry(ring)
+    return footprint
+
+def get_watershed_dem_files(watershed_folder, dem_extension='img'):
+    '''
+    Get the (sub folder, DEM file) of each AutoRoute input folder in the watershed
+    '''
+    watershed_dem_files = []
+    for sub_folder in sorted(os.listdir(watershed_folder)):
+        sub_folder = os.path.join(watershed_folder, sub_folder)
+        if not os.path.isdir(sub_folder):
+            continue
+        dem_files = sorted(glob(os.path.join(sub_folder, '*.{0}'.format(dem_extension))))
+        if not dem_files:
+            print("DEM not found. Skipping folder: {0}".format(sub_folder))
+            continue
+        watershed_dem_files.append((sub_folder, dem_files[0]))
+    return watershed_dem_files
+
+#------------------------------------------------------------------------------
+#Footprint Functions
+#------------------------------------------------------------------------------
+def get_raster_footprints(raster_files, tgt_srs=None, num_points_per_edge=21):
+    '''
+    Get the footprint coordinates of each raster in the target projection
+    (raster projection if None) with the edges densified. The coordinates
+    of all rasters in the same projection are transformed in one call.
+    '''
+    raster_rings = []
+    raster_projections = []
+    for raster_file in raster_files:
+        raster_ds = gdal.Open(raster_file)
+        raster_rings.append(get_densified_extent(raster_ds.GetGeoTransform(),
+                                                 raster_ds.RasterXSize,
+                                                 raster_ds.RasterYSize,
+                                                 num_points_per_edge))
+        raster_projections.append(raster_ds.GetProjection())
+        raster_ds = None
+
+    if tgt_srs is None:
+        return raster_rings
+
+    footprints = list(raster_rings)
+    for raster_projection in set(raster_projections):
+        raster_indices = [raster_index for raster_index, projection in enumerate(raster_projections)
+                          if projection == raster_projection]
+        src_srs = osr.SpatialReference()
+        src_srs.ImportFromWkt(raster_projection)
+        transformed_coords = transform_coordinates(np.concatenate([raster_rings[raster_index]
+                                                                   for raster_index in raster_indices]),
+                                                   src_srs, tgt_srs)
+        ring_start = 0
+        for raster_index in raster_indices:
+            ring_end = ring_start + len(raster_rings[raster_index])
+            footprints[raster_index] = transformed_coords[ring_start:ring_end]
+            ring_start = ring_end
+    return footprints
+
+def get_watershed_footprints(watershed_folder, tgt_srs=None, dem_extension='img',
+                             num_points_per_edge=21):
+    '''
+    Get the (sub folder, footprint polygon of the DEM in the target projection)
+    of each AutoRoute input folder in the watershed
+    '''
+    watershed_dem_files = get_watershed_dem_files(watershed_folder, dem_extension)
+    footprints = get_raster_footprints([dem_file for sub_folder, dem_file in watershed_dem_files],
+                                       tgt_srs, num_points_per_edge)
+    return [(sub_folder, get_footprint_polygon(footprint))
+            for (sub_folder, dem_file), footprint in zip(watershed_dem_files, footprints)]
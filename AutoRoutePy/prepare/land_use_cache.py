@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+##
+##  land_use_cache.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License BSD 3-Clause
+
+import math
+import os
+import time
+
+from osgeo import gdal
+
+#local imports
+from ..utilities import evict_cache_files, get_cache_key, get_file_identity
+from .raster_profiles import (get_raster_creation_options,
+                              get_raster_profile_from_data_type)
+from .reproject_raster import get_dem_grid, get_output_format, warp_land_use_raster
+
+#name of the land use rasters in the cache directory
+LAND_USE_CACHE_FILE_PREFIX = "land_use_cache_"
+
+#------------------------------------------------------------------------------
+#Land Use Warp Cache Class
+#------------------------------------------------------------------------------
+class LandUseWarpCache(object):
+    """
+    This class keeps the land use raster warped once to the projection,
+    resolution and grid alignment of the DEMs on disk so each DEM tile
+    gets a window of it instead of warping the land use raster again.
+    Only the union of the DEM grids (cache bounds) is warped.
+    Entries are keyed by the land use file identity (path, size,
+    modification time), the grid definition and the cache bounds.
+    """
+    def __init__(self, cache_directory, max_cache_size=20e9, lock_timeout=6*3600,
+                 num_threads=1, max_memory_fraction=0.1):
+        """
+        Initialize the class with variables given by the user
+        """
+        self.cache_directory = cache_directory
+        self.max_cache_size = max_cache_size
+        self.lock_timeout = lock_timeout
+        self.num_threads = num_threads
+        self.max_memory_fraction = max_memory_fraction
+        try:
+            os.makedirs(cache_directory)
+        except OSError:
+            pass
+
+    @staticmethod
+    def get_grid_definition(dem_raster):
+        """
+        Get the (projection, x resolution, y resolution, x alignment, y alignment)
+        of the DEM grid (DEM tiles with the same definition share a cache entry)
+        """
+        dem_ds = gdal.Open(dem_raster)
+        geotransform = dem_ds.GetGeoTransform()
+        projection = dem_ds.GetProjection()
+        dem_ds = None
+        if geotransform[2] != 0 or geotransform[4] != 0:
+            raise Exception("ERROR: Rotated DEM grids are not supported by the land use cache ...")
+        x_resolution = abs(geotransform[1])
+        y_resolution = abs(geotransform[5])
+        #offset of the grid lines from the origin of the projection
+        #as a fraction of the resolution
+        return (projection, x_resolution, y_resolution,
+                round((geotransform[0] / x_resolution) % 1.0, 6) % 1.0,
+                round((geotransform[3] / y_resolution) % 1.0, 6) % 1.0)
+
+    @staticmethod
+    def get_grid_bounds(grid_definition, bounds):
+        """
+        Snap the bounds (min x, min y, max x, max y) outward to the grid
+        """
+        projection, x_resolution, y_resolution, x_alignment, y_alignment = grid_definition
+        x_alignment *= x_resolution
+        y_alignment *= y_resolution
+        min_x, min_y, max_x, max_y = bounds
+        return (x_alignment + math.floor(round((min_x - x_alignment) / x_resolution, 6)) * x_resolution,
+                y_alignment + math.floor(round((min_y - y_alignment) / y_resolution, 6)) * y_resolution,
+                x_alignment + math.ceil(round((max_x - x_alignment) / x_resolution, 6)) * x_resolution,
+                y_alignment + math.ceil(round((max_y - y_alignment) / y_resolution, 6)) * y_resolution)
+
+    @staticmethod
+    def get_union_bounds(bounds_list):
+        """
+        Get the bounds (min x, min y, max x, max y) covering all bounds in the list
+        """
+        return (min([bounds[0] for bounds in bounds_list]),
+                min([bounds[1] for bounds in bounds_list]),
+                max([bounds[2] for bounds in bounds_list]),
+                max([bounds[3] for bounds in bounds_list]))
+
+    @classmethod
+    def get_cache_bounds(cls, dem_raster_list):
+        """
+        Get the {grid definition: cache bounds} of the DEMs (union of
+        the bounds of the DEMs with each grid definition snapped to the grid)
+        to warp the land use raster once for all of them
+        """
+        grid_bounds_list = {}
+        for dem_raster in dem_raster_list:
+            grid_definition = cls.get_grid_definition(dem_raster)
+            grid_bounds_list.setdefault(grid_definition, []).append(get_dem_grid(dem_raster)[1])
+        return dict([(grid_definition, cls.get_grid_bounds(grid_definition,
+                                                           cls.get_union_bounds(bounds_list)))
+                     for grid_definition, bounds_list in grid_bounds_list.items()])
+
+    @staticmethod
+    def get_window(cache_geotransform, dem_geotransform, dem_num_cols, dem_num_rows):
+        """
+        Get the [col offset, row offset, columns, rows] of the DEM grid
+        in the cache entry (srcWin of gdal.Translate)
+        """
+        return [int(round((dem_geotransform[0] - cache_geotransform[0]) / cache_geotransform[1])),
+                int(round((dem_geotransform[3] - cache_geotransform[3]) / cache_geotransform[5])),
+                dem_num_cols,
+                dem_num_rows]
+
+    def get_cache_file(self, land_use_raster, grid_definition, cache_bounds):
+        """
+        Path to the cache entry of the land use raster, grid definition
+        and cache bounds
+        """
+        cache_key = get_cache_key("land_use",
+                                  get_file_identity(land_use_raster),
+                                  grid_definition,
+                                  tuple([round(bound, 6) for bound in cache_bounds]))
+        return os.path.join(self.cache_directory,
+                            "{0}{1}.tif".format(LAND_USE_CACHE_FILE_PREFIX, cache_key))
+
+    def get_cached_land_use_raster(self, land_use_raster, grid_definition, cache_bounds):
+        """
+        Get the cache entry of the land use raster warped to the grid
+        over the cache bounds (warped by one process if missing)
+        """
+        cache_file = self.get_cache_file(land_use_raster, grid_definition, cache_bounds)
+        while not os.path.exists(cache_file):
+            lock_file = "{0}.lock".format(cache_file)
+            try:
+                lock_file_descriptor = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError:
+                #another process is warping the land use raster
+                try:
+                    if time.time() - os.path.getmtime(lock_file) > self.lock_timeout:
+                        print("Removing stale lock file: {0}".format(lock_file))
+                        os.remove(lock_file)
+                except OSError:
+                    pass
+                time.sleep(5)
+                continue
+
+            try:
+                if not os.path.exists(cache_file):
+                    self.write_cache_file(cache_file, land_use_raster, grid_definition, cache_bounds)
+            finally:
+                os.close(lock_file_descriptor)
+                os.remove(lock_file)
+
+        try:
+            #mark as recently used
+            os.utime(cache_file, None)
+        except OSError:
+            pass
+        return cache_file
+
+    def write_cache_file(self, cache_file, land_use_raster, grid_definition, cache_bounds):
+        """
+        Warp the land use raster to the grid over the cache bounds and remove
+        least recently used entries over the maximum cache size
+        """
+        print("Warping land use raster to cache: {0}".format(land_use_raster))
+        projection, x_resolution, y_resolution = grid_definition[:3]
+        #not matched by the cache file pattern until complete
+        temp_cache_file = "{0}.{1}.temp".format(cache_file, os.getpid())
+        warp_land_use_raster(land_use_raster, temp_cache_file, projection, cache_bounds,
+                             num_threads=self.num_threads,
+                             max_memory_fraction=self.max_memory_fraction,
+                             xRes=x_resolution,
+                             yRes=y_resolution)
+
+        #make room before adding the entry so it is not evicted itself
+        evict_cache_files(self.cache_directory,
+                          max(0, self.max_cache_size - os.path.getsize(temp_cache_file)),
+                          "{0}*.tif".format(LAND_USE_CACHE_FILE_PREFIX))
+        os.rename(temp_cache_file, cache_file)
+
+    def reproject_lu_raster(self, dem_raster, land_use_raster, reprojected_land_use_raster,
+                            creation_options=None, cache_bounds=None):
+        """
+        This gets the land use raster on the grid of the dem_raster from
+        the window of the cache entry under the DEM (see reproject_lu_raster)
+
+        cache_bounds is the {grid definition: cache bounds} of the DEMs sharing
+        the cache entry (see get_cache_bounds). Otherwise, only the part under
+        the DEM is warped.
+
+        The output is a VRT on the cache entry if reprojected_land_use_raster
+        ends with .vrt (the cache entry must not be evicted while it is used),
+        otherwise a GeoTIFF tiled and compressed with the raster creation
+        profile of the land use data type unless creation_options are given.
+        """
+        grid_definition = self.get_grid_definition(dem_raster)
+        dem_bounds = self.get_grid_bounds(grid_definition, get_dem_grid(dem_raster)[1])
+        if cache_bounds and grid_definition in cache_bounds:
+            dem_bounds = self.get_union_bounds([cache_bounds[grid_definition], dem_bounds])
+        cache_file = self.get_cached_land_use_raster(land_use_raster, grid_definition, dem_bounds)
+
+        dem_ds = gdal.Open(dem_raster)
+        dem_geotransform = dem_ds.GetGeoTransform()
+        dem_num_cols = dem_ds.RasterXSize
+        dem_num_rows = dem_ds.RasterYSize
+        dem_ds = None
+        cache_ds = gdal.Open(cache_file)
+        cache_geotransform = cache_ds.GetGeoTransform()
+        cache_data_type = cache_ds.GetRasterBand(1).DataType
+        cache_ds = None
+
+        output_format = get_output_format(reprojected_land_use_raster)
+        if output_format == 'VRT':
+            creation_options = []
+        elif creation_options is None:
+            creation_options = get_raster_creation_options(get_raster_profile_from_data_type(cache_data_type))
+        dst_ds = gdal.Translate(reprojected_land_use_raster, cache_file,
+                                format=output_format,
+                                srcWin=self.get_window(cache_geotransform, dem_geotransform,
+                                                       dem_num_cols, dem_num_rows),
+                                creationOptions=creation_options)
+        if dst_ds is None:
+            raise Exception("ERROR: Unable to read land use raster from cache {0} ...".format(cache_file))
+        dst_ds = None
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+##
+##  manning_n.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License BSD 3-Clause
+
+import threading
+
+CONCURRENT_FUTURES_ENABLED = False
+try:
+    from concurrent.futures import ThreadPoolExecutor
+    CONCURRENT_FUTURES_ENABLED = True
+except ImportError:
+    print("concurrent.futures unable to be imported. If you would like to generate"
+          " Manning's n rasters with threads, please install futures (i.e. pip install futures).")
+    pass
+
+import numpy as np
+from osgeo import gdal
+
+#local imports
+from ..utilities import get_available_memory
+
+#------------------------------------------------------------------------------
+#Helper Functions
+#------------------------------------------------------------------------------
+def read_manning_n_table(manning_n_table):
+    ''' Read the land use class (first column) and Manning's n (last column)
+        of each row of the Manning's n table. Rows that do not start with a
+        land use class (e.g. the header) are skipped.
+
+        @type manning_n_table:  C{str}
+        @param manning_n_table: Path to tab, comma, or space delimited table
+        @rtype:                 C{tuple}
+        @return:                (land use classes, Manning's n values)
+        '''
+    land_use_classes = []
+    manning_n_values = []
+    with open(manning_n_table, 'r') as infile:
+        for line in infile:
+            line_split = line.replace(',', ' ').split()
+            if len(line_split) < 2:
+                continue
+            try:
+                land_use_class = int(float(line_split[0]))
+                manning_n = float(line_split[-1])
+            except ValueError:
+                continue
+            land_use_classes.append(land_use_class)
+            manning_n_values.append(manning_n)
+
+    return (np.array(land_use_classes, dtype=np.int64),
+            np.array(manning_n_values, dtype=np.float32))
+
+def get_manning_n_lookup(land_use_classes, manning_n_values, default_manning_n):
+    ''' Lookup array of Manning's n indexed by land use class minus the
+        smallest land use class (default_manning_n for unmapped classes)
+
+        @rtype:  C{tuple}
+        @return: (lookup array, smallest land use class)
+        '''
+    if len(land_use_classes) <= 0:
+        return np.array([default_manning_n], dtype=np.float32), 0
+    min_land_use_class = land_use_classes.min()
+    lookup = np.full(land_use_classes.max() - min_land_use_class + 1,
+                     default_manning_n, dtype=np.float32)
+    lookup[land_use_classes - min_land_use_class] = manning_n_values
+    return lookup, min_land_use_class
+
+#------------------------------------------------------------------------------
+#Manning's n Raster Class
+#------------------------------------------------------------------------------
+class ManningNReclassifier(object):
+    """
+    This class reclassifies the land use raster to Manning's n on the grid
+    of the DEM (nearest land use cell to the center of each DEM cell),
+    a block of DEM rows at a time. The land use raster must be in the
+    projection of the DEM (see reproject_lu_raster).
+    """
+    def __init__(self, land_use_raster, manning_n_table, default_manning_n,
+                 dem_geotransform, dem_num_cols):
+        """
+        Initialize the class with variables given by the user
+        """
+        self.land_use_raster = land_use_raster
+        self.default_manning_n = default_manning_n
+        land_use_classes, manning_n_values = read_manning_n_table(manning_n_table)
+        self.lookup, self.min_land_use_class = get_manning_n_lookup(land_use_classes,
+                                                                    manning_n_values,
+                                                                    default_manning_n)
+        self.dem_geotransform = dem_geotransform
+        self._thread_data = threading.local()
+
+        land_use_ds = gdal.Open(land_use_raster)
+        self.land_use_geotransform = land_use_ds.GetGeoTransform()
+        self.land_use_num_cols = land_use_ds.RasterXSize
+        self.land_use_num_rows = land_use_ds.RasterYSize
+        self.land_use_nodata = land_use_ds.GetRasterBand(1).GetNoDataValue()
+        land_use_ds = None
+
+        #land use column of each DEM column (same for all rows)
+        dem_x = dem_geotransform[0] + (np.arange(dem_num_cols) + 0.5) * dem_geotransform[1]
+        self.land_use_cols = np.floor((dem_x - self.land_use_geotransform[0]) /
+                                      self.land_use_geotransform[1]).astype(np.int64)
+
+    def get_land_use_band(self):
+        """
+        Land use band opened once per thread (GDAL datasets are not thread safe)
+        """
+        if getattr(self._thread_data, 'land_use_ds', None) is None:
+            self._thread_data.land_use_ds = gdal.Open(self.land_use_raster)
+        return self._thread_data.land_use_ds.GetRasterBand(1)
+
+    def get_bytes_per_dem_row(self):
+        """
+        Approximate memory used for each DEM row in a block
+        """
+        land_use_rows_per_dem_row = max(1.0, abs(self.dem_geotransform[5] /
+                                                 self.land_use_geotransform[5]))
+        land_use_cols_per_dem_col = max(1.0, abs(self.dem_geotransform[1] /
+                                                 self.land_use_geotransform[1]))
+        num_dem_cols = len(self.land_use_cols)
+        #land use window (up to 8 bytes) and int64/float32 block arrays
+        return int(num_dem_cols * (land_use_rows_per_dem_row * land_use_cols_per_dem_col * 8 + 20))
+
+    def read_block(self, row_start, row_end):
+        """
+        Manning's n of DEM rows row_start to row_end
+        """
+        dem_y = self.dem_geotransform[3] + (np.arange(row_start, row_end) + 0.5) * self.dem_geotransform[5]
+        land_use_rows = np.floor((dem_y - self.land_use_geotransform[3]) /
+                                 self.land_use_geotransform[5]).astype(np.int64)
+
+        manning_n_block = np.full((row_end - row_start, len(self.land_use_cols)),
+                                  self.default_manning_n, dtype=np.float32)
+        valid_rows = (land_use_rows >= 0) & (land_use_rows < self.land_use_num_rows)
+        valid_cols = (self.land_use_cols >= 0) & (self.land_use_cols < self.land_use_num_cols)
+        if not valid_rows.any() or not valid_cols.any():
+            return manning_n_block
+
+        #read the land use window under the block
+        window_rows = land_use_rows[valid_rows]
+        window_cols = self.land_use_cols[valid_cols]
+        window_row_start, window_col_start = window_rows.min(), window_cols.min()
+        land_use_window = self.get_land_use_band() \
+            .ReadAsArray(int(window_col_start), int(window_row_start),
+                         int(window_cols.max() - window_col_start + 1),
+                         int(window_rows.max() - window_row_start + 1))
+        land_use_classes = land_use_window[np.ix_(window_rows - window_row_start,
+                                                  window_cols - window_col_start)]
+
+        #reclassify with the lookup array
+        lookup_index = land_use_classes.astype(np.int64) - self.min_land_use_class
+        mapped_classes = (lookup_index >= 0) & (lookup_index < len(self.lookup))
+        if self.land_use_nodata is not None:
+            mapped_classes &= land_use_classes != self.land_use_nodata
+        manning_n_values = np.where(mapped_classes,
+                                    np.take(self.lookup, lookup_index, mode='clip'),
+                                    self.default_manning_n)
+        manning_n_block[np.ix_(valid_rows, valid_cols)] = manning_n_values
+        return manning_n_block
+
+    def write(self, target_band, num_rows, max_memory_fraction=0.1, num_threads=1):
+        """
+        Write Manning's n of all DEM rows to the band with bounded memory
+        (blocks are reclassified by up to num_threads threads)
+        """
+        block_size = max(1, int(get_available_memory() * max_memory_fraction /
+                                max(1, 2 * num_threads) / self.get_bytes_per_dem_row()))
+        #align blocks to the tiles of the output raster
+        tile_rows = target_band.GetBlockSize()[1]
+        if block_size > tile_rows:
+            block_size = block_size // tile_rows * tile_rows
+        block_starts = list(range(0, num_rows, block_size))
+
+        def read_block(block_start):
+            return block_start, self.read_block(block_start,
+                                                min(block_start + block_size, num_rows))
+
+        if num_threads <= 1 or not CONCURRENT_FUTURES_ENABLED:
+            for block_start in block_starts:
+                target_band.WriteArray(read_block(block_start)[1], 0, block_start)
+            return
+
+        executor = ThreadPoolExecutor(max_workers=num_threads)
+        try:
+            #keep at most 2 blocks per thread in memory
+            for window_start in range(0, len(block_starts), 2 * num_threads):
+                for block_start, manning_n_block in \
+                        executor.map(read_block, block_starts[window_start:window_start + 2 * num_threads]):
+                    target_band.WriteArray(manning_n_block, 0, block_start)
+        finally:
+            executor.shutdown(wait=True)
@@ -7,12 +7,235 @@
 ##  License BSD 3-Clause
 
 from glob import glob
+import json
 import os
 from shutil import copy, move
 
-def organize_dem(input_folder, output_folder=None, dem_ext=".tif"):
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+#local imports
+from .footprint import (get_coordinate_transformation, get_densified_extent,
+                        get_footprint_polygon, transform_coordinates)
+from .raster_profiles import (get_raster_creation_options,
+                              get_raster_profile_from_data_type)
+
+TILE_LAYOUT_FILE_NAME = "tile_layout.json"
+
+#------------------------------------------------------------------------------
+#Tiling Functions
+#------------------------------------------------------------------------------
+def get_stream_cell_counts(dem_file, stream_network_shapefile, tile_block_size=256):
+    ''' Estimated number of stream cells in each block of the DEM from
+        points sampled along the stream network every DEM cell
+        (only the features over the DEM footprint are read).
+
+        @type dem_file:                  C{str}
+        @param dem_file:                 Path to DEM raster
+        @type stream_network_shapefile:  C{str}
+        @param stream_network_shapefile: Path to stream network shapefile
+        @type tile_block_size:           C{int}
+        @param tile_block_size:          Number of DEM rows and columns in each block
+        @rtype:                          C{numpy.ndarray}
+        @return:                         Stream cell count of each block (block row, block col)
+        '''
+    dem_ds = gdal.Open(dem_file)
+    geotransform = dem_ds.GetGeoTransform()
+    num_block_rows = int(np.ceil(dem_ds.RasterYSize / float(tile_block_size)))
+    num_block_cols = int(np.ceil(dem_ds.RasterXSize / float(tile_block_size)))
+    dem_footprint = get_densified_extent(geotransform, dem_ds.RasterXSize, dem_ds.RasterYSize)
+    dem_srs = osr.SpatialReference()
+    dem_srs.ImportFromWkt(dem_ds.GetProjection())
+    dem_ds = None
+
+    stream_shapefile = ogr.Open(stream_network_shapefile)
+    stream_layer = stream_shapefile.GetLayer()
+    coordinate_transform = None
+    stream_srs = stream_layer.GetSpatialRef()
+    if stream_srs is not None and not dem_srs.IsSame(stream_srs):
+        coordinate_transform = get_coordinate_transformation(stream_srs, dem_srs)
+        dem_footprint = transform_coordinates(dem_footprint, dem_srs, stream_srs)
+    #only segmentize the features over the DEM
+    stream_layer.SetSpatialFilter(get_footprint_polygon(dem_footprint))
+
+    cell_size = min(abs(geotransform[1]), abs(geotransform[5]))
+    stream_x_list = []
+    stream_y_list = []
+    for feature in stream_layer:
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+        geometry = geometry.Clone()
+        if coordinate_transform is not None:
+            geometry.Transform(coordinate_transform)
+        geometry.Segmentize(cell_size)
+        if geometry.GetGeometryCount() > 0:
+            line_list = [geometry.GetGeometryRef(line_index)
+                         for line_index in range(geometry.GetGeometryCount())]
+        else:
+            line_list = [geometry]
+        for line in line_list:
+            points = line.GetPoints()
+            if not points:
+                continue
+            points = np.array(points, dtype=np.float64)
+            stream_x_list.append(points[:, 0])
+            stream_y_list.append(points[:, 1])
+    stream_shapefile = None
+
+    stream_cell_counts = np.zeros((num_block_rows, num_block_cols), dtype=np.int64)
+    if not stream_x_list:
+        return stream_cell_counts
+    block_rows = np.floor((np.concatenate(stream_y_list) - geotransform[3]) /
+                          (geotransform[5] * tile_block_size)).astype(np.int64)
+    block_cols = np.floor((np.concatenate(stream_x_list) - geotransform[0]) /
+                          (geotransform[1] * tile_block_size)).astype(np.int64)
+    in_dem = (block_rows >= 0) & (block_rows < num_block_rows) & \
+             (block_cols >= 0) & (block_cols < num_block_cols)
+    np.add.at(stream_cell_counts, (block_rows[in_dem], block_cols[in_dem]), 1)
+    return stream_cell_counts
+
+def get_balanced_tile_windows(stream_cell_counts, max_stream_cells_per_tile):
+    ''' Split the blocks of the DEM into tiles with at most
+        max_stream_cells_per_tile stream cells (unless a tile is one block)
+        by bisecting the longer side of each tile at its stream cell median.
+
+        @type stream_cell_counts:         C{numpy.ndarray}
+        @param stream_cell_counts:        Stream cell count of each block
+        @type max_stream_cells_per_tile:  C{int}
+        @param max_stream_cells_per_tile: Target number of stream cells per tile
+        @rtype:                           C{list}
+        @return:                          [(block row start, block row end,
+                                            block col start, block col end), ...]
+        '''
+    tile_windows = []
+    windows_to_split = [(0, stream_cell_counts.shape[0], 0, stream_cell_counts.shape[1])]
+    while windows_to_split:
+        row_start, row_end, col_start, col_end = windows_to_split.pop()
+        window_counts = stream_cell_counts[row_start:row_end, col_start:col_end]
+        if window_counts.sum() <= max_stream_cells_per_tile or \
+                (row_end - row_start <= 1 and col_end - col_start <= 1):
+            tile_windows.append((row_start, row_end, col_start, col_end))
+            continue
+
+        split_rows = row_end - row_start >= col_end - col_start
+        cumulative_counts = np.cumsum(window_counts.sum(axis=1 if split_rows else 0))
+        split_index = int(np.searchsorted(cumulative_counts, cumulative_counts[-1] / 2.0)) + 1
+        split_index = min(max(split_index, 1), len(cumulative_counts) - 1)
+        if split_rows:
+            windows_to_split += [(row_start, row_start + split_index, col_start, col_end),
+                                 (row_start + split_index, row_end, col_start, col_end)]
+        else:
+            windows_to_split += [(row_start, row_end, col_start, col_start + split_index),
+                                 (row_start, row_end, col_start + split_index, col_end)]
+    return sorted(tile_windows)
+
+def tile_dem(dem_file, output_folder, stream_network_shapefile,
+             max_stream_cells_per_tile, halo_size=100, tile_block_size=256,
+             stream_cell_counts=None):
+    '''
+    Split the DEM into tiles with about max_stream_cells_per_tile stream
+    cells that overlap by halo_size cells. Each tile is written in the format
+    and with the extension of the DEM (so it is found with the same DEM
+    extension) in its own folder with the tile layout (see clip_raster_to_tile_core).
+    Returns the list of tile folders.
+    '''
+    if stream_cell_counts is None:
+        stream_cell_counts = get_stream_cell_counts(dem_file, stream_network_shapefile,
+                                                    tile_block_size)
+    tile_windows = get_balanced_tile_windows(stream_cell_counts,
+                                             max_stream_cells_per_tile)
+
+    dem_ds = gdal.Open(dem_file)
+    num_rows = dem_ds.RasterYSize
+    num_cols = dem_ds.RasterXSize
+    geotransform = dem_ds.GetGeoTransform()
+    dem_name, dem_extension = os.path.splitext(os.path.basename(dem_file))
+    dem_format = dem_ds.GetDriver().ShortName
+    creation_options = []
+    if dem_format == 'GTiff':
+        creation_options = get_raster_creation_options(
+            get_raster_profile_from_data_type(dem_ds.GetRasterBand(1).DataType))
+    tile_folder_list = []
+    for block_row_start, block_row_end, block_col_start, block_col_end in tile_windows:
+        core_row_start = block_row_start * tile_block_size
+        core_row_end = min(block_row_end * tile_block_size, num_rows)
+        core_col_start = block_col_start * tile_block_size
+        core_col_end = min(block_col_end * tile_block_size, num_cols)
+        tile_row_start = max(core_row_start - halo_size, 0)
+        tile_row_end = min(core_row_end + halo_size, num_rows)
+        tile_col_start = max(core_col_start - halo_size, 0)
+        tile_col_end = min(core_col_end + halo_size, num_cols)
+
+        tile_name = "{0}_r{1}_c{2}".format(dem_name, core_row_start, core_col_start)
+        tile_folder = os.path.join(output_folder, tile_name)
+        try:
+            os.mkdir(tile_folder)
+        except OSError:
+            pass
+        tile_file = os.path.join(tile_folder, "{0}{1}".format(tile_name, dem_extension))
+        tile_window = [tile_col_start, tile_row_start,
+                       tile_col_end - tile_col_start, tile_row_end - tile_row_start]
+        tile_ds = gdal.Translate(tile_file, dem_ds, format=dem_format, srcWin=tile_window,
+                                 creationOptions=creation_options)
+        if tile_ds is None:
+            raise Exception("ERROR: Unable to write DEM tile: {0} ...".format(tile_file))
+        tile_ds = None
+
+        tile_layout = {
+            'source_dem': os.path.abspath(dem_file),
+            'halo_size': halo_size,
+            'estimated_stream_cells': int(stream_cell_counts[block_row_start:block_row_end,
+                                                             block_col_start:block_col_end].sum()),
+            #[col offset, row offset, columns, rows] in the source DEM
+            'tile_window': tile_window,
+            'core_window': [core_col_start, core_row_start,
+                            core_col_end - core_col_start, core_row_end - core_row_start],
+            #[min x, min y, max x, max y] of the core in the DEM projection
+            'core_extent': [geotransform[0] + core_col_start * geotransform[1],
+                            geotransform[3] + core_row_end * geotransform[5],
+                            geotransform[0] + core_col_end * geotransform[1],
+                            geotransform[3] + core_row_start * geotransform[5]],
+        }
+        with open(os.path.join(tile_folder, TILE_LAYOUT_FILE_NAME), 'w') as outfile:
+            json.dump(tile_layout, outfile, indent=2)
+        print("Tiled: {0} to {1} ({2} stream cells)".format(dem_file, tile_file,
+                                                           tile_layout['estimated_stream_cells']))
+        tile_folder_list.append(tile_folder)
+    dem_ds = None
+    return tile_folder_list
+
+def clip_raster_to_tile_core(raster_file, tile_layout_file, output_raster_file,
+                             creation_options=None):
+    '''
+    Clip a raster on the grid of a DEM tile (e.g. flood map) to the core
+    of the tile without the halo
+    '''
+    with open(tile_layout_file) as infile:
+        tile_layout = json.load(infile)
+    tile_col_start, tile_row_start = tile_layout['tile_window'][:2]
+    core_col_start, core_row_start, core_num_cols, core_num_rows = tile_layout['core_window']
+    if creation_options is None:
+        creation_options = get_raster_creation_options('integer')
+    gdal.Translate(output_raster_file, raster_file, format='GTiff',
+                   srcWin=[core_col_start - tile_col_start,
+                           core_row_start - tile_row_start,
+                           core_num_cols, core_num_rows],
+                   creationOptions=creation_options)
+
+#------------------------------------------------------------------------------
+#Main Functions
+#------------------------------------------------------------------------------
+def organize_dem(input_folder, output_folder=None, dem_ext=".tif",
+                 stream_network_shapefile=None, max_stream_cells_per_tile=0,
+                 halo_size=100, tile_block_size=256):
     '''
     Reoganzie DEM files into structure needed for AutoRoutePy multiprocessing
+
+    If stream_network_shapefile and max_stream_cells_per_tile are given,
+    DEM files with more estimated stream cells are split into tiles
+    that overlap by halo_size cells (see tile_dem). The tiles keep the
+    format and extension of the DEM file.
     '''
     if output_folder is None:
         output_folder = input_folder
@@ -20,6 +243,16 @@ def organize_dem(input_folder, output_folder=None, dem_ext=".tif"):
     for filename in os.listdir(input_folder):
         if filename.endswith(dem_ext):
             folder_name = os.path.splitext(filename)[0]
+            if stream_network_shapefile and max_stream_cells_per_tile > 0:
+                dem_file = os.path.join(input_folder, filename)
+                stream_cell_counts = get_stream_cell_counts(dem_file,
+                                                            stream_network_shapefile,
+                                                            tile_block_size)
+                if stream_cell_counts.sum() > max_stream_cells_per_tile:
+                    tile_dem(dem_file, output_folder, stream_network_shapefile,
+                             max_stream_cells_per_tile, halo_size, tile_block_size,
+                             stream_cell_counts=stream_cell_counts)
+                    continue
             folder_path = os.path.join(output_folder, folder_name)
             dem_file_list = glob("{0}*".format(os.path.join(input_folder, folder_name)))
             try:
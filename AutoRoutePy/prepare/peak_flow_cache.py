@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+##
+##  peak_flow_cache.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License BSD 3-Clause
+
+import os
+import time
+
+import numpy as np
+from RAPIDpy.dataset import RAPIDDataset
+
+#local imports
+from ..utilities import evict_cache_files, get_cache_key, get_file_identity
+
+#------------------------------------------------------------------------------
+#Peak Flow Cache Class
+#------------------------------------------------------------------------------
+class PeakFlowCache(object):
+    """
+    This class keeps the peak flow of every river in a RAPID output file
+    on disk so each subbasin looks them up instead of recomputing them.
+    Entries are keyed by the RAPID output file identity (path, size,
+    modification time), the streamflow variable and the peak search dates.
+    """
+    def __init__(self, cache_directory, max_cache_size=2e9, lock_timeout=6*3600):
+        """
+        Initialize the class with variables given by the user
+        """
+        self.cache_directory = cache_directory
+        self.max_cache_size = max_cache_size
+        self.lock_timeout = lock_timeout
+        try:
+            os.makedirs(cache_directory)
+        except OSError:
+            pass
+
+    def get_cache_file(self, rapid_output_file, streamflow_variable,
+                       date_peak_search_start=None, date_peak_search_end=None):
+        """
+        Path to the cache entry of the RAPID output file and search dates
+        """
+        cache_key = get_cache_key("peak_flow",
+                                  get_file_identity(rapid_output_file),
+                                  streamflow_variable,
+                                  str(date_peak_search_start),
+                                  str(date_peak_search_end))
+        return os.path.join(self.cache_directory, "peak_flow_{0}.npz".format(cache_key))
+
+    def get_peak_flows(self, rapid_output_file, stream_ids, get_all_peak_flows,
+                       date_peak_search_start=None, date_peak_search_end=None):
+        """
+        Get the peak flow of each stream id (zero if missing in RAPID output)
+
+        get_all_peak_flows(rapid_output_file, date_peak_search_start, date_peak_search_end)
+        returns (stream ids, peak flows) of all rivers in the RAPID output file
+        and is only called when the cache entry does not exist.
+        """
+        with RAPIDDataset(rapid_output_file) as data_nc:
+            streamflow_variable = getattr(data_nc, 'q_var_name', 'Qout')
+
+        cache_file = self.get_cache_file(rapid_output_file,
+                                         streamflow_variable,
+                                         date_peak_search_start,
+                                         date_peak_search_end)
+
+        cache_data = self.read_cache_file(cache_file)
+        while cache_data is None:
+            lock_file = "{0}.lock".format(cache_file)
+            try:
+                lock_file_descriptor = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError:
+                #another process is computing the peak flows
+                try:
+                    if time.time() - os.path.getmtime(lock_file) > self.lock_timeout:
+                        print("Removing stale lock file: {0}".format(lock_file))
+                        os.remove(lock_file)
+                except OSError:
+                    pass
+                time.sleep(5)
+                cache_data = self.read_cache_file(cache_file)
+                continue
+
+            try:
+                cache_data = self.read_cache_file(cache_file)
+                if cache_data is None:
+                    print("Computing peak flows for all rivers in: {0}".format(rapid_output_file))
+                    all_stream_ids, all_peak_flows = get_all_peak_flows(rapid_output_file,
+                                                                        date_peak_search_start,
+                                                                        date_peak_search_end)
+                    cache_data = self.write_cache_file(cache_file, all_stream_ids, all_peak_flows)
+            finally:
+                os.close(lock_file_descriptor)
+                os.remove(lock_file)
+
+        cached_stream_ids, cached_peak_flows = cache_data
+        stream_ids = np.array(stream_ids, dtype=np.int64)
+        peak_flows = np.zeros(len(stream_ids), dtype=cached_peak_flows.dtype)
+        if len(cached_stream_ids) > 0:
+            cache_index = np.searchsorted(cached_stream_ids, stream_ids)
+            cache_index[cache_index >= len(cached_stream_ids)] = 0
+            found_stream_ids = cached_stream_ids[cache_index] == stream_ids
+            peak_flows[found_stream_ids] = cached_peak_flows[cache_index[found_stream_ids]]
+        return stream_ids, peak_flows
+
+    def read_cache_file(self, cache_file):
+        """
+        Read (sorted stream ids, peak flows) from cache entry (None if missing)
+        """
+        try:
+            with np.load(cache_file) as cache_data:
+                stream_ids, peak_flows = cache_data['stream_ids'], cache_data['peak_flows']
+        except (IOError, OSError):
+            return None
+        try:
+            #mark as recently used
+            os.utime(cache_file, None)
+        except OSError:
+            pass
+        print("Peak flows read from cache: {0}".format(cache_file))
+        return stream_ids, peak_flows
+
+    def write_cache_file(self, cache_file, stream_ids, peak_flows):
+        """
+        Write the cache entry and remove least recently used entries
+        over the maximum cache size
+        """
+        stream_ids = np.array(stream_ids, dtype=np.int64)
+        sort_order = np.argsort(stream_ids, kind='mergesort')
+        stream_ids = stream_ids[sort_order]
+        peak_flows = np.asarray(peak_flows)[sort_order]
+
+        #not matched by the cache file pattern until complete
+        temp_cache_file = "{0}.{1}.temp".format(cache_file, os.getpid())
+        #written to the open file so that .npz is not appended to the name
+        with open(temp_cache_file, 'wb') as temp_cache:
+            np.savez(temp_cache, stream_ids=stream_ids, peak_flows=peak_flows)
+
+        #make room before adding the entry so it is not evicted itself
+        evict_cache_files(self.cache_directory,
+                          max(0, self.max_cache_size - os.path.getsize(temp_cache_file)),
+                          "peak_flow_*.npz")
+        os.rename(temp_cache_file, cache_file)
+        return stream_ids, peak_flows
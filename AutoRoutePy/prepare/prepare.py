@@ -7,17 +7,38 @@
 ##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
 ##  License BSD 3-Clause
 
-import csv
 import datetime
-from io import open
 import os
 from subprocess import Popen, PIPE
 
+CONCURRENT_FUTURES_ENABLED = False
+try:
+    from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                    FIRST_COMPLETED, wait)
+    CONCURRENT_FUTURES_ENABLED = True
+except ImportError:
+    print("concurrent.futures unable to be imported. If you would like to read"
+          " ECMWF ensembles concurrently, please install futures (i.e. pip install futures).")
+    pass
+
 from netCDF4 import Dataset
 import numpy as np
 from osgeo import gdal, ogr, osr
 from RAPIDpy.dataset import RAPIDDataset
-from RAPIDpy.helper_functions import csv_to_list, open_csv
+
+#local imports
+from ..utilities import get_available_memory, get_file_identity
+from .footprint import (get_footprint_polygon, get_raster_footprints,
+                        transform_coordinates)
+from .manning_n import ManningNReclassifier
+from .peak_flow_cache import PeakFlowCache
+from .raster_profiles import (get_raster_creation_options,
+                              get_raster_profile_from_data_type)
+from .stream_direction import get_stream_info_block
+from .stream_network_index import StreamNetworkIndex
+from .stream_info import (StreamInfoFileWriter, StreamInfoTable,
+                          get_scenario_stream_info_file,
+                          render_stream_info_file)
 
 
 #------------------------------------------------------------------------------
@@ -59,12 +80,338 @@ def ReprojectCoords(coords,src_srs,tgt_srs):
         @rtype:         C{tuple/list}
         @return:        List of transformed [[x,y],...[x,y]] coordinates
         '''
-    trans_coords=[]
-    transform = osr.CoordinateTransformation( src_srs, tgt_srs)
-    for x,y in coords:
-        x,y,z = transform.TransformPoint(x,y)
-        trans_coords.append([x,y])
-    return trans_coords
+    return transform_coordinates(coords, src_srs, tgt_srs).tolist()
+
+VALID_STATISTIC_METHODS = ('max', 'min', 'mean', 'mean_plus_std', 'mean_minus_std')
+
+def get_statistic(data_array, method, axis):
+    ''' Reduce an array along an axis with a statistic method.
+
+        @type data_array: C{numpy.array}
+        @param data_array: Array of data
+        @type method:     C{str}
+        @param method:    max, min, mean, mean_plus_std, or mean_minus_std
+        @type axis:       C{int}
+        @param axis:      Axis to reduce
+        @rtype:           C{numpy.array}
+        @return:          Array reduced along the axis
+        '''
+    if "mean" in method:
+        statistic = np.mean(data_array, axis=axis)
+        if method == "mean_plus_std":
+            statistic += np.std(data_array, axis=axis)
+        elif method == "mean_minus_std":
+            statistic -= np.std(data_array, axis=axis)
+    elif method == "max":
+        statistic = np.amax(data_array, axis=axis)
+    elif method == "min":
+        statistic = np.amin(data_array, axis=axis)
+    else:
+        raise Exception("Invalid statistic method {0} ...".format(method))
+    return statistic
+
+def read_ecmwf_ensemble_hydrographs(prediction_file, river_index_list,
+                                    num_rivers, first_half_size,
+                                    river_row_list=None):
+    ''' Read the hydrographs of one ECMWF ensemble split into the first
+        half and the second half (20 steps) of the forecast.
+        The high resolution ensemble (52) is resampled to the
+        resolution of the other ensembles. Rivers missing in the
+        Qout file are left at zero.
+
+        @type prediction_file:  C{str}
+        @param prediction_file: Path to RAPID Qout file of the ensemble
+        @type river_index_list: C{list}
+        @param river_index_list: Indices of the rivers in the Qout file
+        @type num_rivers:       C{int}
+        @param num_rivers:      Number of rivers
+        @type first_half_size:  C{int}
+        @param first_half_size: Number of time steps in the first half
+        @type river_row_list:   C{list}
+        @param river_row_list:  Rows of the rivers in river_index_list in the
+                                output arrays (all rows if None)
+        @rtype:                 C{(numpy.array, numpy.array)}
+        @return:                (river, time) arrays of the first and second half
+        '''
+    first_half_data = np.zeros((num_rivers, first_half_size))
+    second_half_data = np.zeros((num_rivers, 20))
+    river_rows = slice(None)
+    if river_row_list is not None:
+        river_rows = np.asarray(river_row_list, dtype=np.int64)
+    ensemble_index = int(os.path.basename(prediction_file)[:-3].split("_")[-1])
+    #Get hydrograph data from ECMWF Ensemble
+    with RAPIDDataset(prediction_file) as data_nc:
+        data_values_2d_array = data_nc.get_qout_index(river_index_list)
+
+        #add data to main arrays and order in order of interim comids
+        if len(data_values_2d_array) > 0:
+            data_values_2d_array = np.atleast_2d(data_values_2d_array)
+            if(ensemble_index < 52):
+                first_half_data[river_rows] = data_values_2d_array[:, :first_half_size]
+                second_half_data[river_rows] = data_values_2d_array[:, first_half_size:]
+            if(ensemble_index == 52):
+                if first_half_size == 65:
+                    #convert to 3hr-6hr
+                    streamflow_1hr = data_values_2d_array[:, :90:3]
+                    # get the time series of 3 hr/6 hr data
+                    streamflow_3hr_6hr = data_values_2d_array[:, 90:]
+                    # concatenate all time series
+                    first_half_data[river_rows] = np.concatenate([streamflow_1hr, streamflow_3hr_6hr], axis=1)
+                elif data_nc.size_time == 125:
+                    #convert to 6hr
+                    streamflow_1hr = data_values_2d_array[:, :90:6]
+                    # calculate time series of 6 hr data from 3 hr data
+                    streamflow_3hr = data_values_2d_array[:, 90:109:2]
+                    # get the time series of 6 hr data
+                    streamflow_6hr = data_values_2d_array[:, 109:]
+                    # concatenate all time series
+                    first_half_data[river_rows] = np.concatenate([streamflow_1hr, streamflow_3hr, streamflow_6hr], axis=1)
+                else:
+                    first_half_data[river_rows] = data_values_2d_array
+    return first_half_data, second_half_data
+
+def iter_ecmwf_ensemble_hydrographs(prediction_files, river_index_list,
+                                    num_rivers, first_half_size,
+                                    num_readers=1, reader_type="thread",
+                                    river_row_list=None):
+    ''' Read the ECMWF ensembles with up to num_readers threads or processes.
+        Yields each ensemble as soon as it is read (not in file order).
+        Ensembles that fail to read are yielded as zero flow.
+
+        @type prediction_files: C{list}
+        @param prediction_files: Paths to RAPID Qout files of the ensembles
+        @type num_readers:      C{int}
+        @param num_readers:     Number of files to read at the same time
+        @type reader_type:      C{str}
+        @param reader_type:     thread or process (NOTE: thread requires thread-safe
+                                NetCDF/HDF5 libraries and process does not work
+                                inside of multiprocessing.Pool workers)
+        @type river_row_list:   C{list}
+        @param river_row_list:  Rows of the rivers in river_index_list in the
+                                output arrays (all rows if None)
+        @rtype:                 C{generator}
+        @return:                (file index, first half array, second half array)
+        '''
+    def get_zero_flow():
+        return np.zeros((num_rivers, first_half_size)), np.zeros((num_rivers, 20))
+
+    if num_readers <= 1 or not CONCURRENT_FUTURES_ENABLED:
+        for file_index, prediction_file in enumerate(prediction_files):
+            try:
+                yield (file_index,) + read_ecmwf_ensemble_hydrographs(prediction_file,
+                                                                      river_index_list,
+                                                                      num_rivers,
+                                                                      first_half_size,
+                                                                      river_row_list)
+            except Exception as e:
+                print(e)
+                yield (file_index,) + get_zero_flow()
+        return
+
+    if reader_type == "process":
+        executor = ProcessPoolExecutor(max_workers=num_readers)
+    elif reader_type == "thread":
+        executor = ThreadPoolExecutor(max_workers=num_readers)
+    else:
+        raise Exception("Invalid reader type {0}. Only thread or process allowed ...".format(reader_type))
+
+    try:
+        #keep at most 2 files per reader in memory
+        file_index_list = list(range(len(prediction_files)))[::-1]
+        future_file_index = {}
+        while file_index_list or future_file_index:
+            while file_index_list and len(future_file_index) < 2 * num_readers:
+                file_index = file_index_list.pop()
+                future = executor.submit(read_ecmwf_ensemble_hydrographs,
+                                         prediction_files[file_index],
+                                         river_index_list,
+                                         num_rivers,
+                                         first_half_size,
+                                         river_row_list)
+                future_file_index[future] = file_index
+
+            done_futures = wait(list(future_file_index), return_when=FIRST_COMPLETED)[0]
+            for future in done_futures:
+                file_index = future_file_index.pop(future)
+                try:
+                    yield (file_index,) + future.result()
+                except Exception as e:
+                    print(e)
+                    yield (file_index,) + get_zero_flow()
+    finally:
+        executor.shutdown(wait=True)
+
+def get_river_chunk_size(data_nc, time_length, max_memory_fraction=0.1):
+    ''' Number of rivers to read from a RAPID Qout file at once so that
+        the data uses at most max_memory_fraction of the available memory.
+        It is rounded down to a multiple of the NetCDF chunk size along the
+        river dimension if that chunk fits in memory (e.g. not for RAPID
+        Qout files chunked as (1, number of rivers)).
+
+        @type data_nc:      C{RAPIDpy.dataset.RAPIDDataset}
+        @param data_nc:     Open RAPID Qout dataset
+        @type time_length:  C{int}
+        @param time_length: Number of time steps read per river
+        @type max_memory_fraction: C{float}
+        @param max_memory_fraction: Fraction of available memory to use
+        @rtype:             C{int}
+        @return:            Number of rivers per read
+        '''
+    try:
+        qout_var = data_nc.qout_nc.variables[data_nc.q_var_name]
+        itemsize = qout_var.dtype.itemsize
+    except (AttributeError, KeyError):
+        qout_var = None
+        itemsize = 4
+    #reading converts to float64 and masks missing data
+    bytes_per_river = max(1, time_length) * (itemsize + 9)
+    river_chunk_size = max(1, int(get_available_memory() * max_memory_fraction / bytes_per_river))
+
+    try:
+        chunking = qout_var.chunking()
+        if chunking != 'contiguous':
+            river_axis = qout_var.dimensions.index(data_nc.river_id_dimension)
+            nc_river_chunk_size = chunking[river_axis]
+            if nc_river_chunk_size <= river_chunk_size:
+                river_chunk_size = river_chunk_size // nc_river_chunk_size * nc_river_chunk_size
+    except (AttributeError, IndexError, ValueError):
+        pass
+
+    return river_chunk_size
+
+def remove_raster(raster_path):
+    ''' Remove a raster written to disk or to GDAL memory (/vsimem/)
+
+        @type raster_path:  C{str}
+        @param raster_path: Path to the raster
+        '''
+    if raster_path.startswith("/vsimem/"):
+        gdal.Unlink(raster_path)
+    else:
+        try:
+            os.remove(raster_path)
+        except OSError:
+            pass
+
+def get_river_row_indices(sorted_river_ids, river_sort_order, stream_ids):
+    ''' Row of each stream id in a NetCDF river dimension
+        (-1 for stream ids not in the file)
+
+        @type sorted_river_ids:  C{numpy.ndarray}
+        @param sorted_river_ids: River ids of the file in sorted order
+        @type river_sort_order:  C{numpy.ndarray}
+        @param river_sort_order: Row in the file of each sorted river id
+        @type stream_ids:        C{numpy.ndarray}
+        @param stream_ids:       Stream ids to find
+        @rtype:                  C{numpy.ndarray}
+        @return:                 Row of each stream id in the file
+        '''
+    stream_ids = np.asarray(stream_ids, dtype=np.int64)
+    row_indices = np.full(len(stream_ids), -1, dtype=np.int64)
+    if len(sorted_river_ids) > 0:
+        sorted_index = np.searchsorted(sorted_river_ids, stream_ids)
+        sorted_index[sorted_index >= len(sorted_river_ids)] = 0
+        found_stream_ids = sorted_river_ids[sorted_index] == stream_ids
+        row_indices[found_stream_ids] = river_sort_order[sorted_index[found_stream_ids]]
+    return row_indices
+
+def read_river_rows(nc_variable, row_indices):
+    ''' Read only the rows of a 1D NetCDF river variable that are needed.
+        Close rows are read as one slice, scattered rows by index.
+
+        @type nc_variable:   C{netCDF4.Variable}
+        @param nc_variable:  River variable to read
+        @type row_indices:   C{numpy.ndarray}
+        @param row_indices:  Rows to read
+        @rtype:              C{numpy.ndarray}
+        @return:             Values of the rows in the order given
+        '''
+    if len(row_indices) <= 0:
+        return np.array([], dtype=nc_variable.dtype)
+    unique_rows, row_order = np.unique(row_indices, return_inverse=True)
+    row_start = unique_rows[0]
+    row_end = unique_rows[-1] + 1
+    if row_end - row_start <= 8 * len(unique_rows):
+        unique_values = nc_variable[row_start:row_end][unique_rows - row_start]
+    else:
+        unique_values = nc_variable[unique_rows]
+    return np.ma.filled(unique_values, 0)[row_order]
+
+#------------------------------------------------------------------------------
+#Ensemble Statistic Classes
+#------------------------------------------------------------------------------
+class EnsembleStatistic(object):
+    """
+    This class keeps all ensembles in a (river, ensemble, time) array
+    and reduces them along the ensemble axis
+    """
+    def __init__(self, method, shape, dtype=np.float64):
+        """
+        Initialize the class with variables given by the user
+        """
+        self.method = method
+        self.data = np.zeros(shape, dtype=dtype)
+
+    def add(self, ensemble_index, data_array):
+        """
+        Add (river, time) array of one ensemble
+        """
+        self.data[:, ensemble_index] = data_array
+
+    def get_statistic(self):
+        """
+        Get (river, time) array of the statistic over the ensembles
+        """
+        return get_statistic(self.data, self.method, axis=1)
+
+class RunningEnsembleStatistic(object):
+    """
+    This class folds the ensembles one at a time into running statistics
+    (Welford's algorithm for mean and standard deviation), so memory
+    does not depend on the number of ensembles
+    """
+    def __init__(self, method, dtype=np.float64):
+        """
+        Initialize the class with variables given by the user
+        """
+        if method not in VALID_STATISTIC_METHODS:
+            raise Exception("Invalid statistic method {0} ...".format(method))
+        self.method = method
+        self.dtype = dtype
+        self.count = 0
+        self.value = None
+        self.sum_squared_difference = None
+
+    def add(self, ensemble_index, data_array):
+        """
+        Fold (river, time) array of one ensemble into the statistic
+        """
+        data_array = np.asarray(data_array, dtype=self.dtype)
+        self.count += 1
+        if self.value is None:
+            self.value = data_array.copy()
+            if "std" in self.method:
+                self.sum_squared_difference = np.zeros_like(self.value)
+        elif self.method == "max":
+            np.maximum(self.value, data_array, out=self.value)
+        elif self.method == "min":
+            np.minimum(self.value, data_array, out=self.value)
+        else:
+            difference = data_array - self.value
+            self.value += difference / self.count
+            if "std" in self.method:
+                self.sum_squared_difference += difference * (data_array - self.value)
+
+    def get_statistic(self):
+        """
+        Get (river, time) array of the statistic over the ensembles
+        """
+        statistic = self.value.copy()
+        if self.method == "mean_plus_std":
+            statistic += np.sqrt(self.sum_squared_difference / self.count)
+        elif self.method == "mean_minus_std":
+            statistic -= np.sqrt(self.sum_squared_difference / self.count)
+        return statistic
     
 #------------------------------------------------------------------------------
 #Main Dataset Manager Class
@@ -76,19 +423,58 @@ class AutoRoutePrepare(object):
     """
 
     def __init__(self, autoroute_executable_location, elevation_dem_path, 
-                 stream_info_file, stream_shapefile_path=""):
+                 stream_info_file, stream_shapefile_path="",
+                 use_binary_sidecar=False, stream_network_index_directory=""):
         """
         Initialize the class with variables given by the user
+
+        If use_binary_sidecar is True, the stream info table is kept in a
+        memory-mapped binary file next to the stream info file between stages
+        and the text file is only written by render_stream_info_file.
+
+        stream_network_index_directory is the directory of the stream network
+        index if it is not next to the stream network (see StreamNetworkIndex).
         """
         self.autoroute_executable_location = autoroute_executable_location
         self.elevation_dem_path = elevation_dem_path
         self.stream_info_file = stream_info_file
         self.stream_shapefile_path = stream_shapefile_path
+        self.use_binary_sidecar = use_binary_sidecar
+        self.stream_network_index_directory = stream_network_index_directory
+        #sorted river id index of NetCDF files by file identity
+        self._river_index_cache = {}
+
+    def read_stream_info_table(self):
+        """
+        Read the stream info table (from the binary sidecar if enabled)
+        """
+        return StreamInfoTable.read(self.stream_info_file,
+                                    use_sidecar=self.use_binary_sidecar)
+
+    def write_stream_info_table(self, stream_info_table):
+        """
+        Write the stream info table (to the binary sidecar if enabled)
+        """
+        stream_info_table.save(self.stream_info_file,
+                               use_sidecar=self.use_binary_sidecar)
+
+    def render_stream_info_file(self):
+        """
+        Write the stream info text file from the binary sidecar for AutoRoute
+        """
+        render_stream_info_file(self.stream_info_file)
     
-    def generate_raster_from_dem(self, raster_path, dtype=gdal.GDT_Int32):
+    def generate_raster_from_dem(self, raster_path, dtype=gdal.GDT_Int32,
+                                 creation_options=None):
         """
         Create an empty raster based on the DEM file
+        (raster_path can be in memory, e.g. /vsimem/stream_raster.tif)
+
+        The raster is tiled and compressed with the raster creation profile
+        of dtype unless creation_options are given.
         """
+        if creation_options is None:
+            creation_options = get_raster_creation_options(get_raster_profile_from_data_type(dtype))
         # Create the destination data source
         template_raster = gdal.Open(self.elevation_dem_path)
         template_raster_band = template_raster.GetRasterBand(1)
@@ -96,7 +482,8 @@ class AutoRoutePrepare(object):
         if target_driver is None:
             raise ValueError("Can't find GTiff Driver")
         target_ds = target_driver.Create(raster_path, template_raster_band.XSize,
-                                         template_raster_band.YSize, 1, dtype)
+                                         template_raster_band.YSize, 1, dtype,
+                                         options=creation_options)
         
         target_ds.SetGeoTransform(template_raster.GetGeoTransform())
         out_projection = osr.SpatialReference()
@@ -107,21 +494,41 @@ class AutoRoutePrepare(object):
 
         return target_ds
 
-    def rasterize_stream_shapefile(self, streamid_raster_path, stream_id, input_dtype=gdal.GDT_Int32):
+    def rasterize_stream_shapefile(self, streamid_raster_path, stream_id, input_dtype=gdal.GDT_Int32,
+                                   creation_options=None):
         """
         Convert stream shapefile to raster with stream ids/slope
+
+        Only streams within the extent of the elevation DEM are rasterized.
+        The raster can be written to memory (e.g. /vsimem/stream_raster.tif)
+        or with creation_options such as get_raster_creation_options('scratch').
         """
         print("Converting stream shapefile to raster ...")
         # Open the data source
         stream_shapefile = ogr.Open(self.stream_shapefile_path)
         source_layer = stream_shapefile.GetLayer(0)
 
-        target_ds = self.generate_raster_from_dem(streamid_raster_path, dtype=input_dtype)
+        self.spatially_filter_streamfile_layer_by_elevation_dem(source_layer)
+
+        target_ds = self.generate_raster_from_dem(streamid_raster_path, dtype=input_dtype,
+                                                  creation_options=creation_options)
         # Rasterize
         err = gdal.RasterizeLayer(target_ds, [1], source_layer, options=["ATTRIBUTE=%s" % stream_id])
         if err != 0:
             raise Exception("error rasterizing layer: %s" % err)
+        target_ds.FlushCache()
             
+    def get_elevation_dem_extent(self, stream_shp_layer):
+        """
+        Get the footprint coordinates of the elevation DEM with densified
+        edges in the projection of the stream layer (DEM projection if
+        the layer has none)
+        """
+        tgt_srs = stream_shp_layer.GetSpatialRef()
+        if tgt_srs is None:
+            print("Stream layer has no projection. Using DEM projection ...")
+        return get_raster_footprints([self.elevation_dem_path], tgt_srs)[0]
+
     def spatially_filter_streamfile_layer_by_elevation_dem(self, stream_shp_layer):
         """
         This function returns the stream shapefile spatially filtered if possible
@@ -130,28 +537,34 @@ class AutoRoutePrepare(object):
         #get extent from elevation raster to filter data
         try:
             print("Attempting to filter ...")
-            elevation_raster = gdal.Open(self.elevation_dem_path)
-
-            gt=elevation_raster.GetGeoTransform()
-            cols = elevation_raster.RasterXSize
-            rows = elevation_raster.RasterYSize
-            raster_ext = GetExtent(gt,cols,rows)
-
-            src_srs=osr.SpatialReference()
-            src_srs.ImportFromWkt(elevation_raster.GetProjection())
-            tgt_srs = stream_shp_layer.GetSpatialRef()
-
-            raster_ext = ReprojectCoords(raster_ext,src_srs,tgt_srs)
-            
-            #read in the shapefile and get the data for slope
-            string_rast_ext = ["{0} {1}".format(x,y) for x,y in raster_ext]
-            wkt = "POLYGON (({0},{1}))".format(",".join(string_rast_ext), string_rast_ext[0])
-            stream_shp_layer.SetSpatialFilter(ogr.CreateGeometryFromWkt(wkt))
+            raster_ext = self.get_elevation_dem_extent(stream_shp_layer)
+            stream_shp_layer.SetSpatialFilter(get_footprint_polygon(raster_ext))
         except Exception as ex:
             print(ex)
             print("Skipping filter. This may take longer ...")
             pass
 
+    def iter_stream_features(self, stream_shp_layer):
+        """
+        Iterate over the features of the stream layer within the extent
+        of the elevation DEM (from the stream network index if it is current)
+        """
+        stream_network_index = StreamNetworkIndex(self.stream_shapefile_path,
+                                                  self.stream_network_index_directory)
+        if stream_network_index.is_current():
+            try:
+                raster_ext = self.get_elevation_dem_extent(stream_shp_layer)
+                return stream_network_index.iter_features(stream_shp_layer,
+                                                          (raster_ext[:, 0].min(), raster_ext[:, 1].min(),
+                                                           raster_ext[:, 0].max(), raster_ext[:, 1].max()))
+            except Exception as ex:
+                print(ex)
+                print("Skipping stream network index ...")
+                pass
+
+        self.spatially_filter_streamfile_layer_by_elevation_dem(stream_shp_layer)
+        return stream_shp_layer
+
     def generate_stream_info_file_with_direction(self, stream_raster_file_name,
                                                  search_radius):
         """
@@ -161,6 +574,12 @@ class AutoRoutePrepare(object):
         time_start = datetime.datetime.utcnow()
                         
 
+        #remove binary sidecar from previous stream info file
+        try:
+            os.remove(StreamInfoTable.get_sidecar_file(self.stream_info_file))
+        except OSError:
+            pass
+
         #run AutoRoute
         print("Running AutoRoute prepare ...")
         process = Popen([self.autoroute_executable_location,
@@ -178,6 +597,52 @@ class AutoRoutePrepare(object):
 
         print("Time to run: %s" % (datetime.datetime.utcnow()-time_start))
 
+    def generate_stream_info_file_from_raster(self, stream_raster_file_name,
+                                              search_radius, block_size=1024):
+        """
+        Generate stream info input file with stream direction in this process
+        (same table as the AutoRoute prepare executable), block_size rows
+        of the stream raster at a time
+        """
+        time_start = datetime.datetime.utcnow()
+
+        #remove binary sidecar from previous stream info file
+        try:
+            os.remove(StreamInfoTable.get_sidecar_file(self.stream_info_file))
+        except OSError:
+            pass
+
+        print("Generating stream info file from stream raster ...")
+        search_radius = int(search_radius)
+        stream_raster = gdal.Open(stream_raster_file_name)
+        stream_raster_band = stream_raster.GetRasterBand(1)
+        num_rows = stream_raster_band.YSize
+        num_cols = stream_raster_band.XSize
+
+        def iter_stream_info_blocks():
+            for block_start in range(0, num_rows, block_size):
+                block_end = min(block_start + block_size, num_rows)
+                #read the neighboring rows to search across blocks
+                read_start = max(0, block_start - search_radius)
+                read_end = min(num_rows, block_end + search_radius)
+                stream_id_block = stream_raster_band.ReadAsArray(0, read_start, num_cols,
+                                                                 read_end - read_start)
+                yield get_stream_info_block(stream_id_block,
+                                            search_radius,
+                                            block_first_row=read_start,
+                                            first_row=block_start - read_start,
+                                            last_row=block_end - read_start)
+
+        if self.use_binary_sidecar:
+            StreamInfoTable(np.concatenate([stream_info_block.table for stream_info_block
+                                            in iter_stream_info_blocks()])) \
+                .write_sidecar(self.stream_info_file)
+        else:
+            with StreamInfoFileWriter(self.stream_info_file) as writer:
+                for stream_info_block in iter_stream_info_blocks():
+                    writer.write(stream_info_block)
+
+        print("Time to run: %s" % (datetime.datetime.utcnow()-time_start))
 
     def generate_manning_n_raster(self, land_use_raster,
                                   input_manning_n_table,
@@ -209,55 +674,98 @@ class AutoRoutePrepare(object):
 
         print("Time to run: %s" % (datetime.datetime.utcnow()-time_start))
 
-    def append_slope_to_stream_info_file(self, stream_id_field="COMID", slope_field="slope"):
+    def generate_manning_n_raster_from_land_use(self, land_use_raster,
+                                                input_manning_n_table,
+                                                output_manning_n_raster,
+                                                default_manning_n,
+                                                num_threads=1,
+                                                max_memory_fraction=0.1):
         """
-        Add the slope attribute to the stream direction file
+        Generate Manning's n raster on the DEM grid in this process by
+        reclassifying the land use raster with the Manning's n table
+        (default_manning_n for land use classes not in the table)
+
+        The land use raster is read in blocks of DEM rows that use at most
+        max_memory_fraction of the available memory and are reclassified
+        by up to num_threads threads.
+        """
+        time_start = datetime.datetime.utcnow()
+
+        print("Generating Manning's n raster ...")
+        template_raster = gdal.Open(self.elevation_dem_path)
+        num_rows = template_raster.RasterYSize
+        manning_n_reclassifier = ManningNReclassifier(land_use_raster,
+                                                      input_manning_n_table,
+                                                      default_manning_n,
+                                                      template_raster.GetGeoTransform(),
+                                                      template_raster.RasterXSize)
+        template_raster = None
+
+        target_ds = self.generate_raster_from_dem(output_manning_n_raster,
+                                                  dtype=gdal.GDT_Float32,
+                                                  creation_options=get_raster_creation_options('float',
+                                                                                               num_threads=num_threads))
+        manning_n_reclassifier.write(target_ds.GetRasterBand(1),
+                                     num_rows,
+                                     max_memory_fraction=max_memory_fraction,
+                                     num_threads=num_threads)
+        target_ds.FlushCache()
+        target_ds = None
+
+        print("Time to run: %s" % (datetime.datetime.utcnow()-time_start))
+
+    def get_stream_attribute_from_shapefile(self, stream_id_field, attribute_field):
+        """
+        Get the stream ids and attribute values from the stream shapefile
+        within the extent of the elevation DEM
         """
         stream_shapefile = ogr.Open(self.stream_shapefile_path)
         stream_shp_layer = stream_shapefile.GetLayer()
 
-        self.spatially_filter_streamfile_layer_by_elevation_dem(stream_shp_layer)
+        stream_id_list = []
+        attribute_list = []
+        for feature in self.iter_stream_features(stream_shp_layer):
+            stream_id_list.append(int(float(feature.GetField(stream_id_field))))
+            attribute_list.append(feature.GetField(attribute_field))
+
+        return (np.array(stream_id_list, dtype=np.int64),
+                np.array(attribute_list, dtype=np.float64))
+
+    def append_slope_to_stream_info_file(self, stream_id_field="COMID", slope_field="slope"):
+        """
+        Add the slope attribute to the stream direction file
+        """
+        stream_id_array, slope_array = \
+            self.get_stream_attribute_from_shapefile(stream_id_field, slope_field)
 
         print("Writing output to file ...")
-        stream_info_table = csv_to_list(self.stream_info_file, ", ")[1:]
-        #Columns: DEM_1D_Index Row Col StreamID StreamDirection
-        stream_id_list = np.array([row[3] for row in stream_info_table], dtype=np.int32)
-        
-        temp_stream_info_file = "{0}_temp.txt".format(os.path.splitext(self.stream_info_file)[0])
-        with open_csv(temp_stream_info_file, 'w') as outfile:
-            writer = csv.writer(outfile, delimiter=" ")
-            writer.writerow([u"DEM_1D_Index", u"Row", u"Col", u"StreamID", u"StreamDirection", u"Slope"])
-            for feature in stream_shp_layer:
-                #find all raster indices associates with the comid
-                raster_index_list = np.where(stream_id_list==int(float(feature.GetField(stream_id_field))))[0]
-                #add slope associated with comid    
-                slope = feature.GetField(slope_field)
-                for raster_index in raster_index_list:
-                    writer.writerow(stream_info_table[raster_index][:5] + [slope] + stream_info_table[raster_index][6:])
-
-        os.remove(self.stream_info_file)
-        os.rename(temp_stream_info_file, self.stream_info_file)
+        stream_info_table = self.read_stream_info_table()
+        self.write_stream_info_table(stream_info_table.join(stream_id_array,
+                                                            slope_array,
+                                                            "Slope"))
 
-    def append_streamflow_from_ecmwf_rapid_output(self, prediction_folder,
-                                                  method_x, method_y):
+    def get_streamflow_from_ecmwf_rapid_output(self, prediction_folder,
+                                               method_x, method_y, stream_ids,
+                                               streaming=False,
+                                               accumulator_dtype=np.float64,
+                                               num_readers=1,
+                                               reader_type="thread"):
         """
-        Generate StreamFlow raster
-        Create AutoRAPID INPUT from ECMWF predicitons
-     
+        Get the streamflow of each stream id from ECMWF predicitons
+
         method_x = the first axis - it produces the max, min, mean, mean_plus_std, mean_minus_std hydrograph data for the 52 ensembles
         method_y = the second axis - it calculates the max, min, mean, mean_plus_std, mean_minus_std value from method_x
+        streaming = fold each ensemble into running statistics instead of keeping all ensembles in memory
+        accumulator_dtype = dtype of the ensemble arrays/running statistics (e.g. np.float32 to halve memory)
+        num_readers = number of ensemble files to read at the same time
+        reader_type = read ensemble files with a thread or process pool
         """
-     
-        print("Generating Streamflow Raster ...")
-        #get list of streamidS
-        stream_info_table = csv_to_list(self.stream_info_file, ", ")[1:]
+        for method in (method_x, method_y):
+            if method not in VALID_STATISTIC_METHODS:
+                raise Exception("Invalid statistic method {0}. Valid methods are: " \
+                                "{1} ...".format(method, ", ".join(VALID_STATISTIC_METHODS)))
 
-        #Columns: DEM_1D_Index Row Col StreamID StreamDirection
-        streamid_list_full = np.array([row[3] for row in stream_info_table], dtype=np.int32)
-        streamid_list_unique = np.unique(streamid_list_full)
-        if not streamid_list_unique:
-            raise Exception("ERROR: No stream id values found in stream info file.")
-        
+        stream_ids = np.array(stream_ids, dtype=np.int64)
         #Get list of prediciton files
         prediction_files = sorted([os.path.join(prediction_folder,f) for f in os.listdir(prediction_folder) \
                                   if not os.path.isdir(os.path.join(prediction_folder, f)) and f.lower().endswith('.nc')],
@@ -266,7 +774,10 @@ class AutoRoutePrepare(object):
      
         print("Finding streamid indices ...")
         with RAPIDDataset(prediction_files[0]) as data_nc:
-            reordered_streamid_index_list = data_nc.get_subset_riverid_index_list(streamid_list_unique)[0]
+            reordered_streamid_index_list, valid_stream_ids = \
+                data_nc.get_subset_riverid_index_list(stream_ids)[:2]
+            #rows of the stream ids in the RAPID output (others have zero flow)
+            valid_stream_rows = np.flatnonzero(np.isin(stream_ids, valid_stream_ids))
 
             first_half_size = 40
             if data_nc.size_time == 41 or data_nc.size_time == 61:
@@ -276,266 +787,388 @@ class AutoRoutePrepare(object):
                 first_half_size = 65
         
         print("Extracting Data ...")
-        reach_prediciton_array_first_half = np.zeros((len(streamid_list_unique),len(prediction_files),first_half_size))
-        reach_prediciton_array_second_half = np.zeros((len(streamid_list_unique),len(prediction_files),20))
+        if streaming:
+            #fold each ensemble into running statistics
+            first_half_statistic = RunningEnsembleStatistic(method_x, dtype=accumulator_dtype)
+            second_half_statistic = RunningEnsembleStatistic(method_x, dtype=accumulator_dtype)
+        else:
+            #(reach, ensemble, time) arrays of the ensemble hydrographs
+            first_half_statistic = EnsembleStatistic(method_x,
+                                                     (len(stream_ids), len(prediction_files), first_half_size),
+                                                     dtype=accumulator_dtype)
+            second_half_statistic = EnsembleStatistic(method_x,
+                                                      (len(stream_ids), len(prediction_files), 20),
+                                                      dtype=accumulator_dtype)
         #get information from datasets
-        for file_index, prediction_file in enumerate(prediction_files):
-            data_values_2d_array = []
-            try:
-                ensemble_index = int(os.path.basename(prediction_file)[:-3].split("_")[-1])
-                #Get hydrograph data from ECMWF Ensemble
-                with RAPIDDataset(prediction_file) as data_nc:
-                    data_values_2d_array = data_nc.get_qout_index(reordered_streamid_index_list)
-    
-                    #add data to main arrays and order in order of interim comids
-                    if len(data_values_2d_array) > 0:
-                        for comid_index in range(len(streamid_list_unique)):
-                            if(ensemble_index < 52):
-                                reach_prediciton_array_first_half[comid_index][file_index] = data_values_2d_array[comid_index][:first_half_size]
-                                reach_prediciton_array_second_half[comid_index][file_index] = data_values_2d_array[comid_index][first_half_size:]
-                            if(ensemble_index == 52):
-                                if first_half_size == 65:
-                                    #convert to 3hr-6hr
-                                    streamflow_1hr = data_values_2d_array[comid_index][:90:3]
-                                    # get the time series of 3 hr/6 hr data
-                                    streamflow_3hr_6hr = data_values_2d_array[comid_index][90:]
-                                    # concatenate all time series
-                                    reach_prediciton_array_first_half[comid_index][file_index] = np.concatenate([streamflow_1hr, streamflow_3hr_6hr])
-                                elif data_nc.size_time == 125:
-                                    #convert to 6hr
-                                    streamflow_1hr = data_values_2d_array[comid_index][:90:6]
-                                    # calculate time series of 6 hr data from 3 hr data
-                                    streamflow_3hr = data_values_2d_array[comid_index][90:109:2]
-                                    # get the time series of 6 hr data
-                                    streamflow_6hr = data_values_2d_array[comid_index][109:]
-                                    # concatenate all time series
-                                    reach_prediciton_array_first_half[comid_index][file_index] = np.concatenate([streamflow_1hr, streamflow_3hr, streamflow_6hr])
-                                else:
-                                    reach_prediciton_array_first_half[comid_index][file_index] = data_values_2d_array[comid_index][:]
-                                
-            except Exception as e:
-                print(e)
-                #pass
+        for file_index, first_half_data, second_half_data in \
+                iter_ecmwf_ensemble_hydrographs(prediction_files,
+                                                reordered_streamid_index_list,
+                                                len(stream_ids),
+                                                first_half_size,
+                                                num_readers=num_readers,
+                                                reader_type=reader_type,
+                                                river_row_list=valid_stream_rows):
+            first_half_statistic.add(file_index, first_half_data)
+            second_half_statistic.add(file_index, second_half_data)
      
-        print("Analyzing data and writing output ...")
-        temp_stream_info_file = "{0}_temp.txt".format(os.path.splitext(self.stream_info_file)[0])
-        with open(temp_stream_info_file, 'w', newline='') as outfile:
-            writer = csv.writer(outfile, delimiter=" ")
-            writer.writerow([u"DEM_1D_Index", u"Row", u"Col", u"StreamID", u"StreamDirection", u"Slope", "uFlow"])
-
-            for streamid_index, streamid in enumerate(streamid_list_unique):
-                #perform analysis on datasets
-                all_data_first = reach_prediciton_array_first_half[streamid_index]
-                all_data_second = reach_prediciton_array_second_half[streamid_index]
-         
-                series = []
-         
-                if "mean" in method_x:
-                    #get mean
-                    mean_data_first = np.mean(all_data_first, axis=0)
-                    mean_data_second = np.mean(all_data_second, axis=0)
-                    series = np.concatenate([mean_data_first,mean_data_second])
-                    if "std" in method_x:
-                        #get std dev
-                        std_dev_first = np.std(all_data_first, axis=0)
-                        std_dev_second = np.std(all_data_second, axis=0)
-                        std_dev = np.concatenate([std_dev_first,std_dev_second])
-                        if method_x == "mean_plus_std":
-                            #mean plus std
-                            series += std_dev
-                        elif method_x == "mean_minus_std":
-                            #mean minus std
-                            series -= std_dev
-         
-                elif method_x == "max":
-                    #get max
-                    max_data_first = np.amax(all_data_first, axis=0)
-                    max_data_second = np.amax(all_data_second, axis=0)
-                    series = np.concatenate([max_data_first,max_data_second])
-                elif method_x == "min":
-                    #get min
-                    min_data_first = np.amin(all_data_first, axis=0)
-                    min_data_second = np.amin(all_data_second, axis=0)
-                    series = np.concatenate([min_data_first,min_data_second])
-         
-                data_val = 0
-                if "mean" in method_y:
-                    #get mean
-                    data_val = np.mean(series)
-                    if "std" in method_y:
-                        #get std dev
-                        std_dev = np.std(series)
-                        if method_y == "mean_plus_std":
-                            #mean plus std
-                            data_val += std_dev
-                        elif method_y == "mean_minus_std":
-                            #mean minus std
-                            data_val -= std_dev
-         
-                elif method_y == "max":
-                    #get max
-                    data_val = np.amax(series)
-                elif method_y == "min":
-                    #get min
-                    data_val = np.amin(series)
-         
-                #get where streamids are in the lookup grid id table
-                raster_index_list = np.where(streamid_list_full==streamid)[0]
-                for raster_index in raster_index_list:
-                    writer.writerow(stream_info_table[raster_index][:6] + [data_val])
-
-        os.remove(self.stream_info_file)
-        os.rename(temp_stream_info_file, self.stream_info_file)
+        print("Analyzing data ...")
+        #perform analysis on datasets for all reaches at once
+        series = np.concatenate([first_half_statistic.get_statistic(),
+                                 second_half_statistic.get_statistic()],
+                                axis=1)
+        return stream_ids, get_statistic(series, method_y, axis=1)
+
+    def append_streamflow_from_ecmwf_rapid_output(self, prediction_folder,
+                                                  method_x, method_y,
+                                                  streaming=False,
+                                                  accumulator_dtype=np.float64,
+                                                  num_readers=1,
+                                                  reader_type="thread"):
+        """
+        Generate StreamFlow raster
+        Create AutoRAPID INPUT from ECMWF predicitons
+     
+        method_x = the first axis - it produces the max, min, mean, mean_plus_std, mean_minus_std hydrograph data for the 52 ensembles
+        method_y = the second axis - it calculates the max, min, mean, mean_plus_std, mean_minus_std value from method_x
+        streaming = fold each ensemble into running statistics instead of keeping all ensembles in memory
+        accumulator_dtype = dtype of the ensemble arrays/running statistics (e.g. np.float32 to halve memory)
+        num_readers = number of ensemble files to read at the same time
+        reader_type = read ensemble files with a thread or process pool
+        """
+     
+        print("Generating Streamflow Raster ...")
+        #get list of streamidS
+        stream_info_table = self.read_stream_info_table()
+        streamid_list_unique = stream_info_table.unique_stream_ids
+        if len(streamid_list_unique) <= 0:
+            raise Exception("ERROR: No stream id values found in stream info file.")
+        
+        stream_ids, streamflows = \
+            self.get_streamflow_from_ecmwf_rapid_output(prediction_folder,
+                                                        method_x,
+                                                        method_y,
+                                                        streamid_list_unique,
+                                                        streaming=streaming,
+                                                        accumulator_dtype=accumulator_dtype,
+                                                        num_readers=num_readers,
+                                                        reader_type=reader_type)
+
+        print("Writing output ...")
+        self.write_stream_info_table(stream_info_table.join(stream_ids,
+                                                            streamflows,
+                                                            "Flow"))
     
+    def get_peak_streamflow_from_rapid_output(self, rapid_output_file, stream_ids,
+                                              date_peak_search_start=None,
+                                              date_peak_search_end=None,
+                                              max_memory_fraction=0.1,
+                                              peak_flow_cache_directory=""):
+        """
+        Get the peak streamflow of each stream id from a single RAPID output
+        (zero for stream ids missing in the RAPID output)
+
+        The rivers are read in file order in chunks sized to use at most
+        max_memory_fraction of the available memory.
+
+        If peak_flow_cache_directory is set, the peak flows of all rivers
+        in the RAPID output are computed once and stored there for all
+        subbasins using the same RAPID output and search dates.
+        """
+        if peak_flow_cache_directory:
+            def get_all_peak_flows(rapid_output_file, date_peak_search_start,
+                                   date_peak_search_end):
+                with RAPIDDataset(rapid_output_file) as data_nc:
+                    all_stream_ids = data_nc.get_river_id_array()
+                return self.get_peak_streamflow_from_rapid_output(rapid_output_file,
+                                                                  all_stream_ids,
+                                                                  date_peak_search_start,
+                                                                  date_peak_search_end,
+                                                                  max_memory_fraction)
+
+            return PeakFlowCache(peak_flow_cache_directory) \
+                .get_peak_flows(rapid_output_file, stream_ids, get_all_peak_flows,
+                                date_peak_search_start, date_peak_search_end)
+
+        stream_ids = np.array(stream_ids, dtype=np.int64)
+        with RAPIDDataset(rapid_output_file) as data_nc:
+            
+            time_range = data_nc.get_time_index_range(date_search_start=date_peak_search_start,
+                                                      date_search_end=date_peak_search_end)
+            if time_range is not None:
+                time_length = len(time_range)
+            else:
+                time_length = data_nc.size_time
+
+            print("Finding streamid indices ...")
+            valid_stream_indices, valid_stream_ids, missing_stream_ids = \
+                data_nc.get_subset_riverid_index_list(stream_ids)
+            valid_stream_indices = np.array(valid_stream_indices, dtype=np.int64)
+            valid_stream_ids = np.array(valid_stream_ids, dtype=np.int64)
+            missing_stream_ids = np.array(missing_stream_ids, dtype=np.int64)
+            if len(missing_stream_ids) > 0:
+                print("{0} stream ids not found in RAPID output. " \
+                      "Setting flow to zero ...".format(len(missing_stream_ids)))
+
+            #read the rivers in the order they are in the file
+            read_order = np.argsort(valid_stream_indices, kind='mergesort')
+            step_size = get_river_chunk_size(data_nc, time_length, max_memory_fraction)
+            valid_peak_flows = np.zeros(len(valid_stream_ids))
+            for list_index_start in range(0, len(read_order), step_size):
+                list_index_end = min(list_index_start+step_size, len(read_order))
+                print("River ID subset range {0} to {1} of {2} ...".format(list_index_start,
+                                                                           list_index_end,
+                                                                           len(read_order)))
+                read_chunk = read_order[list_index_start:list_index_end]
+                streamflow_array = data_nc.get_qout_index(valid_stream_indices[read_chunk],
+                                                          time_index_array=time_range)
+                streamflow_array = np.ma.reshape(streamflow_array, (len(read_chunk), -1))
+                valid_peak_flows[read_chunk] = np.ma.filled(np.ma.amax(streamflow_array, axis=1), 0)
+
+        #set flow to zero for missing stream ids
+        return (np.concatenate([valid_stream_ids, missing_stream_ids]),
+                np.concatenate([valid_peak_flows, np.zeros(len(missing_stream_ids))]))
+
     def append_streamflow_from_rapid_output(self, rapid_output_file,
                                             date_peak_search_start=None,
-                                            date_peak_search_end=None):
+                                            date_peak_search_end=None,
+                                            peak_flow_cache_directory=""):
         """
         Generate StreamFlow raster
         Create AutoRAPID INPUT from single RAPID output
+        (peak flows are shared through peak_flow_cache_directory if set)
         """
         print("Appending streamflow for:", self.stream_info_file)
         #get information from datasets
         #get list of streamids
-        stream_info_table = csv_to_list(self.stream_info_file, ", ")[1:]
-        #Columns: DEM_1D_Index Row Col StreamID StreamDirection
-        streamid_list_full = np.array([row[3] for row in stream_info_table], dtype=np.int32)
-        streamid_list_unique = np.unique(streamid_list_full)
+        stream_info_table = self.read_stream_info_table()
+        streamid_list_unique = stream_info_table.unique_stream_ids
+        if len(streamid_list_unique) <= 0:
+            raise IndexError("Invalid stream info file {0}." \
+                             " No stream ID's found ...".format(self.stream_info_file))
         
-        temp_stream_info_file = "{0}_temp.txt".format(os.path.splitext(self.stream_info_file)[0])
         print("Analyzing data and appending to list ...")
-        with open_csv(temp_stream_info_file, 'w') as outfile:
-            writer = csv.writer(outfile)
-            writer.writerow([u"DEM_1D_Index", u"Row", u"Col", u"StreamID", u"StreamDirection", u"Slope", u"Flow"])
-            
-            with RAPIDDataset(rapid_output_file) as data_nc:
-                
-                time_range = data_nc.get_time_index_range(date_search_start=date_peak_search_start,
-                                                          date_search_end=date_peak_search_end)
-                #perform operation in max chunk size of 4,000
-                max_chunk_size = 8*365*5*4000 #5 years of 3hr data (8/day) with 4000 comids at a time
-                time_length = 8*365*5 #assume 5 years of 3hr data
-                if time_range is not None:
-                    time_length = len(time_range)
-                else:
-                    time_length = data_nc.size_time
+        peak_stream_ids, peak_flows = \
+            self.get_peak_streamflow_from_rapid_output(rapid_output_file,
+                                                       streamid_list_unique,
+                                                       date_peak_search_start,
+                                                       date_peak_search_end,
+                                                       peak_flow_cache_directory=peak_flow_cache_directory)
 
-                streamid_list_length = len(streamid_list_unique)
-                if streamid_list_length <=0:
-                    raise IndexError("Invalid stream info file {0}." \
-                                     " No stream ID's found ...".format(self.stream_info_file))
-                
-                step_size = min(max_chunk_size/time_length, streamid_list_length)
-                for list_index_start in range(0, streamid_list_length, step_size):
-                    list_index_end = min(list_index_start+step_size, streamid_list_length)
-                    print("River ID subset range {0} to {1} of {2} ...".format(list_index_start,
-                                                                               list_index_end,
-                                                                               streamid_list_length))
-                    print("Extracting data ...")
-                    valid_stream_indices, valid_stream_ids, missing_stream_ids = \
-                        data_nc.get_subset_riverid_index_list(streamid_list_unique[list_index_start:list_index_end])
-                        
-                    streamflow_array = data_nc.get_qout_index(valid_stream_indices,
-                                                              time_index_array=time_range)
-                    
-                    print("Calculating peakflow and writing to file ...")
-                    for streamid_index, streamid in enumerate(valid_stream_ids):
-                        #get where streamids are in the lookup grid id table
-                        peak_flow = max(streamflow_array[streamid_index])
-                        raster_index_list = np.where(streamid_list_full==streamid)[0]
-                        for raster_index in raster_index_list:
-                            writer.writerow(stream_info_table[raster_index][:6] + [peak_flow])
+        print("Writing output to file ...")
+        self.write_stream_info_table(stream_info_table.join(peak_stream_ids,
+                                                            peak_flows,
+                                                            "Flow"))
 
-                    for missing_streamid in missing_stream_ids:
-                        #set flow to zero for missing stream ids
-                        raster_index_list = np.where(streamid_list_full==missing_streamid)[0]
-                        for raster_index in raster_index_list:
-                            writer.writerow(stream_info_table[raster_index][:6] + [0])
+        print("Appending streamflow complete for:", self.stream_info_file)
 
+    def get_streamflow_from_return_period_file(self, return_period_file,
+                                               return_period, stream_ids):
+        """
+        Get the return period streamflow of each stream id from return period file
+        (zero for stream ids missing in the return period file)
+        """
+        stream_ids, peak_flow_list = \
+            self.get_streamflows_from_return_period_file(return_period_file,
+                                                         [return_period],
+                                                         stream_ids)
+        return stream_ids, peak_flow_list[0]
 
-         
-        os.remove(self.stream_info_file)
-        os.rename(temp_stream_info_file, self.stream_info_file)
+    def get_streamflows_from_return_period_file(self, return_period_file,
+                                                return_period_list, stream_ids):
+        """
+        Get the streamflow of each stream id for each return period in the
+        list with one pass through the return period file
+        (zero for stream ids missing in the return period file)
+        """
+        return_period_variables = {
+                                    'return_period_20': 'return_period_20',
+                                    'return_period_10': 'return_period_10',
+                                    'return_period_2': 'return_period_2',
+                                    'max_flow': 'return_period_2',
+                                  }
+        for return_period in return_period_list:
+            if return_period not in return_period_variables:
+                raise Exception("Invalid return period definition.")
 
-        print("Appending streamflow complete for:", self.stream_info_file)
+        print("Extracting Return Period Data ...")
+        stream_ids = np.array(stream_ids, dtype=np.int64)
+        return_period_nc = Dataset(return_period_file, mode="r")
+        try:
+            sorted_river_ids, river_sort_order = \
+                self.get_river_index(return_period_file, return_period_nc)
+            row_indices = get_river_row_indices(sorted_river_ids,
+                                                river_sort_order,
+                                                stream_ids)
+            found_stream_ids = row_indices >= 0
+
+            peak_flow_list = []
+            for return_period in return_period_list:
+                return_period_var = return_period_nc.variables[return_period_variables[return_period]]
+                peak_flows = np.zeros(len(stream_ids), dtype=return_period_var.dtype)
+                peak_flows[found_stream_ids] = read_river_rows(return_period_var,
+                                                               row_indices[found_stream_ids])
+                peak_flow_list.append(peak_flows)
+        finally:
+            return_period_nc.close()
+
+        if not found_stream_ids.all():
+            missing_stream_ids = stream_ids[~found_stream_ids]
+            missing_stream_id_string = ", ".join([str(stream_id) for stream_id
+                                                  in missing_stream_ids[:10]])
+            if len(missing_stream_ids) > 10:
+                missing_stream_id_string += ", ..."
+            print("{0} stream ids not found in return period file. " \
+                  "Setting flow to zero for: {1}".format(len(missing_stream_ids),
+                                                         missing_stream_id_string))
 
+        return stream_ids, peak_flow_list
+
+    def get_river_index(self, netcdf_file, netcdf_dataset):
+        """
+        Get the sorted river ids of a NetCDF file and their rows in the file
+        (built once per file and reused for the following lookups)
+        """
+        file_identity = get_file_identity(netcdf_file)
+        if file_identity not in self._river_index_cache:
+            rivid_var = 'COMID'
+            if 'rivid' in netcdf_dataset.variables:
+                rivid_var = 'rivid'
+            river_ids = np.array(netcdf_dataset.variables[rivid_var][:], dtype=np.int64)
+            river_sort_order = np.argsort(river_ids, kind='mergesort')
+            self._river_index_cache[file_identity] = (river_ids[river_sort_order],
+                                                      river_sort_order)
+        return self._river_index_cache[file_identity]
 
     def append_streamflow_from_return_period_file(self, return_period_file, 
                                                   return_period):
         """
         Generates return period raster from return period file
         """
-        print("Extracting Return Period Data ...")
-        return_period_nc = Dataset(return_period_file, mode="r")
-        if return_period == "return_period_20": 
-            return_period_data = return_period_nc.variables['return_period_20'][:]
-        elif return_period == "return_period_10": 
-            return_period_data = return_period_nc.variables['return_period_10'][:]
-        elif return_period == "return_period_2": 
-            return_period_data = return_period_nc.variables['return_period_2'][:]
-        elif return_period == "max_flow": 
-            return_period_data = return_period_nc.variables['return_period_2'][:]
-        else:
-            raise Exception("Invalid return period definition.")
-        rivid_var = 'COMID'
-        if 'rivid' in return_period_nc.variables:
-            rivid_var = 'rivid'
-        return_period_comids = return_period_nc.variables[rivid_var][:]
-        return_period_nc.close()
-        
         #get where streamids are in the lookup grid id table
-        stream_info_table = csv_to_list(self.stream_info_file, ", ")[1:]
-        streamid_list_full = np.array([row[3] for row in stream_info_table], dtype=np.int32)
-        streamid_list_unique = np.unique(streamid_list_full)
+        stream_info_table = self.read_stream_info_table()
+        stream_ids, peak_flows = \
+            self.get_streamflow_from_return_period_file(return_period_file,
+                                                        return_period,
+                                                        stream_info_table.unique_stream_ids)
         print("Analyzing data and appending to list ...")
-        
-        temp_stream_info_file = "{0}_temp.txt".format(os.path.splitext(self.stream_info_file)[0])
-        with open_csv(temp_stream_info_file, 'w') as outfile:
-            writer = csv.writer(outfile, delimiter=" ")
-            writer.writerow([u"DEM_1D_Index", u"Row", u"Col", u"StreamID", u"StreamDirection", u"Slope", u"Flow"])
-            for streamid in streamid_list_unique:
-                try:
-                    #get where streamids are in netcdf file
-                    streamid_index = np.where(return_period_comids==streamid)[0][0]
-                    peak_flow = return_period_data[streamid_index]
-                except IndexError:
-                    print( "ReachID", streamid, "not found in netCDF dataset. Setting value to zero ...")
-                    peak_flow = 0
-                    pass
-                    
-                #get where streamids are in the lookup grid id table
-                raster_index_list = np.where(streamid_list_full==streamid)[0]
-                for raster_index in raster_index_list:
-                    writer.writerow(stream_info_table[raster_index][:6] + [peak_flow])
-                    
-        os.remove(self.stream_info_file)
-        os.rename(temp_stream_info_file, self.stream_info_file)
+        self.write_stream_info_table(stream_info_table.join(stream_ids,
+                                                            peak_flows,
+                                                            "Flow"))
                     
+    def write_return_period_scenario_files(self, return_period_file,
+                                           return_period_list):
+        """
+        Writes a stream info scenario file with the streamflow of each return
+        period (e.g. stream_info_return_period_20.txt) from one read of the
+        stream info table and return period file
+        """
+        stream_info_table = self.read_stream_info_table()
+        stream_ids, peak_flow_list = \
+            self.get_streamflows_from_return_period_file(return_period_file,
+                                                         return_period_list,
+                                                         stream_info_table.unique_stream_ids)
+        scenario_stream_info_files = []
+        for return_period, peak_flows in zip(return_period_list, peak_flow_list):
+            scenario_stream_info_file = get_scenario_stream_info_file(self.stream_info_file,
+                                                                      return_period)
+            print("Writing {0} ...".format(scenario_stream_info_file))
+            stream_info_table.join(stream_ids, peak_flows, "Flow") \
+                .write(scenario_stream_info_file)
+            scenario_stream_info_files.append(scenario_stream_info_file)
+        return scenario_stream_info_files
+
     def append_streamflow_from_stream_shapefile(self, stream_id_field, streamflow_field):
         """
         Appends streamflow from values in shapefile 
         """
-        stream_shapefile = ogr.Open(self.stream_shapefile_path)
-        stream_shp_layer = stream_shapefile.GetLayer()
-
-        self.spatially_filter_streamfile_layer_by_elevation_dem(stream_shp_layer)
+        stream_id_array, streamflow_array = \
+            self.get_stream_attribute_from_shapefile(stream_id_field, streamflow_field)
 
         print("Writing output to file ...")
-        stream_info_table = csv_to_list(self.stream_info_file, ", ")[1:]
-        #Columns: DEM_1D_Index Row Col StreamID StreamDirection
-        stream_id_list = np.array([row[3] for row in stream_info_table], dtype=np.int32)
-        
-        temp_stream_info_file = "{0}_temp.txt".format(os.path.splitext(self.stream_info_file)[0])
-        with open_csv(temp_stream_info_file, 'w') as outfile:
-            writer = csv.writer(outfile, delimiter=" ")
-            writer.writerow([u"DEM_1D_Index", u"Row", u"Col", u"StreamID", u"StreamDirection", u"Slope", u"Flow"])
-            for feature in stream_shp_layer:
-                #find all raster indices associates with the comid
-                raster_index_list = np.where(stream_id_list==int(float(feature.GetField(stream_id_field))))[0]
-                #add streamflow associated with comid    
-                streamflow = feature.GetField(streamflow_field)
-                for raster_index in raster_index_list:
-                    writer.writerow(stream_info_table[raster_index][:6] + [streamflow])
-
-        os.remove(self.stream_info_file)
-        os.rename(temp_stream_info_file, self.stream_info_file)
+        stream_info_table = self.read_stream_info_table()
+        self.write_stream_info_table(stream_info_table.join(stream_id_array,
+                                                            streamflow_array,
+                                                            "Flow"))
+
+    def enrich_stream_info_file(self, enrichment_steps, chunk_size=500000):
+        """
+        Append slope and streamflow to the stream info file with a single
+        write of the table, chunk_size rows at a time. If streamflow is read
+        from RAPID output, the stream ids are collected in a first read of
+        the table so the streamflow is read once for all chunks.
+
+        enrichment_steps is a list of (step name, keyword arguments):
+            ("slope", dict(stream_id_field=..., slope_field=...))
+            ("streamflow_shapefile", dict(stream_id_field=..., streamflow_field=...))
+            ("return_period", dict(return_period_file=..., return_period=...))
+            ("rapid_output", dict(rapid_output_file=...,
+                                  date_peak_search_start=...,
+                                  date_peak_search_end=...,
+                                  peak_flow_cache_directory=...))
+            ("ecmwf", dict(prediction_folder=..., method_x=..., method_y=...))
+
+        Rows keep their original order. Rows with stream ids not in the
+        stream shapefile are dropped and missing streamflow from NetCDF
+        files is set to zero (same as the append functions).
+        """
+        #step name: (column name, fill value, function to get values by stream id)
+        valid_enrichment_steps = {
+            'slope': ("Slope", None, None),
+            'streamflow_shapefile': ("Flow", None, None),
+            'return_period': ("Flow", 0, self.get_streamflow_from_return_period_file),
+            'rapid_output': ("Flow", 0, self.get_peak_streamflow_from_rapid_output),
+            'ecmwf': ("Flow", 0, self.get_streamflow_from_ecmwf_rapid_output),
+        }
+
+        enrichment_step_list = []
+        for step_name, step_kwargs in enrichment_steps:
+            if step_name not in valid_enrichment_steps:
+                raise Exception("Invalid stream info enrichment step {0} ...".format(step_name))
+            column_name, fill_value, get_values_by_stream_id = valid_enrichment_steps[step_name]
+            if step_name == "slope":
+                reach_values = self.get_stream_attribute_from_shapefile(step_kwargs['stream_id_field'],
+                                                                        step_kwargs['slope_field'])
+            elif step_name == "streamflow_shapefile":
+                reach_values = self.get_stream_attribute_from_shapefile(step_kwargs['stream_id_field'],
+                                                                        step_kwargs['streamflow_field'])
+            else:
+                reach_values = (np.array([], dtype=np.int64), np.array([]))
+            enrichment_step_list.append({
+                                          'column_name': column_name,
+                                          'fill_value': fill_value,
+                                          'get_values': get_values_by_stream_id,
+                                          'kwargs': step_kwargs,
+                                          'reach_values': reach_values,
+                                        })
+
+        if [enrichment_step for enrichment_step in enrichment_step_list
+                if enrichment_step['get_values'] is not None]:
+            #read the values of all stream ids in the table at once
+            unique_stream_ids = StreamInfoTable.read_unique_stream_ids(self.stream_info_file,
+                                                                       chunk_size=chunk_size,
+                                                                       use_sidecar=self.use_binary_sidecar)
+            for enrichment_step in enrichment_step_list:
+                if enrichment_step['get_values'] is not None and len(unique_stream_ids) > 0:
+                    enrichment_step['reach_values'] = \
+                        enrichment_step['get_values'](stream_ids=unique_stream_ids,
+                                                      **enrichment_step['kwargs'])
+
+        print("Enriching stream info file ...")
+        with StreamInfoFileWriter(self.stream_info_file) as writer:
+            for stream_info_chunk in StreamInfoTable.iter_read(self.stream_info_file,
+                                                               chunk_size=chunk_size,
+                                                               use_sidecar=self.use_binary_sidecar):
+                for enrichment_step in enrichment_step_list:
+                    reach_stream_ids, reach_values = enrichment_step['reach_values']
+                    stream_info_chunk = stream_info_chunk.join(reach_stream_ids,
+                                                               reach_values,
+                                                               enrichment_step['column_name'],
+                                                               fill_value=enrichment_step['fill_value'],
+                                                               keep_order=True)
+                writer.write(stream_info_chunk)
+
+        #the binary sidecar is out of date with the enriched stream info file
+        try:
+            os.remove(StreamInfoTable.get_sidecar_file(self.stream_info_file))
+        except OSError:
+            pass
@@ -12,13 +12,38 @@ from datetime import datetime
 import multiprocessing
 import os
 
+import numpy as np
+
 #local imports
 from ..prepare import AutoRoutePrepare
+from .footprint import get_watershed_dem_files
+from .land_use_cache import LandUseWarpCache
+from .prepare import remove_raster
+from .raster_profiles import get_raster_creation_options
+from .reproject_raster import reproject_lu_raster
+from .shared_streamflow import SharedStreamflow, SHARED_MEMORY_ENABLED
+from .stream_info import StreamInfoTable
+from .stream_network_index import StreamNetworkIndex
+from .stream_network_partition import (get_tile_stream_network_file,
+                                       partition_stream_network as partition_stream_network_by_tile)
+from ..scheduling import (get_estimated_job_cost, get_job_size,
+                          MemoryAwareScheduler, sort_jobs_by_cost)
+from ..stage_cache import get_file_digest, get_input_digests, get_stage_digest, StageRecord
 from ..utilities import CaptureStdOutToLog, get_valid_num_cpus
 
 #----------------------------------------------------------------------------------
 #MULTIPROCESSING FUNCTIONS
 #----------------------------------------------------------------------------------
+def get_prepare_job_size(sub_folder, dem_extension='img'):
+    """
+    Get the size of the job to prepare the folder from the DEM and
+    the stream info file of a previous run (if any)
+    """
+    dem_files = glob(os.path.join(sub_folder, '*.{0}'.format(dem_extension)))
+    if not dem_files:
+        return 0, 0
+    return get_job_size(dem_files[0], os.path.join(sub_folder, 'stream_info.txt'))
+
 def get_valid_streamflow_prepare_mode(autoroute_input_directory,
                                       rapid_output_directory,
                                       return_period,
@@ -84,6 +109,135 @@ def get_valid_streamflow_prepare_mode(autoroute_input_directory,
         print("Running in mode {0}. Generating input from stream network shapefile ({1}) ...".format(PREPARE_MODE, stream_network_shapefile))
 
     return PREPARE_MODE
+
+def get_streamflow_stage_digest(PREPARE_MODE,
+                                previous_stage_digest,
+                                rapid_output_directory,
+                                return_period_file,
+                                return_period,
+                                rapid_output_file,
+                                date_peak_search_start,
+                                date_peak_search_end,
+                                river_id,
+                                streamflow_id,
+                                stream_network_shapefile,
+                                input_digests=None,
+                                ):
+    """
+    Gets the digest of the streamflow stage from the streamflow source
+    of the prepare mode
+    """
+    if PREPARE_MODE == 1:
+        return get_stage_digest("streamflow", previous_stage_digest,
+                                [rapid_output_directory],
+                                (PREPARE_MODE, "mean_plus_std", "max"),
+                                input_digests)
+    elif PREPARE_MODE == 2:
+        return get_stage_digest("streamflow", previous_stage_digest,
+                                [return_period_file],
+                                (PREPARE_MODE, return_period),
+                                input_digests)
+    elif PREPARE_MODE == 3:
+        return get_stage_digest("streamflow", previous_stage_digest,
+                                [rapid_output_file],
+                                (PREPARE_MODE, date_peak_search_start, date_peak_search_end),
+                                input_digests)
+    return get_stage_digest("streamflow", previous_stage_digest,
+                            [stream_network_shapefile],
+                            (PREPARE_MODE, river_id, streamflow_id),
+                            input_digests)
+
+def get_streamflow_stages(stream_info_file,
+                          PREPARE_MODE,
+                          rapid_output_directory,
+                          return_period_file,
+                          return_period,
+                          rapid_output_file,
+                          date_peak_search_start,
+                          date_peak_search_end,
+                          river_id,
+                          streamflow_id,
+                          stream_network_shapefile,
+                          ):
+    """
+    Gets the recorded stages of the stream info file with the
+    streamflow stage of the prepare mode last (from the tile stream
+    network of the sub folder if partitioned, like the prepare stages)
+    """
+    tile_stream_network_file = get_tile_stream_network_file(os.path.dirname(stream_info_file),
+                                                            stream_network_shapefile)
+    stream_info_stages = StageRecord([stream_info_file]).read()
+    if stream_info_stages and stream_info_stages[-1][0] == "streamflow":
+        stream_info_stages = stream_info_stages[:-1]
+    if not stream_info_stages:
+        #written without the stage cache
+        stream_info_stages = [("stream_info_file", get_file_digest(stream_info_file))]
+    return stream_info_stages + [("streamflow",
+                                  get_streamflow_stage_digest(PREPARE_MODE,
+                                                              stream_info_stages[-1][1],
+                                                              rapid_output_directory,
+                                                              return_period_file,
+                                                              return_period,
+                                                              rapid_output_file,
+                                                              date_peak_search_start,
+                                                              date_peak_search_end,
+                                                              river_id,
+                                                              streamflow_id,
+                                                              tile_stream_network_file))]
+
+def create_shared_streamflow(PREPARE_MODE,
+                             stream_info_files,
+                             rapid_output_directory,
+                             return_period_file,
+                             return_period,
+                             rapid_output_file,
+                             date_peak_search_start,
+                             date_peak_search_end,
+                             peak_flow_cache_directory="",
+                             ):
+    """
+    Reads the streamflow of all stream ids in the stream info files of a
+    watershed once into shared memory for the streamflow workers
+
+    Returns None if the mode does not read NetCDF files or shared memory
+    is not available.
+    """
+    if PREPARE_MODE not in (1, 2, 3) or not SHARED_MEMORY_ENABLED:
+        return None
+
+    print("Finding stream ids in watershed ...")
+    unique_stream_id_list = []
+    for stream_info_file in stream_info_files:
+        use_binary_sidecar = os.path.exists(StreamInfoTable.get_sidecar_file(stream_info_file))
+        for stream_info_chunk in StreamInfoTable.iter_read(stream_info_file,
+                                                           use_sidecar=use_binary_sidecar):
+            unique_stream_id_list.append(stream_info_chunk.unique_stream_ids)
+    if not unique_stream_id_list:
+        return None
+    stream_ids = np.unique(np.concatenate(unique_stream_id_list))
+
+    print("Reading streamflow for {0} stream ids in watershed ...".format(len(stream_ids)))
+    arp = AutoRoutePrepare("", "", "")
+    if PREPARE_MODE == 1:
+        stream_ids, streamflows = \
+            arp.get_streamflow_from_ecmwf_rapid_output(prediction_folder=rapid_output_directory,
+                                                       method_x="mean_plus_std", method_y="max",
+                                                       stream_ids=stream_ids,
+                                                       streaming=True)
+    elif PREPARE_MODE == 2:
+        stream_ids, streamflows = \
+            arp.get_streamflow_from_return_period_file(return_period_file=return_period_file,
+                                                       return_period=return_period,
+                                                       stream_ids=stream_ids)
+    else:
+        stream_ids, streamflows = \
+            arp.get_peak_streamflow_from_rapid_output(rapid_output_file=rapid_output_file,
+                                                      stream_ids=stream_ids,
+                                                      date_peak_search_start=date_peak_search_start,
+                                                      date_peak_search_end=date_peak_search_end,
+                                                      peak_flow_cache_directory=peak_flow_cache_directory)
+
+    return SharedStreamflow.create(stream_ids, np.ma.filled(streamflows, 0))
     
 def prepare_autoroute_streamflow_single_folder(PREPARE_MODE,
                                                autoroute_input_directory,
@@ -97,6 +251,8 @@ def prepare_autoroute_streamflow_single_folder(PREPARE_MODE,
                                                river_id,
                                                streamflow_id,
                                                stream_network_shapefile,
+                                               peak_flow_cache_directory="", #directory to share peak flows from RAPID output
+                                               shared_streamflow_info=None, #(name, number of reaches, streamflow type) of shared streamflow in watershed
                                                ):
     """
     This function prepares streamflow inputs in single directory for AutoRoute
@@ -104,28 +260,52 @@ def prepare_autoroute_streamflow_single_folder(PREPARE_MODE,
     os.chdir(autoroute_input_directory)
     
     #create input streamflow raster for AutoRoute
-    arp = AutoRoutePrepare("", "", stream_info_file, stream_network_shapefile)
-    if PREPARE_MODE == 1:
+    #NOTE: keep using the binary sidecar if the prepare step left one
+    use_binary_sidecar = os.path.exists(StreamInfoTable.get_sidecar_file(stream_info_file))
+    arp = AutoRoutePrepare("", "", stream_info_file, stream_network_shapefile,
+                           use_binary_sidecar=use_binary_sidecar)
+    if shared_streamflow_info is not None:
+        print("Appending streamflow from shared watershed streamflow ...")
+        stream_info_table = arp.read_stream_info_table()
+        with SharedStreamflow.attach(shared_streamflow_info) as shared_streamflow:
+            stream_ids, streamflows = \
+                shared_streamflow.get_streamflow(stream_info_table.unique_stream_ids)
+        arp.write_stream_info_table(stream_info_table.join(stream_ids,
+                                                           streamflows,
+                                                           "Flow"))
+    elif PREPARE_MODE == 1:
         arp.append_streamflow_from_ecmwf_rapid_output(prediction_folder=rapid_output_directory,
-                                                      method_x="mean_plus_std", method_y="max")
+                                                      method_x="mean_plus_std", method_y="max",
+                                                      streaming=True)
     elif PREPARE_MODE == 2:
         arp.append_streamflow_from_return_period_file(return_period_file=return_period_file,
                                                       return_period=return_period)
     elif PREPARE_MODE == 3:
         arp.append_streamflow_from_rapid_output(rapid_output_file=rapid_output_file,
                                                 date_peak_search_start=date_peak_search_start,
-                                                date_peak_search_end=date_peak_search_end)
+                                                date_peak_search_end=date_peak_search_end,
+                                                peak_flow_cache_directory=peak_flow_cache_directory)
     elif PREPARE_MODE == 4:
         arp.append_streamflow_from_stream_shapefile(river_id, streamflow_id)
 
+    arp.render_stream_info_file()
+
 def prepare_autoroute_streamflow_multiprocess_worker(args):
     """
     Prepare streamflow for AutoRoute simulation on one of multiple cores
+    (the stream info stages are recorded if given and skipped if current)
     """
-    job_name = args[12]
-    log_directory = args[13]
+    job_name = args[15]
+    log_directory = args[16]
     log_file_path = os.path.join(log_directory, "{0}-{1}.log".format(job_name, datetime.now().strftime("%Y-%m-%d_%H-%M-%S")))
     with CaptureStdOutToLog(log_file_path):
+        stream_info_stages = args[14]
+        if stream_info_stages:
+            stream_info_record = StageRecord([args[2]])
+            if stream_info_record.is_current(stream_info_stages):
+                print("Skipping current stages: streamflow")
+                return job_name
+            stream_info_record.invalidate()
         prepare_autoroute_streamflow_single_folder(args[0],
                                                    args[1],
                                                    args[2],
@@ -138,7 +318,27 @@ def prepare_autoroute_streamflow_multiprocess_worker(args):
                                                    args[9],
                                                    args[10],
                                                    args[11],
+                                                   args[12],
+                                                   args[13],
                                                    )
+        if stream_info_stages:
+            stream_info_record.write(stream_info_stages)
+    return job_name
+
+def prepare_return_period_scenarios_multiprocess_worker(args):
+    """
+    Write the stream info file of each return period on one of multiple cores
+    """
+    job_name = args[4]
+    log_directory = args[5]
+    log_file_path = os.path.join(log_directory, "{0}-{1}.log".format(job_name, datetime.now().strftime("%Y-%m-%d_%H-%M-%S")))
+    with CaptureStdOutToLog(log_file_path):
+        os.chdir(args[0])
+        #NOTE: keep using the binary sidecar if the prepare step left one
+        use_binary_sidecar = os.path.exists(StreamInfoTable.get_sidecar_file(args[1]))
+        arp = AutoRoutePrepare("", "", args[1], use_binary_sidecar=use_binary_sidecar)
+        arp.write_return_period_scenario_files(return_period_file=args[2],
+                                               return_period_list=args[3])
     return job_name
 
 def prepare_autoroute_single_folder(sub_folder,
@@ -157,13 +357,39 @@ def prepare_autoroute_single_folder(sub_folder,
                                     rapid_output_file="", #path to RAPID output file to be used
                                     date_peak_search_start=None, #datetime of start of search for peakflow
                                     date_peak_search_end=None, #datetime of end of search for peakflow
+                                    use_binary_sidecar=False, #keep stream info in binary file between stages
+                                    peak_flow_cache_directory="", #directory to share peak flows from RAPID output
+                                    prepare_engine="executable", #generate stream info file and Manning's n raster with AutoRoute executable or numpy
+                                    use_stage_cache=False, #skip stages with outputs written from the same inputs
+                                    stream_network_index_directory="", #directory of stream network index if not next to stream network
+                                    input_digests=None, #{input file: digest} of the shared inputs (see get_input_digests)
+                                    land_use_cache_directory="", #warp land use raster to the DEM grid through the land use cache
+                                    land_use_cache_bounds=None, #{grid definition: bounds} to warp once for all DEMs (see LandUseWarpCache.get_cache_bounds)
                                     ):
     """
     Worker process for multiprocessing that manages one folders preparation
+
+    If use_stage_cache is True, the digests of the rasterize, stream info,
+    slope, streamflow and Manning's n stages (from the content of their
+    inputs and their parameters) are recorded next to the stream info file
+    and Manning's n raster and the stages with current outputs are skipped.
+    The digests of the inputs shared by all folders are taken from
+    input_digests if given.
+
+    If land_use_cache_directory is set, the land use raster does not need to
+    be in the DEM projection. It is warped once to the DEM grid over the
+    land_use_cache_bounds in the cache and the window under the DEM is used
+    to generate the Manning's n raster (see LandUseWarpCache).
     """
+    valid_prepare_engines = ("executable", "numpy")
+    if prepare_engine not in valid_prepare_engines:
+        raise Exception("ERROR: Invalid prepare engine {0}. Valid engines are: " \
+                        "{1} ...".format(prepare_engine, ", ".join(valid_prepare_engines)))
+
     if not sub_folder or not os.path.exists(sub_folder):
         print("sub_folder path invalid. Skipping folder: {0}".format(sub_folder))
-    elif not autoroute_executable_location or not os.path.exists(autoroute_executable_location):
+    elif prepare_engine == "executable" and \
+        (not autoroute_executable_location or not os.path.exists(autoroute_executable_location)):
         print("autoroute_executable_location path invalid. Skipping folder: {0}".format(sub_folder))
     elif not stream_network_shapefile or not os.path.exists(stream_network_shapefile):
         print("stream_network_shapefile path invalid. Skipping folder: {0}".format(sub_folder))
@@ -173,6 +399,9 @@ def prepare_autoroute_single_folder(sub_folder,
         os.chdir(sub_folder)
         
         out_rasterized_streamfile = os.path.join(sub_folder, 'rasterized_streamfile.tif')
+        if prepare_engine == "numpy":
+            #only read in this process
+            out_rasterized_streamfile = '/vsimem/rasterized_streamfile.tif'
         stream_info_file = os.path.join(sub_folder,'stream_info.txt')
         
         #rename elevation file for running autoroute
@@ -183,21 +412,6 @@ def prepare_autoroute_single_folder(sub_folder,
             renamed_file = os.path.join(sub_folder, 'elevation.{0}'.format(".".join(assocated_dem_file.split(".")[1:])))
             os.rename(assocated_dem_file, renamed_file)
         
-        #----------------------------------------------------------------------
-        # Prepare stream info file
-        #----------------------------------------------------------------------
-        arp = AutoRoutePrepare(autoroute_executable_location,
-                               elevation_dem_file,
-                               stream_info_file,
-                               stream_network_shapefile)
-                               
-        arp.rasterize_stream_shapefile(out_rasterized_streamfile, river_id)
-           
-        arp.generate_stream_info_file_with_direction(out_rasterized_streamfile,
-                                                     search_radius=1)
-       
-        arp.append_slope_to_stream_info_file(river_id, slope_id)
-
         #----------------------------------------------------------------------
         # Method to generate streamflow for AutoRoute simulation (Optional)
         #----------------------------------------------------------------------
@@ -215,21 +429,103 @@ def prepare_autoroute_single_folder(sub_folder,
             print(ex)
             PREPARE_MODE = 0
             pass
+
+        #----------------------------------------------------------------------
+        # Check stages with current outputs (Optional)
+        #----------------------------------------------------------------------
+        tile_stream_network_file = get_tile_stream_network_file(sub_folder,
+                                                                stream_network_shapefile)
+        stream_info_stages = []
+        num_current_stages = 0
+        if use_stage_cache:
+            autoroute_executable_file = ""
+            if prepare_engine == "executable":
+                autoroute_executable_file = autoroute_executable_location
+            stream_info_stages.append(("rasterize",
+                                       get_stage_digest("rasterize", "",
+                                                        [elevation_dem_file, tile_stream_network_file],
+                                                        (river_id,),
+                                                        input_digests)))
+            stream_info_stages.append(("stream_info",
+                                       get_stage_digest("stream_info", stream_info_stages[-1][1],
+                                                        [autoroute_executable_file],
+                                                        (prepare_engine, 1),
+                                                        input_digests)))
+            stream_info_stages.append(("slope",
+                                       get_stage_digest("slope", stream_info_stages[-1][1],
+                                                        [tile_stream_network_file],
+                                                        (river_id, slope_id),
+                                                        input_digests)))
+            if PREPARE_MODE > 0:
+                stream_info_stages.append(("streamflow",
+                                           get_streamflow_stage_digest(PREPARE_MODE,
+                                                                       stream_info_stages[-1][1],
+                                                                       rapid_output_directory,
+                                                                       return_period_file,
+                                                                       return_period,
+                                                                       rapid_output_file,
+                                                                       date_peak_search_start,
+                                                                       date_peak_search_end,
+                                                                       river_id,
+                                                                       streamflow_id,
+                                                                       tile_stream_network_file,
+                                                                       input_digests)))
+            stream_info_record = StageRecord([stream_info_file])
+            num_current_stages = stream_info_record.get_num_current_stages(stream_info_stages)
+            if num_current_stages > 0:
+                print("Skipping current stages: {0}".format(", ".join([stage_name for stage_name, digest
+                                                                       in stream_info_stages[:num_current_stages]])))
+            if num_current_stages < len(stream_info_stages):
+                stream_info_record.invalidate()
+
+        #----------------------------------------------------------------------
+        # Prepare stream info file
+        #----------------------------------------------------------------------
+        arp = AutoRoutePrepare(autoroute_executable_location,
+                               elevation_dem_file,
+                               stream_info_file,
+                               tile_stream_network_file,
+                               use_binary_sidecar=use_binary_sidecar,
+                               stream_network_index_directory=stream_network_index_directory)
+                               
+        #NOTE: the rasterized stream file is only kept while the stream info file is generated
+        if num_current_stages < 2:
+            arp.rasterize_stream_shapefile(out_rasterized_streamfile, river_id,
+                                           creation_options=get_raster_creation_options('scratch'))
+               
+            if prepare_engine == "numpy":
+                arp.generate_stream_info_file_from_raster(out_rasterized_streamfile,
+                                                          search_radius=1)
+            else:
+                arp.generate_stream_info_file_with_direction(out_rasterized_streamfile,
+                                                             search_radius=1)
         
-        if PREPARE_MODE > 0:
-            prepare_autoroute_streamflow_single_folder(PREPARE_MODE,
-                                                       sub_folder,
-                                                       stream_info_file,
-                                                       rapid_output_directory,
-                                                       return_period_file,
-                                                       return_period,
-                                                       rapid_output_file,
-                                                       date_peak_search_start,
-                                                       date_peak_search_end,
-                                                       river_id,
-                                                       streamflow_id,
-                                                       stream_network_shapefile,
-                                                       )
+        #add slope and streamflow in one pass through the stream info file
+        enrichment_steps = []
+        if num_current_stages < 3:
+            enrichment_steps.append(("slope", dict(stream_id_field=river_id,
+                                                   slope_field=slope_id)))
+        if PREPARE_MODE == 1:
+            enrichment_steps.append(("ecmwf", dict(prediction_folder=rapid_output_directory,
+                                                   method_x="mean_plus_std",
+                                                   method_y="max",
+                                                   streaming=True)))
+        elif PREPARE_MODE == 2:
+            enrichment_steps.append(("return_period", dict(return_period_file=return_period_file,
+                                                           return_period=return_period)))
+        elif PREPARE_MODE == 3:
+            enrichment_steps.append(("rapid_output", dict(rapid_output_file=rapid_output_file,
+                                                          date_peak_search_start=date_peak_search_start,
+                                                          date_peak_search_end=date_peak_search_end,
+                                                          peak_flow_cache_directory=peak_flow_cache_directory)))
+        elif PREPARE_MODE == 4:
+            enrichment_steps.append(("streamflow_shapefile", dict(stream_id_field=river_id,
+                                                                  streamflow_field=streamflow_id)))
+        if PREPARE_MODE > 0 and num_current_stages >= 4:
+            #streamflow current
+            enrichment_steps = enrichment_steps[:-1]
+        if enrichment_steps:
+            arp.enrich_stream_info_file(enrichment_steps)
        
         #----------------------------------------------------------------------
         # Method to generate manning_n file from DEM, Land Use Raster, 
@@ -239,23 +535,69 @@ def prepare_autoroute_single_folder(sub_folder,
         #----------------------------------------------------------------------
         if land_use_raster and os.path.exists(land_use_raster) \
         and manning_n_table and os.path.exists(manning_n_table):
-            arp.generate_manning_n_raster(land_use_raster,
-                                          manning_n_table,
-                                          os.path.join(sub_folder, 'manning_n.tif'),
-                                          default_manning_n
-                                          )
+            manning_n_raster = os.path.join(sub_folder, 'manning_n.tif')
+            manning_n_stages = []
+            if use_stage_cache:
+                autoroute_executable_file = ""
+                if prepare_engine == "executable":
+                    autoroute_executable_file = autoroute_executable_location
+                manning_n_stages.append(("manning_n",
+                                         get_stage_digest("manning_n", "",
+                                                          [elevation_dem_file,
+                                                           land_use_raster,
+                                                           manning_n_table,
+                                                           autoroute_executable_file],
+                                                          (prepare_engine, default_manning_n,
+                                                           bool(land_use_cache_directory)),
+                                                          input_digests)))
+                manning_n_record = StageRecord([manning_n_raster])
 
-        try:
-            os.remove(out_rasterized_streamfile)
-        except OSError:
-            pass
+            if manning_n_stages and manning_n_record.is_current(manning_n_stages):
+                print("Skipping current stages: manning_n")
+            else:
+                if manning_n_stages:
+                    manning_n_record.invalidate()
+                dem_land_use_raster = land_use_raster
+                if land_use_cache_directory:
+                    dem_land_use_raster = os.path.join(sub_folder, 'land_use_dem_grid.tif')
+                    if prepare_engine == "numpy":
+                        #only read in this process
+                        dem_land_use_raster = '/vsimem/land_use_dem_grid.tif'
+                    reproject_lu_raster(elevation_dem_file,
+                                        land_use_raster,
+                                        dem_land_use_raster,
+                                        land_use_cache_directory=land_use_cache_directory,
+                                        land_use_cache_bounds=land_use_cache_bounds)
+                if prepare_engine == "numpy":
+                    arp.generate_manning_n_raster_from_land_use(dem_land_use_raster,
+                                                                manning_n_table,
+                                                                manning_n_raster,
+                                                                default_manning_n
+                                                                )
+                else:
+                    arp.generate_manning_n_raster(dem_land_use_raster,
+                                                  manning_n_table,
+                                                  manning_n_raster,
+                                                  default_manning_n
+                                                  )
+                if land_use_cache_directory:
+                    remove_raster(dem_land_use_raster)
+                if manning_n_stages:
+                    manning_n_record.write(manning_n_stages)
+
+        #write the stream info file for AutoRoute
+        arp.render_stream_info_file()
+        if stream_info_stages and num_current_stages < len(stream_info_stages):
+            stream_info_record.write(stream_info_stages)
+
+        remove_raster(out_rasterized_streamfile)
 
 def prepare_autoroute_multiprocess_worker(args):
     """
     Run autoroute on one of multiple cores
     """
-    job_name = args[16]
-    log_directory = args[17]
+    job_name = args[24]
+    log_directory = args[25]
     log_file_path = os.path.join(log_directory,
                                  "{0}-{1}.log".format(job_name,
                                                       datetime.now().strftime("%Y-%m-%d_%H-%M-%S")))
@@ -275,7 +617,15 @@ def prepare_autoroute_multiprocess_worker(args):
                                         args[12],
                                         args[13],
                                         args[14],
-                                        args[15]
+                                        args[15],
+                                        args[16],
+                                        args[17],
+                                        args[18],
+                                        args[19],
+                                        args[20],
+                                        args[21],
+                                        args[22],
+                                        args[23],
                                         )
     return job_name
 
@@ -299,11 +649,37 @@ def prepare_autoroute_multiprocess(watershed_folder,
                                    rapid_output_file="", #path to RAPID output file to be used
                                    date_peak_search_start=None, #datetime of start of search for peakflow
                                    date_peak_search_end=None, #datetime of end of search for peakflow
-                                   num_cpus=-17
+                                   num_cpus=-17,
+                                   use_binary_sidecar=False, #keep stream info in binary file between stages
+                                   peak_flow_cache_directory="", #directory to share peak flows from RAPID output
+                                   prepare_engine="executable", #generate stream info file and Manning's n raster with AutoRoute executable or numpy
+                                   index_stream_network=False, #build stream network spatial index once for all workers
+                                   stream_network_index_directory="", #directory for stream network index (next to stream network if empty)
+                                   partition_stream_network=False, #write stream network of each tile once for all workers
+                                   memory_budget=None, #bytes for folders to prepare at once (memory-aware scheduling if set)
+                                   use_stage_cache=False, #skip stages with outputs written from the same inputs
+                                   land_use_cache_directory="", #warp land use raster once to the DEM grids in this directory
                                    ):
     """
     Function to prepare AutoRoute input using multiprocessing with the same folder 
     structure as running multiprocessing
+
+    If memory_budget is set, folders are only prepared while their estimated
+    memory fits in the budget (see MemoryAwareScheduler).
+
+    If use_stage_cache is True, stages of each folder with outputs written
+    from the same inputs are skipped (see prepare_autoroute_single_folder).
+    The shared inputs (stream network, streamflow source, land use,
+    Manning's n table) are hashed once here for all workers.
+
+    If index_stream_network is True, a spatial index of the stream network
+    is written once (to stream_network_index_directory if the stream network
+    is in a read-only directory) for the workers to read only the features
+    over their DEM.
+
+    If land_use_cache_directory is set, the land use raster is warped once
+    over the union of the DEMs with the same grid to the cache directory
+    and each worker reads the window under its DEM (see LandUseWarpCache).
     """
     #initialize multiprocess log directory
     prepare_log_directory = os.path.join(log_directory, "prepare")
@@ -315,6 +691,35 @@ def prepare_autoroute_multiprocess(watershed_folder,
     print("Preparing input for AutoRoute ...")
     print("Logs can be found here: {0}".format(prepare_log_directory))
 
+    if partition_stream_network:
+        partition_stream_network_by_tile(watershed_folder,
+                                         stream_network_shapefile,
+                                         dem_extension)
+    elif index_stream_network:
+        #workers use the spatial filter if the index cannot be written
+        StreamNetworkIndex(stream_network_shapefile,
+                           stream_network_index_directory).build()
+
+    input_digests = None
+    if use_stage_cache:
+        autoroute_executable_file = ""
+        if prepare_engine == "executable":
+            autoroute_executable_file = autoroute_executable_location
+        input_digests = get_input_digests([stream_network_shapefile,
+                                           land_use_raster,
+                                           manning_n_table,
+                                           autoroute_executable_file,
+                                           rapid_output_directory,
+                                           return_period_file,
+                                           rapid_output_file])
+
+    land_use_cache_bounds = None
+    if land_use_cache_directory and land_use_raster:
+        land_use_cache_bounds = \
+            LandUseWarpCache.get_cache_bounds([dem_file for sub_folder, dem_file in
+                                               get_watershed_dem_files(watershed_folder,
+                                                                       dem_extension)])
+
     watershed_name = os.path.basename(watershed_folder)
     multiprocessing_input = [(os.path.join(watershed_folder, sub_folder),
                               autoroute_executable_location,
@@ -332,16 +737,38 @@ def prepare_autoroute_multiprocess(watershed_folder,
                               rapid_output_file,
                               date_peak_search_start,
                               date_peak_search_end,
+                              use_binary_sidecar,
+                              peak_flow_cache_directory,
+                              prepare_engine,
+                              use_stage_cache,
+                              stream_network_index_directory,
+                              input_digests,
+                              land_use_cache_directory,
+                              land_use_cache_bounds,
                               "{0}-{1}".format(watershed_name, sub_folder),
                               prepare_log_directory
                              ) 
                              for sub_folder in os.listdir(watershed_folder) \
                              if os.path.isdir(os.path.join(watershed_folder, sub_folder))]
-    pool = multiprocessing.Pool(get_valid_num_cpus(num_cpus))
+    #largest DEMs (and stream networks of previous runs) first
+    job_size_list = [get_prepare_job_size(job_input[0], dem_extension)
+                     for job_input in multiprocessing_input]
+    job_cost_list = [get_estimated_job_cost(job_size) for job_size in job_size_list]
+    multiprocessing_input = sort_jobs_by_cost(multiprocessing_input, job_cost_list)
 
-    mp_worker_list = pool.imap_unordered(prepare_autoroute_multiprocess_worker,
-                                         multiprocessing_input,
-                                         chunksize=1)
+    if memory_budget:
+        num_cpus = get_valid_num_cpus(num_cpus, memory_per_cpu=None)
+        #one job per worker to measure the peak memory of each job
+        pool = multiprocessing.Pool(num_cpus, maxtasksperchild=1)
+        mp_worker_list = MemoryAwareScheduler(pool, num_cpus, memory_budget) \
+            .imap(prepare_autoroute_multiprocess_worker,
+                  multiprocessing_input,
+                  sort_jobs_by_cost(job_size_list, job_cost_list))
+    else:
+        pool = multiprocessing.Pool(get_valid_num_cpus(num_cpus))
+        mp_worker_list = pool.imap_unordered(prepare_autoroute_multiprocess_worker,
+                                             multiprocessing_input,
+                                             chunksize=1)
                                          
     for multi_job_output in mp_worker_list:
         print("JOB FINISHED: {0}".format(multi_job_output))
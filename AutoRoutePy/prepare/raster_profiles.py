@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+##
+##  raster_profiles.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License BSD 3-Clause
+
+from osgeo import gdal
+
+#GeoTIFF creation options of each raster written by the package
+#(tiles, block size, BigTIFF and threads are added by get_raster_creation_options)
+RASTER_CREATION_PROFILES = {
+    #scratch rasters only read once (e.g. rasterized stream network)
+    'scratch': ["COMPRESS=DEFLATE", "ZLEVEL=1"],
+    #integer rasters (e.g. reprojected land use)
+    'integer': ["COMPRESS=DEFLATE", "PREDICTOR=2"],
+    #floating point rasters read by AutoRoute (e.g. Manning's n)
+    'float': ["COMPRESS=DEFLATE", "PREDICTOR=3"],
+    #rasters for readers that do not support compression
+    'uncompressed': [],
+}
+
+#------------------------------------------------------------------------------
+#Helper Functions
+#------------------------------------------------------------------------------
+def get_raster_creation_options(profile, block_size=256, num_threads=1):
+    ''' GeoTIFF creation options of the raster creation profile.
+
+        @type profile:      C{str}
+        @param profile:     Name of the profile in RASTER_CREATION_PROFILES
+        @type block_size:   C{int}
+        @param block_size:  Width and height of the tiles (multiple of 16)
+        @type num_threads:  C{int/str}
+        @param num_threads: Threads used to compress (e.g. 4 or ALL_CPUS)
+        @rtype:             C{list}
+        @return:            Creation options for the GTiff driver
+        '''
+    if profile not in RASTER_CREATION_PROFILES:
+        raise Exception("ERROR: Invalid raster creation profile {0}. Valid profiles are: "
+                        "{1}".format(profile, ", ".join(sorted(RASTER_CREATION_PROFILES))))
+    if int(block_size) <= 0 or int(block_size) % 16 != 0:
+        raise Exception("ERROR: Raster block size must be a positive multiple of 16 ...")
+
+    creation_options = ["TILED=YES",
+                        "BLOCKXSIZE={0}".format(int(block_size)),
+                        "BLOCKYSIZE={0}".format(int(block_size)),
+                        "BIGTIFF=IF_SAFER"]
+    creation_options += RASTER_CREATION_PROFILES[profile]
+    if profile != 'uncompressed' and str(num_threads) != '1':
+        creation_options.append("NUM_THREADS={0}".format(num_threads))
+    return creation_options
+
+def get_raster_profile_from_data_type(data_type):
+    ''' Raster creation profile matching the predictor to the GDAL data type.
+
+        @type data_type:  C{int}
+        @param data_type: GDAL data type (e.g. gdal.GDT_Float32)
+        @rtype:           C{str}
+        @return:          float or integer
+        '''
+    if gdal.GetDataTypeName(data_type).startswith('Float'):
+        return 'float'
+    return 'integer'
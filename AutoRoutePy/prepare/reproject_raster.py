@@ -7,27 +7,118 @@
 ##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
 ##  License BSD 3-Clause
 
+import os
+
 from osgeo import gdal
 
-def reproject_lu_raster(dem_raster, land_use_raster, reprojected_land_use_raster):
-    """
-    This reprojects the land use raster to the same projection as the dem_raster
-    """
-    # Open source dataset
-    src_ds = gdal.Open(land_use_raster)
+#local imports
+from ..utilities import get_available_memory
+from .prepare import GetExtent
+from .raster_profiles import (get_raster_creation_options,
+                              get_raster_profile_from_data_type)
+
+def get_dem_grid(dem_raster):
+    '''
+    Get the (projection, bounds, number of columns, number of rows) of the DEM
+    with bounds as (min x, min y, max x, max y)
+    '''
     template_ds = gdal.Open(dem_raster)
+    num_cols = template_ds.RasterXSize
+    num_rows = template_ds.RasterYSize
+    dem_extent = GetExtent(template_ds.GetGeoTransform(), num_cols, num_rows)
+    dem_x = [coordinate[0] for coordinate in dem_extent]
+    dem_y = [coordinate[1] for coordinate in dem_extent]
+    dem_grid = (template_ds.GetProjection(),
+                (min(dem_x), min(dem_y), max(dem_x), max(dem_y)),
+                num_cols, num_rows)
+    template_ds = None
+    return dem_grid
 
-    error_threshold = 0.125  # error threshold --> use same value as in gdalwarp
-    resampling = gdal.GRA_NearestNeighbour
+def get_output_format(output_raster):
+    '''
+    Get the GDAL format of the output raster (VRT if it ends with .vrt)
+    '''
+    if os.path.splitext(output_raster)[1].lower() == '.vrt':
+        return 'VRT'
+    return 'GTiff'
+
+def warp_land_use_raster(land_use_raster, output_raster, projection, bounds,
+                         creation_options=None, num_threads=1, max_memory_fraction=0.1,
+                         **grid_kwargs):
+    """
+    Warp the land use raster to the projection and bounds with the
+    nearest neighbor (grid_kwargs are width/height or xRes/yRes of gdal.Warp)
+
+    The output is a VRT if output_raster ends with .vrt, otherwise a GeoTIFF
+    tiled and compressed with the raster creation profile of the land use
+    data type unless creation_options are given. The warp uses up to
+    num_threads threads and max_memory_fraction of the available memory.
+    """
+    output_format = get_output_format(output_raster)
+    if output_format == 'VRT':
+        creation_options = []
+    elif creation_options is None:
+        src_ds = gdal.Open(land_use_raster)
+        land_use_data_type = src_ds.GetRasterBand(1).DataType
+        src_ds = None
+        creation_options = get_raster_creation_options(get_raster_profile_from_data_type(land_use_data_type),
+                                                       num_threads=num_threads)
 
-    # Call AutoCreateWarpedVRT() to fetch default values for target raster dimensions and geotransform
-    tmp_ds = gdal.AutoCreateWarpedVRT( src_ds,
-                                       None, # src_wkt : left to default value --> will use the one from source
-                                       template_ds.GetProjection(),
-                                       resampling,
-                                       error_threshold )
+    warp_options = []
+    if num_threads > 1:
+        warp_options.append("NUM_THREADS={0}".format(num_threads))
 
-    # Create the final warped raster
-    dst_ds = gdal.GetDriverByName('GTiff').CreateCopy(reprojected_land_use_raster, tmp_ds)
+    dst_ds = gdal.Warp(output_raster, land_use_raster,
+                       format=output_format,
+                       dstSRS=projection,
+                       outputBounds=bounds,
+                       resampleAlg=gdal.GRA_NearestNeighbour,
+                       errorThreshold=0.125, # use same value as in gdalwarp
+                       multithread=num_threads > 1,
+                       warpOptions=warp_options,
+                       warpMemoryLimit=int(get_available_memory() * max_memory_fraction),
+                       creationOptions=creation_options,
+                       **grid_kwargs)
+    if dst_ds is None:
+        raise Exception("ERROR: Unable to reproject land use raster {0} ...".format(land_use_raster))
     dst_ds = None
-    src_ds = None
+
+def reproject_lu_raster(dem_raster, land_use_raster, reprojected_land_use_raster,
+                        creation_options=None, num_threads=1, max_memory_fraction=0.1,
+                        land_use_cache_directory="", land_use_cache_bounds=None):
+    """
+    This reprojects the land use raster to the projection and grid of the
+    dem_raster (only the part of the land use raster under the DEM is warped)
+
+    The output is a VRT if reprojected_land_use_raster ends with .vrt,
+    otherwise a GeoTIFF tiled and compressed with the raster creation profile
+    of the land use data type unless creation_options are given.
+    The warp uses up to num_threads threads and max_memory_fraction
+    of the available memory.
+
+    If land_use_cache_directory is set, the land use raster is warped once
+    over the land_use_cache_bounds of the DEMs sharing the grid (see
+    LandUseWarpCache.get_cache_bounds) and the window under the DEM is read
+    from the cache.
+    """
+    if land_use_cache_directory:
+        #imported here to avoid a circular import
+        from .land_use_cache import LandUseWarpCache
+        LandUseWarpCache(land_use_cache_directory,
+                         num_threads=num_threads,
+                         max_memory_fraction=max_memory_fraction) \
+            .reproject_lu_raster(dem_raster, land_use_raster, reprojected_land_use_raster,
+                                 creation_options=creation_options,
+                                 cache_bounds=land_use_cache_bounds)
+        return
+
+    dem_projection, dem_bounds, dem_num_cols, dem_num_rows = get_dem_grid(dem_raster)
+
+    #bounds and size of the DEM snap the output to the DEM grid
+    warp_land_use_raster(land_use_raster, reprojected_land_use_raster,
+                         dem_projection, dem_bounds,
+                         creation_options=creation_options,
+                         num_threads=num_threads,
+                         max_memory_fraction=max_memory_fraction,
+                         width=dem_num_cols,
+                         height=dem_num_rows)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+##
+##  shared_streamflow.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License BSD 3-Clause
+
+import numpy as np
+
+SHARED_MEMORY_ENABLED = False
+try:
+    from multiprocessing import shared_memory
+    SHARED_MEMORY_ENABLED = True
+except ImportError:
+    print("multiprocessing.shared_memory unable to be imported. If you would like "
+          "to share streamflow between processes, please use Python 3.8 or newer.")
+    pass
+
+#------------------------------------------------------------------------------
+#Shared Streamflow Class
+#------------------------------------------------------------------------------
+class SharedStreamflow(object):
+    """
+    This class keeps the streamflow of every reach in a watershed in one
+    shared memory block so each streamflow worker looks up its reaches
+    instead of reading the NetCDF files again.
+    Layout: sorted stream ids (int64) followed by streamflow (in the
+    floating point type of the source, e.g. float32 from RAPID output,
+    so the stream info files get the same digits as reading the source)
+    """
+    def __init__(self, shared_memory_block, num_reaches, streamflow_dtype=np.float64):
+        """
+        Initialize the class with an open shared memory block
+        """
+        self.shared_memory_block = shared_memory_block
+        self.num_reaches = num_reaches
+        self.streamflow_dtype = np.dtype(streamflow_dtype)
+        self.stream_ids = np.ndarray((num_reaches,), dtype=np.int64,
+                                     buffer=shared_memory_block.buf)
+        self.streamflows = np.ndarray((num_reaches,), dtype=self.streamflow_dtype,
+                                      buffer=shared_memory_block.buf,
+                                      offset=num_reaches*np.dtype(np.int64).itemsize)
+
+    @classmethod
+    def create(cls, stream_ids, streamflows):
+        """
+        Create the shared memory block from the streamflow of each stream id
+        """
+        if not SHARED_MEMORY_ENABLED:
+            raise Exception("ERROR: Shared memory requires Python 3.8 or newer ...")
+
+        stream_ids = np.array(stream_ids, dtype=np.int64)
+        streamflows = np.asarray(streamflows)
+        streamflow_dtype = streamflows.dtype
+        if streamflow_dtype.kind != 'f':
+            streamflow_dtype = np.dtype(np.float64)
+        sort_order = np.argsort(stream_ids, kind='mergesort')
+        num_reaches = len(stream_ids)
+        block_size = num_reaches*(np.dtype(np.int64).itemsize + streamflow_dtype.itemsize)
+        shared_memory_block = shared_memory.SharedMemory(create=True,
+                                                         size=max(block_size, 1))
+        shared_streamflow = cls(shared_memory_block, num_reaches, streamflow_dtype)
+        shared_streamflow.stream_ids[:] = stream_ids[sort_order]
+        shared_streamflow.streamflows[:] = streamflows.astype(streamflow_dtype)[sort_order]
+        return shared_streamflow
+
+    @classmethod
+    def attach(cls, shared_streamflow_info):
+        """
+        Attach to the shared memory block created by another process
+        """
+        name, num_reaches, streamflow_dtype = shared_streamflow_info
+        return cls(shared_memory.SharedMemory(name=name), num_reaches, streamflow_dtype)
+
+    @property
+    def info(self):
+        """
+        Name, number of reaches and streamflow type to attach
+        to the shared memory block
+        """
+        return self.shared_memory_block.name, self.num_reaches, self.streamflow_dtype.str
+
+    def get_streamflow(self, stream_ids):
+        """
+        Get the streamflow of each stream id (zero if missing)
+        """
+        stream_ids = np.array(stream_ids, dtype=np.int64)
+        streamflows = np.zeros(len(stream_ids), dtype=self.streamflow_dtype)
+        if self.num_reaches > 0:
+            shared_index = np.searchsorted(self.stream_ids, stream_ids)
+            shared_index[shared_index >= self.num_reaches] = 0
+            found_stream_ids = self.stream_ids[shared_index] == stream_ids
+            streamflows[found_stream_ids] = self.streamflows[shared_index[found_stream_ids]]
+        return stream_ids, streamflows
+
+    def close(self):
+        """
+        Close access to the shared memory block from this process
+        """
+        #views on the buffer need to be released before closing
+        self.stream_ids = None
+        self.streamflows = None
+        self.shared_memory_block.close()
+
+    def unlink(self):
+        """
+        Free the shared memory block (called once by the creating process)
+        """
+        self.shared_memory_block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+##
+##  stream_direction.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License BSD 3-Clause
+
+import numpy as np
+
+#local imports
+from .stream_info import StreamInfoTable
+
+#stream directions in radians (clockwise from north, 0 to pi in steps of pi/8)
+#with the six significant digits written by the AutoRoute prepare executable
+STREAM_DIRECTIONS = np.array([float("{0:g}".format(direction_index*np.pi/8))
+                              for direction_index in range(8)])
+
+#------------------------------------------------------------------------------
+#Stream Direction Functions
+#------------------------------------------------------------------------------
+def get_stream_cell_directions(stream_id_array, stream_rows, stream_cols,
+                               search_radius=1):
+    ''' Direction of the stream at each stream cell from the orientation of
+        the cells of the same stream within search_radius cells.
+
+        @type stream_id_array:  C{numpy.ndarray}
+        @param stream_id_array: Stream id of each raster cell (<= 0 not stream)
+        @type stream_rows:      C{numpy.ndarray}
+        @param stream_rows:     Row of each stream cell in stream_id_array
+        @type stream_cols:      C{numpy.ndarray}
+        @param stream_cols:     Column of each stream cell in stream_id_array
+        @type search_radius:    C{int}
+        @param search_radius:   Number of cells to search around each cell
+        @rtype:                 C{numpy.ndarray}
+        @return:                Stream direction of each stream cell
+        '''
+    search_radius = int(search_radius)
+    padded_stream_id_array = np.pad(stream_id_array, search_radius,
+                                    mode='constant', constant_values=0)
+    stream_ids = stream_id_array[stream_rows, stream_cols]
+
+    #moments of the north/east offsets of the cells of the same stream
+    num_cells = np.zeros(len(stream_rows))
+    sum_north = np.zeros(len(stream_rows))
+    sum_east = np.zeros(len(stream_rows))
+    sum_north_north = np.zeros(len(stream_rows))
+    sum_east_east = np.zeros(len(stream_rows))
+    sum_north_east = np.zeros(len(stream_rows))
+    for row_offset in range(-search_radius, search_radius+1):
+        for col_offset in range(-search_radius, search_radius+1):
+            same_stream = padded_stream_id_array[stream_rows + search_radius + row_offset,
+                                                 stream_cols + search_radius + col_offset] == stream_ids
+            north = -row_offset
+            east = col_offset
+            num_cells += same_stream
+            sum_north += same_stream * north
+            sum_east += same_stream * east
+            sum_north_north += same_stream * north * north
+            sum_east_east += same_stream * east * east
+            sum_north_east += same_stream * north * east
+
+    covariance_north_north = sum_north_north - sum_north * sum_north / num_cells
+    covariance_east_east = sum_east_east - sum_east * sum_east / num_cells
+    covariance_north_east = sum_north_east - sum_north * sum_east / num_cells
+    #orientation of the major axis clockwise from north
+    orientation = 0.5 * np.arctan2(2 * covariance_north_east,
+                                   covariance_north_north - covariance_east_east)
+    direction_index = np.round(orientation / (np.pi / 8)).astype(np.int64) % 8
+    return STREAM_DIRECTIONS[direction_index]
+
+def get_stream_info_block(stream_id_block, search_radius=1, block_first_row=0,
+                          first_row=0, last_row=None):
+    ''' Stream info table (DEM_1D_Index Row Col StreamID StreamDirection)
+        of the stream cells in rows first_row to last_row of a block of the
+        stream raster. Rows outside of these are only searched for neighbors.
+
+        @type stream_id_block:  C{numpy.ndarray}
+        @param stream_id_block: Stream id of each cell in the block (<= 0 not stream)
+        @type search_radius:    C{int}
+        @param search_radius:   Number of cells to search around each cell
+        @type block_first_row:  C{int}
+        @param block_first_row: Row in the raster of the first row of the block
+        @type first_row:        C{int}
+        @param first_row:       First row in the block to write
+        @type last_row:         C{int}
+        @param last_row:        Row in the block after the last row to write
+        @rtype:                 C{StreamInfoTable}
+        @return:                Stream info table of the stream cells
+        '''
+    if last_row is None:
+        last_row = stream_id_block.shape[0]
+    num_columns = stream_id_block.shape[1]
+
+    stream_rows, stream_cols = np.nonzero(stream_id_block[first_row:last_row] > 0)
+    stream_rows += first_row
+
+    dtype = [(str(column_name), StreamInfoTable.INTEGER_COLUMNS.get(column_name, np.float64))
+             for column_name in ('DEM_1D_Index', 'Row', 'Col', 'StreamID', 'StreamDirection')]
+    table = np.empty(len(stream_rows), dtype=dtype)
+    table['Row'] = stream_rows + block_first_row
+    table['Col'] = stream_cols
+    table['DEM_1D_Index'] = table['Row'].astype(np.int64) * num_columns + stream_cols
+    table['StreamID'] = stream_id_block[stream_rows, stream_cols]
+    table['StreamDirection'] = get_stream_cell_directions(stream_id_block,
+                                                          stream_rows,
+                                                          stream_cols,
+                                                          search_radius)
+    return StreamInfoTable(table)
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+##
+##  stream_info.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License BSD 3-Clause
+
+from itertools import islice
+import os
+import warnings
+
+import numpy as np
+
+#------------------------------------------------------------------------------
+#Stream Info Table Class
+#------------------------------------------------------------------------------
+class StreamInfoTable(object):
+    """
+    This class holds the stream info file as typed NumPy columns
+    Columns: DEM_1D_Index Row Col StreamID StreamDirection [Slope] [Flow]
+    """
+    INTEGER_COLUMNS = {
+                        'DEM_1D_Index': np.int64,
+                        'Row': np.int32,
+                        'Col': np.int32,
+                        'StreamID': np.int64,
+                      }
+
+    def __init__(self, table):
+        """
+        Initialize the class with a NumPy structured array
+        """
+        self.table = table
+        self._stream_id_index = None
+
+    @staticmethod
+    def get_sidecar_file(stream_info_file):
+        """
+        Path to the binary sidecar file kept next to the stream info file
+        """
+        return "{0}.npy".format(os.path.splitext(stream_info_file)[0])
+
+    @classmethod
+    def sidecar_is_current(cls, stream_info_file):
+        """
+        Checks if the binary sidecar is at least as new as the stream info file
+        """
+        sidecar_file = cls.get_sidecar_file(stream_info_file)
+        if not os.path.exists(sidecar_file):
+            return False
+        if not os.path.exists(stream_info_file):
+            return True
+        return os.path.getmtime(sidecar_file) >= os.path.getmtime(stream_info_file)
+
+    @classmethod
+    def read(cls, stream_info_file, use_sidecar=False):
+        """
+        Read stream info file into typed columns
+
+        If use_sidecar is True, the binary sidecar is memory-mapped when it is
+        current. Otherwise, it is created from the text file for the next read.
+        """
+        if use_sidecar and cls.sidecar_is_current(stream_info_file):
+            return cls(np.load(cls.get_sidecar_file(stream_info_file), mmap_mode='r'))
+
+        stream_info_table = cls.read_text(stream_info_file)
+        if use_sidecar:
+            stream_info_table.write_sidecar(stream_info_file)
+        return stream_info_table
+
+    @classmethod
+    def read_text(cls, stream_info_file):
+        """
+        Read stream info file (space or comma delimited) into typed columns
+        """
+        with open(stream_info_file, 'r') as infile:
+            dtype, delimiter = cls._read_text_header(infile)
+            return cls(cls._parse_text_lines(infile, dtype, delimiter))
+
+    @classmethod
+    def iter_read(cls, stream_info_file, chunk_size=500000, use_sidecar=False):
+        """
+        Read stream info file in chunks of rows
+
+        Yields at least one (possibly empty) StreamInfoTable. The binary
+        sidecar is used when use_sidecar is True and it is current.
+        """
+        if use_sidecar and cls.sidecar_is_current(stream_info_file):
+            table = np.load(cls.get_sidecar_file(stream_info_file), mmap_mode='r')
+            for chunk_start in range(0, max(len(table), 1), chunk_size):
+                yield cls(table[chunk_start:chunk_start+chunk_size])
+            return
+
+        with open(stream_info_file, 'r') as infile:
+            dtype, delimiter = cls._read_text_header(infile)
+            while True:
+                lines = list(islice(infile, chunk_size))
+                yield cls(cls._parse_text_lines(lines, dtype, delimiter))
+                if len(lines) < chunk_size:
+                    break
+
+    @classmethod
+    def read_unique_stream_ids(cls, stream_info_file, chunk_size=500000, use_sidecar=False):
+        """
+        Read the sorted unique stream ids of the stream info file from only
+        the StreamID column (of the binary sidecar when use_sidecar is True
+        and it is current)
+        """
+        if use_sidecar and cls.sidecar_is_current(stream_info_file):
+            return np.unique(np.load(cls.get_sidecar_file(stream_info_file), mmap_mode='r')['StreamID'])
+
+        unique_stream_id_list = []
+        with open(stream_info_file, 'r') as infile:
+            dtype, delimiter = cls._read_text_header(infile)
+            stream_id_column = [column_name for column_name, column_type in dtype].index('StreamID')
+            while True:
+                lines = list(islice(infile, chunk_size))
+                unique_stream_id_list.append(np.unique(cls._parse_text_lines(lines,
+                                                                             cls.INTEGER_COLUMNS['StreamID'],
+                                                                             delimiter,
+                                                                             usecols=(stream_id_column,))))
+                if len(lines) < chunk_size:
+                    break
+        return np.unique(np.concatenate(unique_stream_id_list))
+
+    @classmethod
+    def _read_text_header(cls, infile):
+        """
+        Get the column dtype and delimiter from the header of the file
+        """
+        header = infile.readline()
+        delimiter = None
+        if ',' in header:
+            delimiter = ','
+        column_names = [column_name.strip() for column_name in
+                        header.replace(',', ' ').split()]
+        dtype = [(str(column_name), cls.INTEGER_COLUMNS.get(column_name, np.float64))
+                 for column_name in column_names]
+        return dtype, delimiter
+
+    @staticmethod
+    def _parse_text_lines(lines, dtype, delimiter, usecols=None):
+        """
+        Parse rows of the stream info file into a structured array
+        (or only the columns in usecols)
+        """
+        with warnings.catch_warnings():
+            #empty stream info files are valid, but NumPy warns about them
+            warnings.simplefilter("ignore")
+            return np.loadtxt(lines, dtype=dtype, delimiter=delimiter, ndmin=1,
+                              usecols=usecols)
+
+    @property
+    def column_names(self):
+        """
+        Names of columns in the table
+        """
+        return list(self.table.dtype.names)
+
+    @property
+    def stream_id(self):
+        """
+        StreamID value for each cell in the table
+        """
+        return self.table['StreamID']
+
+    @property
+    def stream_id_index(self):
+        """
+        Sorted unique stream ids and the location of each cell in that list
+        (built once per table)
+        """
+        if self._stream_id_index is None:
+            self._stream_id_index = np.unique(self.stream_id, return_inverse=True)
+        return self._stream_id_index
+
+    @property
+    def unique_stream_ids(self):
+        """
+        Sorted unique stream ids in the table
+        """
+        return self.stream_id_index[0]
+
+    def __len__(self):
+        return len(self.table)
+
+    def with_column(self, column_name, column_values):
+        """
+        Returns a new table with the column replaced or appended
+        """
+        column_values = np.asarray(column_values)
+        dtype = []
+        for name in self.table.dtype.names:
+            if name == column_name:
+                dtype.append((name, column_values.dtype))
+            else:
+                dtype.append((name, self.table.dtype[name]))
+        if column_name not in self.table.dtype.names:
+            dtype.append((str(column_name), column_values.dtype))
+
+        new_table = np.empty(len(self.table), dtype=dtype)
+        for name in self.table.dtype.names:
+            if name != column_name:
+                new_table[name] = self.table[name]
+        new_table[column_name] = column_values
+        return StreamInfoTable(new_table)
+
+    def join(self, stream_ids, values, column_name, fill_value=None,
+             keep_order=False):
+        """
+        Join per-reach values onto every cell of the table in one pass
+
+        Cells are grouped in the order the stream ids are given unless
+        keep_order is True. If fill_value is None, cells without a matching
+        stream id are dropped. Otherwise, they are set to fill_value
+        (and placed at the end if the cells are grouped).
+        """
+        stream_ids = np.asarray(stream_ids, dtype=np.int64).ravel()
+        values = np.asarray(values).ravel()
+        if len(stream_ids) != len(values):
+            raise IndexError("Number of stream ids ({0}) does not match " \
+                             "number of values ({1}) ...".format(len(stream_ids),
+                                                                len(values)))
+
+        unique_stream_ids, cell_unique_index = self.stream_id_index
+        num_reaches = len(stream_ids)
+
+        #locate the reaches in the unique stream ids of the table
+        reach_unique_index = np.searchsorted(unique_stream_ids, stream_ids)
+        reach_unique_index[reach_unique_index >= len(unique_stream_ids)] = 0
+        valid_reaches = np.zeros(num_reaches, dtype=bool)
+        if len(unique_stream_ids) > 0:
+            valid_reaches = unique_stream_ids[reach_unique_index] == stream_ids
+
+        #the first reach given for a stream id determines the order and value
+        unique_rank = np.full(len(unique_stream_ids), num_reaches, dtype=np.int64)
+        np.minimum.at(unique_rank,
+                      reach_unique_index[valid_reaches],
+                      np.nonzero(valid_reaches)[0])
+        cell_rank = unique_rank[cell_unique_index]
+        cell_found = cell_rank < num_reaches
+
+        if fill_value is None:
+            cell_order = np.nonzero(cell_found)[0]
+        else:
+            cell_order = np.arange(len(cell_rank))
+        if not keep_order:
+            cell_order = cell_order[np.argsort(cell_rank[cell_order], kind='mergesort')]
+
+        joined_table = StreamInfoTable(self.table[cell_order])
+        cell_rank = cell_rank[cell_order]
+        cell_found = cell_found[cell_order]
+        if num_reaches > 0:
+            column_values = values[np.minimum(cell_rank, num_reaches - 1)]
+        else:
+            column_values = np.zeros(len(cell_rank), dtype=values.dtype)
+        if fill_value is not None and not cell_found.all():
+            column_values = column_values.astype(np.result_type(column_values,
+                                                                np.asarray(fill_value)))
+            column_values[~cell_found] = fill_value
+
+        return joined_table.with_column(column_name, column_values)
+
+    def save(self, stream_info_file, use_sidecar=False):
+        """
+        Save the table to the binary sidecar if use_sidecar is True.
+        Otherwise, write the stream info text file.
+        """
+        if use_sidecar:
+            self.write_sidecar(stream_info_file)
+        else:
+            self.write(stream_info_file)
+
+    def write_sidecar(self, stream_info_file):
+        """
+        Write the table to the binary sidecar of the stream info file
+        """
+        sidecar_file = self.get_sidecar_file(stream_info_file)
+        temp_sidecar_file = "{0}_temp.npy".format(os.path.splitext(stream_info_file)[0])
+        np.save(temp_sidecar_file, np.ascontiguousarray(self.table))
+        try:
+            os.remove(sidecar_file)
+        except OSError:
+            pass
+        os.rename(temp_sidecar_file, sidecar_file)
+
+    def write(self, stream_info_file, chunk_size=100000):
+        """
+        Write the table to a space delimited stream info file
+        """
+        with StreamInfoFileWriter(stream_info_file, chunk_size) as writer:
+            writer.write(self)
+
+#------------------------------------------------------------------------------
+#Stream Info File Writer Class
+#------------------------------------------------------------------------------
+class StreamInfoFileWriter(object):
+    """
+    This class writes the stream info file one table chunk at a time.
+    The rows go to a temporary file that replaces the stream info file
+    when the writer is closed without an error.
+    """
+    def __init__(self, stream_info_file, chunk_size=100000):
+        """
+        Initialize the class with variables given by the user
+        """
+        self.stream_info_file = stream_info_file
+        self.chunk_size = chunk_size
+        self.temp_stream_info_file = "{0}_temp.txt".format(os.path.splitext(stream_info_file)[0])
+        self._outfile = None
+        self._column_names = None
+
+    def __enter__(self):
+        self._outfile = open(self.temp_stream_info_file, 'wb')
+        return self
+
+    def write(self, stream_info_table):
+        """
+        Append the rows of the table to the stream info file
+        """
+        column_names = stream_info_table.table.dtype.names
+        if self._column_names is None:
+            self._column_names = column_names
+            self._outfile.write(u"{0}\r\n".format(u" ".join(column_names)).encode("utf-8"))
+        elif self._column_names != column_names:
+            raise ValueError("Stream info columns {0} do not match " \
+                             "columns {1} ...".format(column_names, self._column_names))
+
+        for chunk_start in range(0, len(stream_info_table), self.chunk_size):
+            table_chunk = stream_info_table.table[chunk_start:chunk_start+self.chunk_size]
+            string_columns = [table_chunk[column_name].astype(str)
+                              for column_name in column_names]
+            self._outfile.write(u"".join([u"{0}\r\n".format(u" ".join(row))
+                                          for row in zip(*string_columns)]).encode("utf-8"))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._outfile.close()
+        if exc_type is not None:
+            try:
+                os.remove(self.temp_stream_info_file)
+            except OSError:
+                pass
+            return
+
+        try:
+            os.remove(self.stream_info_file)
+        except OSError:
+            pass
+        os.rename(self.temp_stream_info_file, self.stream_info_file)
+
+def get_scenario_stream_info_file(stream_info_file, scenario_name):
+    """
+    Path to the stream info file of a streamflow scenario
+    (e.g. stream_info_return_period_20.txt)
+    """
+    stream_info_base, stream_info_extension = os.path.splitext(stream_info_file)
+    return "{0}_{1}{2}".format(stream_info_base, scenario_name, stream_info_extension)
+
+def render_stream_info_file(stream_info_file):
+    """
+    Writes the stream info text file from the binary sidecar if the
+    sidecar is newer (e.g. right before the AutoRoute executable needs it)
+    """
+    sidecar_file = StreamInfoTable.get_sidecar_file(stream_info_file)
+    if not os.path.exists(sidecar_file):
+        return
+    if os.path.exists(stream_info_file) and \
+        os.path.getmtime(sidecar_file) <= os.path.getmtime(stream_info_file):
+        return
+
+    print("Writing stream info file from binary sidecar ...")
+    StreamInfoTable.read(stream_info_file, use_sidecar=True).write(stream_info_file)
+    #keep the sidecar current with the text file
+    os.utime(sidecar_file, None)
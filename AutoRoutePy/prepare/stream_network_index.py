@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+##
+##  stream_network_index.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License BSD 3-Clause
+
+import os
+from shutil import rmtree
+
+import numpy as np
+from osgeo import ogr
+
+#local imports
+from ..utilities import get_cache_key
+
+#------------------------------------------------------------------------------
+#Stream Network Index Class
+#------------------------------------------------------------------------------
+class StreamNetworkIndex(object):
+    """
+    This class keeps a spatial index of the stream network on disk so each
+    prepare worker only reads the features intersecting its DEM.
+    The index is a uniform grid over the extent of the stream network with
+    the features whose bounding box overlaps each grid cell, so a query
+    only visits the features in the grid cells under the bounds. The arrays
+    are stored as .npy files in an index folder and memory-mapped by each
+    worker.
+
+    The index folder is next to the stream network unless index_directory
+    is given (e.g. if the stream network is in a read-only directory).
+    """
+    BBOX_DTYPE = [('fid', np.int64), ('min_x', np.float64), ('max_x', np.float64),
+                  ('min_y', np.float64), ('max_y', np.float64)]
+
+    def __init__(self, stream_network_shapefile, index_directory=None,
+                 features_per_cell=4):
+        """
+        Initialize the class with variables given by the user
+        """
+        self.stream_network_shapefile = stream_network_shapefile
+        self.features_per_cell = features_per_cell
+        stream_network_base = os.path.splitext(stream_network_shapefile)[0]
+        if index_directory:
+            self.index_folder = os.path.join(index_directory,
+                                             "{0}_{1}_index".format(os.path.basename(stream_network_base),
+                                                                    get_cache_key(os.path.abspath(stream_network_shapefile))))
+        else:
+            self.index_folder = "{0}_index".format(stream_network_base)
+        self._index_arrays = {}
+
+    def get_index_file(self, array_name):
+        """
+        Path to the file of an array of the index
+        """
+        return os.path.join(self.index_folder, "{0}.npy".format(array_name))
+
+    def is_current(self):
+        """
+        Check if the index is newer than the stream network
+        """
+        try:
+            #the grid definition is written last
+            return os.path.getmtime(self.get_index_file('grid')) >= \
+                os.path.getmtime(self.stream_network_shapefile)
+        except OSError:
+            return False
+
+    def build(self, force=False):
+        """
+        Build the index from the bounding box of each feature
+        (once unless force is True). Returns None if the index
+        cannot be written.
+        """
+        if self.is_current() and not force:
+            return self
+
+        print("Indexing stream network: {0}".format(self.stream_network_shapefile))
+        stream_shapefile = ogr.Open(self.stream_network_shapefile)
+        stream_layer = stream_shapefile.GetLayer()
+        bbox_table = np.empty(stream_layer.GetFeatureCount(), dtype=self.BBOX_DTYPE)
+        num_features = 0
+        for feature in stream_layer:
+            geometry = feature.GetGeometryRef()
+            if geometry is None:
+                continue
+            min_x, max_x, min_y, max_y = geometry.GetEnvelope()
+            bbox_table[num_features] = (feature.GetFID(), min_x, max_x, min_y, max_y)
+            num_features += 1
+        stream_shapefile = None
+
+        try:
+            self.write_index(bbox_table[:num_features])
+        except (IOError, OSError) as ex:
+            print(ex)
+            print("Unable to write stream network index. Skipping stream network index ...")
+            return None
+        return self
+
+    def write_index(self, bbox_table):
+        """
+        Write the grid index of the features in the bounding box table
+        """
+        num_features = len(bbox_table)
+        if num_features > 0:
+            extent_min_x = bbox_table['min_x'].min()
+            extent_min_y = bbox_table['min_y'].min()
+            extent_width = max(bbox_table['max_x'].max() - extent_min_x, 1e-9)
+            extent_height = max(bbox_table['max_y'].max() - extent_min_y, 1e-9)
+        else:
+            extent_min_x = extent_min_y = 0.0
+            extent_width = extent_height = 1.0
+
+        #square cells with about features_per_cell features in each cell
+        num_cells = max(1, min(num_features // max(1, self.features_per_cell), 4096**2))
+        cell_size = max(np.sqrt(extent_width * extent_height / float(num_cells)),
+                        extent_width / 4096.0, extent_height / 4096.0)
+        num_cols = int(min(4096, max(1, np.ceil(extent_width / cell_size))))
+        num_rows = int(min(4096, max(1, np.ceil(extent_height / cell_size))))
+        grid = np.array([extent_min_x, extent_min_y, cell_size, cell_size, num_cols, num_rows],
+                        dtype=np.float64)
+
+        #grid cells overlapped by the bounding box of each feature
+        min_cols, max_cols = self.get_cell_range(grid, 0, bbox_table['min_x'], bbox_table['max_x'])
+        min_rows, max_rows = self.get_cell_range(grid, 1, bbox_table['min_y'], bbox_table['max_y'])
+        cell_feature_list = []
+        cell_id_list = []
+        for feature_index in range(num_features):
+            feature_rows = np.arange(min_rows[feature_index], max_rows[feature_index] + 1)
+            feature_cols = np.arange(min_cols[feature_index], max_cols[feature_index] + 1)
+            feature_cells = (feature_rows[:, None] * num_cols + feature_cols[None, :]).ravel()
+            cell_id_list.append(feature_cells)
+            cell_feature_list.append(np.full(len(feature_cells), feature_index, dtype=np.int64))
+        if num_features > 0:
+            cell_ids = np.concatenate(cell_id_list)
+            cell_features = np.concatenate(cell_feature_list)
+        else:
+            cell_ids = cell_features = np.empty(0, dtype=np.int64)
+        cell_order = np.argsort(cell_ids, kind='mergesort')
+        cell_offsets = np.searchsorted(cell_ids[cell_order],
+                                       np.arange(num_cols * num_rows + 1))
+
+        temp_index_folder = "{0}_{1}_temp".format(self.index_folder, os.getpid())
+        rmtree(temp_index_folder, ignore_errors=True)
+        os.makedirs(temp_index_folder)
+        np.save(os.path.join(temp_index_folder, "bbox.npy"), bbox_table)
+        np.save(os.path.join(temp_index_folder, "cell_offsets.npy"), cell_offsets.astype(np.int64))
+        np.save(os.path.join(temp_index_folder, "cell_features.npy"), cell_features[cell_order])
+        np.save(os.path.join(temp_index_folder, "grid.npy"), grid)
+        rmtree(self.index_folder, ignore_errors=True)
+        os.rename(temp_index_folder, self.index_folder)
+        self._index_arrays = {}
+
+    @staticmethod
+    def get_cell_range(grid, axis, min_values, max_values):
+        """
+        Get the first and last grid cell index along the axis (0: x, 1: y)
+        of the ranges clipped to the grid
+        """
+        num_cells = int(grid[4 + axis])
+        min_cells = np.floor((np.asarray(min_values) - grid[axis]) / grid[2 + axis])
+        max_cells = np.floor((np.asarray(max_values) - grid[axis]) / grid[2 + axis])
+        return (np.clip(min_cells, 0, num_cells - 1).astype(np.int64),
+                np.clip(max_cells, 0, num_cells - 1).astype(np.int64))
+
+    def get_index_array(self, array_name):
+        """
+        Array of the index (memory-mapped)
+        """
+        if array_name not in self._index_arrays:
+            self._index_arrays[array_name] = np.load(self.get_index_file(array_name), mmap_mode='r')
+        return self._index_arrays[array_name]
+
+    @property
+    def bbox_table(self):
+        """
+        Feature bounding box table (memory-mapped)
+        """
+        return self.get_index_array('bbox')
+
+    def get_candidate_rows(self, bounds):
+        """
+        Get the rows of the bounding box table of the features
+        in the grid cells under the bounds (min x, min y, max x, max y)
+        """
+        min_x, min_y, max_x, max_y = bounds
+        grid = self.get_index_array('grid')
+        if max_x < grid[0] or max_y < grid[1] or \
+            min_x > grid[0] + grid[2] * grid[4] or min_y > grid[1] + grid[3] * grid[5]:
+            return np.empty(0, dtype=np.int64)
+        (min_col,), (max_col,) = self.get_cell_range(grid, 0, [min_x], [max_x])
+        (min_row,), (max_row,) = self.get_cell_range(grid, 1, [min_y], [max_y])
+        cell_offsets = self.get_index_array('cell_offsets')
+        cell_features = self.get_index_array('cell_features')
+        num_cols = int(grid[4])
+        candidate_row_list = [cell_features[cell_offsets[row * num_cols + min_col]:
+                                            cell_offsets[row * num_cols + max_col + 1]]
+                              for row in range(min_row, max_row + 1)]
+        if not candidate_row_list:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(candidate_row_list))
+
+    def get_intersecting_fids(self, bounds):
+        """
+        Get the sorted FIDs of the features with bounding boxes intersecting
+        the bounds (min x, min y, max x, max y) in the stream network projection
+        """
+        min_x, min_y, max_x, max_y = bounds
+        candidates = self.bbox_table[self.get_candidate_rows(bounds)]
+        intersecting = (candidates['min_x'] <= max_x) & \
+                       (candidates['max_x'] >= min_x) & \
+                       (candidates['min_y'] <= max_y) & \
+                       (candidates['max_y'] >= min_y)
+        return np.sort(candidates['fid'][intersecting])
+
+    def iter_features(self, stream_layer, bounds):
+        """
+        Iterate over the features of the stream network layer
+        intersecting the bounds using the grid index
+        """
+        for fid in self.get_intersecting_fids(bounds):
+            feature = stream_layer.GetFeature(int(fid))
+            if feature is not None:
+                yield feature
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+##
+##  stream_network_partition.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License BSD 3-Clause
+
+import os
+
+import numpy as np
+from osgeo import ogr
+
+#local imports
+from .footprint import get_watershed_footprints
+
+#name of the stream network of the tile in each AutoRoute input folder
+TILE_STREAM_NETWORK_FILE_NAME = "tile_stream_network.shp"
+
+#------------------------------------------------------------------------------
+#Helper Functions
+#------------------------------------------------------------------------------
+def get_tile_stream_network_file(sub_folder, stream_network_shapefile):
+    '''
+    Get the stream network of the tile in the folder if it was partitioned
+    after the last change to the stream network (otherwise the stream network)
+    '''
+    tile_stream_network_file = os.path.join(sub_folder, TILE_STREAM_NETWORK_FILE_NAME)
+    try:
+        if os.path.getmtime(tile_stream_network_file) >= \
+                os.path.getmtime(stream_network_shapefile):
+            return tile_stream_network_file
+    except OSError:
+        pass
+    return stream_network_shapefile
+
+#------------------------------------------------------------------------------
+#Main Functions
+#------------------------------------------------------------------------------
+def partition_stream_network(watershed_folder, stream_network_shapefile,
+                             dem_extension='img', tile_footprints=None):
+    '''
+    Split the stream network into a shapefile for each AutoRoute input folder
+    in the watershed with the features intersecting the footprint of its DEM
+    (see get_tile_stream_network_file). The stream network is read once to
+    assign features to tiles and each tile is written from those features.
+
+    tile_footprints can be given as [(sub folder, footprint polygon in the
+    stream network projection), ...] instead of being computed from the DEMs.
+    '''
+    stream_shapefile = ogr.Open(stream_network_shapefile)
+    stream_layer = stream_shapefile.GetLayer()
+    stream_srs = stream_layer.GetSpatialRef()
+
+    if tile_footprints is None:
+        tile_footprints = get_watershed_footprints(watershed_folder, stream_srs, dem_extension)
+    if not tile_footprints:
+        print("No tiles found to partition stream network: {0}".format(watershed_folder))
+        return
+
+    #min x, max x, min y, max y of each footprint
+    tile_envelopes = np.array([footprint.GetEnvelope() for sub_folder, footprint in tile_footprints])
+
+    print("Assigning stream network features to {0} tiles ...".format(len(tile_footprints)))
+    tile_fid_lists = [[] for tile_footprint in tile_footprints]
+    for feature in stream_layer:
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+        min_x, max_x, min_y, max_y = geometry.GetEnvelope()
+        candidate_tiles = np.nonzero((tile_envelopes[:, 0] <= max_x) &
+                                     (tile_envelopes[:, 1] >= min_x) &
+                                     (tile_envelopes[:, 2] <= max_y) &
+                                     (tile_envelopes[:, 3] >= min_y))[0]
+        for tile_index in candidate_tiles:
+            if tile_footprints[tile_index][1].Intersects(geometry):
+                tile_fid_lists[tile_index].append(feature.GetFID())
+
+    stream_layer_definition = stream_layer.GetLayerDefn()
+    shapefile_driver = ogr.GetDriverByName('ESRI Shapefile')
+    for (sub_folder, footprint), tile_fid_list in zip(tile_footprints, tile_fid_lists):
+        tile_stream_network_file = os.path.join(sub_folder, TILE_STREAM_NETWORK_FILE_NAME)
+        if os.path.exists(tile_stream_network_file):
+            shapefile_driver.DeleteDataSource(tile_stream_network_file)
+        tile_shapefile = shapefile_driver.CreateDataSource(tile_stream_network_file)
+        tile_layer = tile_shapefile.CreateLayer(os.path.splitext(TILE_STREAM_NETWORK_FILE_NAME)[0],
+                                                stream_srs,
+                                                stream_layer.GetGeomType())
+        for field_index in range(stream_layer_definition.GetFieldCount()):
+            tile_layer.CreateField(stream_layer_definition.GetFieldDefn(field_index))
+        for fid in tile_fid_list:
+            tile_feature = ogr.Feature(tile_layer.GetLayerDefn())
+            tile_feature.SetFrom(stream_layer.GetFeature(fid))
+            tile_layer.CreateFeature(tile_feature)
+        tile_shapefile = None
+        print("Wrote {0} stream features to: {1}".format(len(tile_fid_list),
+                                                         tile_stream_network_file))
@@ -25,31 +25,157 @@ except ImportError:
 from ..utilities import (CaptureStdOutToLog, 
                         case_insensitive_file_search, 
                         get_valid_num_cpus)
-from .worker_multiprocess import run_AutoRoute
-from ..prepare.prepare_multiprocess import (get_valid_streamflow_prepare_mode,
-                                            prepare_autoroute_streamflow_multiprocess_worker)
+from ..scheduling import (get_estimated_job_cost, get_job_size, imap_pipeline,
+                          iter_in_background, MemoryAwareScheduler, sort_jobs_by_cost)
+from ..stage_cache import get_output_digest, get_stage_digest, StageRecord
+from .worker_multiprocess import run_AutoRoute, VALID_RASTER_EXTENSIONS
+from ..prepare.stream_info import get_scenario_stream_info_file
+from ..prepare.prepare_multiprocess import (create_shared_streamflow,
+                                            get_streamflow_stages,
+                                            get_valid_streamflow_prepare_mode,
+                                            prepare_autoroute_streamflow_multiprocess_worker,
+                                            prepare_return_period_scenarios_multiprocess_worker)
 
 #----------------------------------------------------------------------------------------
 # MULTIPROCESS FUNCTIONS
 #----------------------------------------------------------------------------------------
+def get_elevation_dem_file(autoroute_input_directory):
+    """
+    Get the elevation raster of the AutoRoute input directory
+    (raises an exception if not found)
+    """
+    try:
+        return case_insensitive_file_search(autoroute_input_directory,
+                                            r'elevation\.(?:{0})$'.format(VALID_RASTER_EXTENSIONS))
+    except Exception:
+        case_insensitive_file_search(os.path.join(autoroute_input_directory, 'elevation'), r'hdr\.adf')
+        return os.path.join(autoroute_input_directory, 'elevation')
+
+def get_autoroute_input_subdirectories(autoroute_input_directory):
+    """
+    Get the (name, path, stream info file, job size) of each AutoRoute
+    input sub-directory with an elevation raster and stream info file
+    (largest estimated cost first)
+    """
+    autoroute_input_subdirectories = []
+    job_cost_list = []
+    for directory in sorted(os.listdir(autoroute_input_directory)):
+        master_watershed_autoroute_input_directory = os.path.join(autoroute_input_directory, directory)
+        if not os.path.isdir(master_watershed_autoroute_input_directory):
+            continue
+
+        try:
+            elevation_dem_file = get_elevation_dem_file(master_watershed_autoroute_input_directory)
+        except Exception:
+            print("ERROR: Elevation raster not found. Skipping run ...")
+            continue
+            pass
+        
+        try:
+            stream_info_file = case_insensitive_file_search(master_watershed_autoroute_input_directory,
+                                                            r'stream_info\.txt')
+        except Exception:
+            print("Stream info file not found. Skipping run ...")
+            continue
+            pass
+
+        job_size = get_job_size(elevation_dem_file, stream_info_file)
+        autoroute_input_subdirectories.append((directory,
+                                               master_watershed_autoroute_input_directory,
+                                               stream_info_file,
+                                               job_size))
+        job_cost_list.append(get_estimated_job_cost(job_size))
+    return sort_jobs_by_cost(autoroute_input_subdirectories, job_cost_list)
+
+def get_simulation_stage_digest(autoroute_executable_location,
+                                autoroute_manager,
+                                autoroute_input_path,
+                                scenario_name="",
+                                output_parameters=()):
+    """
+    Gets the digest of the AutoRoute simulation from the content of its
+    inputs (elevation, stream info, Manning's n and AutoRoute input file),
+    the AutoRoute parameters and the AutoRoute executable
+    """
+    stream_info_file = os.path.join(autoroute_input_path, 'stream_info.txt')
+    if scenario_name:
+        stream_info_file = get_scenario_stream_info_file(stream_info_file, scenario_name)
+
+    input_files = [get_elevation_dem_file(autoroute_input_path)]
+    for input_file_pattern in (r'manning_n\.(?:{0})$'.format(VALID_RASTER_EXTENSIONS),
+                               r'AUTOROUTE_INPUT_FILE\.TXT'):
+        try:
+            input_files.append(case_insensitive_file_search(autoroute_input_path, input_file_pattern))
+        except IndexError:
+            pass
+
+    autoroute_parameters = None
+    if autoroute_manager:
+        #the file paths are set for each simulation
+        autoroute_parameters = sorted([(name, value) for name, value in vars(autoroute_manager).items()
+                                       if not name.endswith("_path")])
+        autoroute_executable_location = autoroute_manager._autoroute_executable_location
+
+    return get_stage_digest("simulation",
+                            get_output_digest(stream_info_file),
+                            input_files + [autoroute_executable_location],
+                            (autoroute_parameters, scenario_name, output_parameters))
+
 def run_autoroute_multiprocess_worker(args):
     """
     Run autoroute on one of multiple cores
     """
-    job_name = args[7]
-    log_directory = args[8]
+    job_name = args[9]
+    log_directory = args[10]
     log_file_path = os.path.join(log_directory, "{0}-{1}.log".format(job_name, datetime.now().strftime("%Y-%m-%d_%H-%M-%S")))
     with CaptureStdOutToLog(log_file_path):
+        simulation_stages = []
+        if args[8]:
+            #the flood map raster is not kept if deleted
+            output_files = [args[3], args[4], args[5]]
+            if args[6]:
+                output_files = [args[4], args[5]]
+            simulation_stages.append(("simulation",
+                                      get_simulation_stage_digest(args[0],
+                                                                  args[1],
+                                                                  args[2],
+                                                                  args[7],
+                                                                  [bool(output_file) for output_file in args[3:7]])))
+            simulation_record = StageRecord(output_files)
+            if simulation_record.is_current(simulation_stages):
+                print("Skipping current stages: simulation")
+                return args[2], args[3], args[4], job_name
+            simulation_record.invalidate()
+
         run_AutoRoute(autoroute_executable_location=args[0],
                       autoroute_manager=args[1],
                       autoroute_input_path=args[2],
                       out_flood_map_raster_name=args[3],
                       out_flood_depth_raster_name=args[4],
                       out_shapefile_name=args[5],
-                      delete_flood_raster=args[6])
+                      delete_flood_raster=args[6],
+                      scenario_name=args[7])
+
+        if simulation_stages:
+            simulation_record.write(simulation_stages)
         
     return args[2], args[3], args[4], job_name
 
+def run_autoroute_pipeline(pool, num_cpus, streamflow_job_list, autoroute_job_list):
+    """
+    Run each AutoRoute simulation as soon as its streamflow is ready
+    and yield the output of each simulation as it finishes
+    """
+    for job_stage, job_output in imap_pipeline(pool, num_cpus,
+                                               prepare_autoroute_streamflow_multiprocess_worker,
+                                               streamflow_job_list,
+                                               run_autoroute_multiprocess_worker,
+                                               autoroute_job_list):
+        if job_stage == 'prepare':
+            print("STREAMFLOW READY: {0}".format(job_output))
+        else:
+            yield job_output
+
 #----------------------------------------------------------------------------------------
 # MAIN PROCESS
 #----------------------------------------------------------------------------------------
@@ -72,10 +198,36 @@ def run_autoroute_multiprocess(autoroute_input_directory, #path to AutoRoute inp
                                generate_flood_depth_raster=False, #generate flood raster
                                generate_flood_map_shapefile=False, #generate a flood map shapefile
                                wait_for_all_processes_to_finish=True, #waits for all processes to finish before ending script
-                               num_cpus=-17 #number of processes to use on computer
+                               num_cpus=-17, #number of processes to use on computer
+                               peak_flow_cache_directory="", #directory to share peak flows from RAPID output between subbasins
+                               memory_budget=None, #bytes for AutoRoute simulations to run at once (memory-aware scheduling if set)
+                               pipeline_streamflow=False, #start each AutoRoute simulation when its streamflow is ready
+                               use_stage_cache=False, #skip streamflow and simulations with outputs written from the same inputs
                                ):
     """
     This it the main AutoRoute-RAPID process
+
+    If memory_budget is set, AutoRoute simulations are only started while
+    their estimated memory fits in the budget (calibrated with the peak
+    memory of finished simulations) instead of 3 GB per CPU. Then, if
+    wait_for_all_processes_to_finish is False, simulations are started
+    as the multiprocess_worker_list is iterated.
+
+    If pipeline_streamflow is True, the streamflow preparation and the
+    AutoRoute simulation of each sub-directory run in one pool of num_cpus
+    workers and each simulation starts as soon as its streamflow is ready
+    instead of after the streamflow of all sub-directories. The pipeline is
+    scheduled in a background thread, so the jobs start even if
+    wait_for_all_processes_to_finish is False and the multiprocess_worker_list
+    is not iterated, and the shared streamflow is removed when it finishes.
+
+    If use_stage_cache is True, the digests of the streamflow and the
+    simulation (from the content of their inputs, the AutoRoute parameters
+    and the AutoRoute executable) are recorded next to their outputs and
+    the ones with current outputs are skipped.
+
+    If wait_for_all_processes_to_finish is True, the multiprocess_worker_list
+    of the returned job information is the list of the finished job outputs.
     """
     time_start_all = datetime.utcnow()
     if not generate_flood_depth_raster and not generate_flood_map_raster and not generate_flood_map_shapefile:
@@ -101,6 +253,9 @@ def run_autoroute_multiprocess(autoroute_input_directory, #path to AutoRoute inp
                                                      streamflow_id,
                                                      stream_network_shapefile,
                                                      )    
+    pipeline_streamflow = pipeline_streamflow and PREPARE_MODE > 0 and mode == "multiprocess"
+    if pipeline_streamflow and memory_budget:
+        raise Exception("ERROR: memory_budget cannot be used with pipeline_streamflow ...")
     #--------------------------------------------------------------------------
     #Initialize Run
     #--------------------------------------------------------------------------
@@ -130,185 +285,252 @@ def run_autoroute_multiprocess(autoroute_input_directory, #path to AutoRoute inp
     #keep list of jobs
     autoroute_job_info = {
                             'multiprocess_job_list': [],
+                            'multiprocess_job_size_list': [],
                             'htcondor_job_list': [],
                             'htcondor_job_info': [],
                             'output_folder': autoroute_output_directory,
                            }
                            
     if mode == "multiprocess":
-        num_cpus = get_valid_num_cpus(num_cpus)                    
+        if memory_budget:
+            num_cpus = get_valid_num_cpus(num_cpus, memory_per_cpu=None)
+            #one job per worker to measure the peak memory of each job
+            pool_main = multiprocessing.Pool(num_cpus, maxtasksperchild=1)
+        else:
+            num_cpus = get_valid_num_cpus(num_cpus)
+            pool_main = multiprocessing.Pool(num_cpus)
         #start pool
-        pool_streamflow = multiprocessing.Pool(num_cpus)
-        pool_main = multiprocessing.Pool(num_cpus)
+        if not pipeline_streamflow:
+            pool_streamflow = multiprocessing.Pool(num_cpus)
 
     #--------------------------------------------------------------------------
     #Run the model
     #--------------------------------------------------------------------------
     #loop through sub-directories
-    streamflow_job_list = []
-    for directory in os.listdir(autoroute_input_directory):
-        master_watershed_autoroute_input_directory = os.path.join(autoroute_input_directory, directory)
-        if os.path.isdir(master_watershed_autoroute_input_directory):
-            autoroute_watershed_name = os.path.basename(autoroute_input_directory)
-            autoroute_job_name = "{0}-{1}".format(autoroute_watershed_name, directory)
+    streamflow_folder_list = []
+    autoroute_watershed_name = os.path.basename(autoroute_input_directory)
+    for directory, master_watershed_autoroute_input_directory, stream_info_file, job_size in \
+            get_autoroute_input_subdirectories(autoroute_input_directory):
+        autoroute_job_name = "{0}-{1}".format(autoroute_watershed_name, directory)
+
+        if PREPARE_MODE > 0:
+            streamflow_folder_list.append((master_watershed_autoroute_input_directory,
+                                           stream_info_file,
+                                           autoroute_job_name))
+        
+        output_shapefile_base_name = '{0}_{1}'.format(autoroute_watershed_name, directory)
+        #set up flood raster name
+        output_flood_map_raster_name = 'flood_map_raster_{0}.tif'.format(output_shapefile_base_name)
+        master_output_flood_map_raster_name = os.path.join(autoroute_output_directory, output_flood_map_raster_name)
+        #set up flood raster name
+        output_flood_depth_raster_name = 'flood_depth_raster_{0}.tif'.format(output_shapefile_base_name)
+        master_output_flood_depth_raster_name = os.path.join(autoroute_output_directory, output_flood_depth_raster_name)
+        #set up flood shapefile name
+        output_shapefile_shp_name = '{0}.shp'.format(output_shapefile_base_name)
+        master_output_shapefile_shp_name = os.path.join(autoroute_output_directory, output_shapefile_shp_name)
+
+        delete_flood_map_raster = False
+        if not generate_flood_map_shapefile:
+            master_output_shapefile_shp_name = ""
+        else:
+            if not generate_flood_map_raster:
+                generate_flood_map_raster = True
+                delete_flood_map_raster = True
             
-            try:
-                case_insensitive_file_search(master_watershed_autoroute_input_directory, r'elevation\.(?!prj)')
-            except Exception:
-                try:
-                    case_insensitive_file_search(os.path.join(master_watershed_autoroute_input_directory, 'elevation'), r'hdr\.adf')
-                except Exception:
-                    print("ERROR: Elevation raster not found. Skipping run ...")
-                    continue
-                    pass
-                pass
+        if not generate_flood_map_raster:
+            master_output_flood_map_raster_name = ""
+
+        if not generate_flood_depth_raster:
+            master_output_flood_depth_raster_name = ""
+
+        if mode == "htcondor":
+            #create job to run autoroute for each raster in watershed
+            job = CJob('job_autoroute_{0}_{1}'.format(os.path.basename(autoroute_input_directory), directory), tmplt.vanilla_transfer_files)
             
-            try:
-                stream_info_file = case_insensitive_file_search(master_watershed_autoroute_input_directory,
-                                                                r'stream_info\.txt')
-            except Exception:
-                print("Stream info file not found. Skipping run ...")
-                continue
-                pass
-
-            if PREPARE_MODE > 0:
-                streamflow_job_list.append((PREPARE_MODE,
-                                            master_watershed_autoroute_input_directory,
-                                            stream_info_file,
-                                            rapid_output_directory,
-                                            return_period_file,
-                                            return_period,
-                                            rapid_output_file,
-                                            date_peak_search_start,
-                                            date_peak_search_end,
-                                            river_id,
-                                            streamflow_id,
-                                            stream_network_shapefile,
-                                            autoroute_job_name,
-                                            prepare_log_directory,
-                                            ))
+
+            if generate_flood_map_shapefile:
+                #setup additional floodmap shapfile names
+                output_shapefile_shx_name = '{0}.shx'.format(output_shapefile_base_name)
+                master_output_shapefile_shx_name = os.path.join(autoroute_output_directory, output_shapefile_shx_name)
+                output_shapefile_prj_name = '{0}.prj'.format(output_shapefile_base_name)
+                master_output_shapefile_prj_name = os.path.join(autoroute_output_directory, output_shapefile_prj_name)
+                output_shapefile_dbf_name = '{0}.dbf'.format(output_shapefile_base_name)
+                master_output_shapefile_dbf_name = os.path.join(autoroute_output_directory, output_shapefile_dbf_name)
             
-            output_shapefile_base_name = '{0}_{1}'.format(autoroute_watershed_name, directory)
-            #set up flood raster name
-            output_flood_map_raster_name = 'flood_map_raster_{0}.tif'.format(output_shapefile_base_name)
-            master_output_flood_map_raster_name = os.path.join(autoroute_output_directory, output_flood_map_raster_name)
-            #set up flood raster name
-            output_flood_depth_raster_name = 'flood_depth_raster_{0}.tif'.format(output_shapefile_base_name)
-            master_output_flood_depth_raster_name = os.path.join(autoroute_output_directory, output_flood_depth_raster_name)
-            #set up flood shapefile name
-            output_shapefile_shp_name = '{0}.shp'.format(output_shapefile_base_name)
-            master_output_shapefile_shp_name = os.path.join(autoroute_output_directory, output_shapefile_shp_name)
-
-            delete_flood_map_raster = False
-            if not generate_flood_map_shapefile:
-                master_output_shapefile_shp_name = ""
+                transfer_output_remaps = "{0} = {1}; {2} = {3}; {4} = {5};" \
+                                         " {6} = {7}; {8} = {9}".format(output_shapefile_shp_name, 
+                                                                        master_output_shapefile_shp_name,
+                                                                        output_shapefile_shx_name,
+                                                                        master_output_shapefile_shx_name,
+                                                                        output_shapefile_prj_name,
+                                                                        master_output_shapefile_prj_name,
+                                                                        output_shapefile_dbf_name,
+                                                                        master_output_shapefile_dbf_name,
+                                                                        output_flood_map_raster_name,
+                                                                        master_output_flood_map_raster_name)
+                
+                if generate_flood_depth_raster:
+                    transfer_output_remaps += "; {0} = {1}".format(output_flood_depth_raster_name, 
+                                                                   master_output_flood_depth_raster_name)
             else:
-                if not generate_flood_map_raster:
-                    generate_flood_map_raster = True
-                    delete_flood_map_raster = True
+                output_shapefile_shp_name = ""
+                transfer_output_remaps = ""
+                if generate_flood_map_raster:
+                    transfer_output_remaps = "{0} = {1}".format(output_flood_map_raster_name, 
+                                                                master_output_flood_map_raster_name)
+                if generate_flood_depth_raster:
+                    if transfer_output_remaps:
+                        transfer_output_remaps += "; "
+                        
+                    transfer_output_remaps += "{0} = {1}".format(output_flood_depth_raster_name, 
+                                                                 master_output_flood_depth_raster_name)
+                                                                 
+            job.set('transfer_output_remaps',"\"{0}\"" .format(transfer_output_remaps))
+                                                                  
+            job.set('executable', os.path.join(local_scripts_location,'multicore_worker_process.py'))
+            job.set('transfer_input_files', "{0}".format(master_watershed_autoroute_input_directory))
+            job.set('initialdir', run_log_directory)
                 
-            if not generate_flood_map_raster:
-                master_output_flood_map_raster_name = ""
+            job.set('arguments', '{0} {1} {2} {3} {4} {5} {6}' % (autoroute_executable_location,
+                                                                  autoroute_manager,
+                                                                  directory,
+                                                                  output_flood_map_raster_name,
+                                                                  output_flood_depth_raster_name,
+                                                                  output_shapefile_shp_name,
+                                                                  delete_flood_map_raster))
+                                                          
+            autoroute_job_info['htcondor_job_list'].append(job)
+            autoroute_job_info['htcondor_job_info'].append({ 'output_shapefile_base_name': output_shapefile_base_name,
+                                                             'autoroute_job_name': autoroute_job_name})
 
-            if not generate_flood_depth_raster:
-                master_output_flood_depth_raster_name = ""
+        else: #mode == "multiprocess":
+            autoroute_job_info['multiprocess_job_list'].append((autoroute_executable_location,
+                                                                autoroute_manager,
+                                                                master_watershed_autoroute_input_directory,
+                                                                master_output_flood_map_raster_name,
+                                                                master_output_flood_depth_raster_name,
+                                                                master_output_shapefile_shp_name,
+                                                                delete_flood_map_raster,
+                                                                "",
+                                                                use_stage_cache,
+                                                                autoroute_job_name,
+                                                                run_log_directory
+                                                                ))
+            autoroute_job_info['multiprocess_job_size_list'].append(job_size)
+            #For testing function serially
+            """
+            run_autoroute_multiprocess_worker((autoroute_executable_location,
+                                               autoroute_manager,
+                                               master_watershed_autoroute_input_directory,
+                                               master_output_flood_map_raster_name,
+                                               master_output_flood_depth_raster_name,
+                                               master_output_shapefile_shp_name,
+                                               delete_flood_map_raster,
+                                               "",
+                                               use_stage_cache,
+                                               autoroute_job_name,
+                                               run_log_directory))
+            """
+    if PREPARE_MODE > 0:
+        stream_info_stage_list = []
+        streamflow_stream_info_files = []
+        for master_watershed_autoroute_input_directory, stream_info_file, autoroute_job_name \
+                in streamflow_folder_list:
+            stream_info_stages = None
+            if use_stage_cache:
+                stream_info_stages = get_streamflow_stages(stream_info_file,
+                                                           PREPARE_MODE,
+                                                           rapid_output_directory,
+                                                           return_period_file,
+                                                           return_period,
+                                                           rapid_output_file,
+                                                           date_peak_search_start,
+                                                           date_peak_search_end,
+                                                           river_id,
+                                                           streamflow_id,
+                                                           stream_network_shapefile)
+            if stream_info_stages and StageRecord([stream_info_file]).is_current(stream_info_stages):
+                #skipped by the worker
+                print("Streamflow current: {0}".format(autoroute_job_name))
+            else:
+                streamflow_stream_info_files.append(stream_info_file)
+            stream_info_stage_list.append(stream_info_stages)
 
-            if mode == "htcondor":
-                #create job to run autoroute for each raster in watershed
-                job = CJob('job_autoroute_{0}_{1}'.format(os.path.basename(autoroute_input_directory), directory), tmplt.vanilla_transfer_files)
-                
+        #read streamflow for the whole watershed once for all workers
+        shared_streamflow = create_shared_streamflow(PREPARE_MODE,
+                                                     streamflow_stream_info_files,
+                                                     rapid_output_directory,
+                                                     return_period_file,
+                                                     return_period,
+                                                     rapid_output_file,
+                                                     date_peak_search_start,
+                                                     date_peak_search_end,
+                                                     peak_flow_cache_directory)
+        shared_streamflow_info = None
+        if shared_streamflow is not None:
+            shared_streamflow_info = shared_streamflow.info
 
-                if generate_flood_map_shapefile:
-                    #setup additional floodmap shapfile names
-                    output_shapefile_shx_name = '{0}.shx'.format(output_shapefile_base_name)
-                    master_output_shapefile_shx_name = os.path.join(autoroute_output_directory, output_shapefile_shx_name)
-                    output_shapefile_prj_name = '{0}.prj'.format(output_shapefile_base_name)
-                    master_output_shapefile_prj_name = os.path.join(autoroute_output_directory, output_shapefile_prj_name)
-                    output_shapefile_dbf_name = '{0}.dbf'.format(output_shapefile_base_name)
-                    master_output_shapefile_dbf_name = os.path.join(autoroute_output_directory, output_shapefile_dbf_name)
-                
-                    transfer_output_remaps = "{0} = {1}; {2} = {3}; {4} = {5};" \
-                                             " {6} = {7}; {8} = {9}".format(output_shapefile_shp_name, 
-                                                                            master_output_shapefile_shp_name,
-                                                                            output_shapefile_shx_name,
-                                                                            master_output_shapefile_shx_name,
-                                                                            output_shapefile_prj_name,
-                                                                            master_output_shapefile_prj_name,
-                                                                            output_shapefile_dbf_name,
-                                                                            master_output_shapefile_dbf_name,
-                                                                            output_flood_map_raster_name,
-                                                                            master_output_flood_map_raster_name)
-                    
-                    if generate_flood_depth_raster:
-                        transfer_output_remaps += "; {0} = {1}".format(output_flood_depth_raster_name, 
-                                                                       master_output_flood_depth_raster_name)
-                else:
-                    output_shapefile_shp_name = ""
-                    transfer_output_remaps = ""
-                    if generate_flood_map_raster:
-                        transfer_output_remaps = "{0} = {1}".format(output_flood_map_raster_name, 
-                                                                    master_output_flood_map_raster_name)
-                    if generate_flood_depth_raster:
-                        if transfer_output_remaps:
-                            transfer_output_remaps += "; "
-                            
-                        transfer_output_remaps += "{0} = {1}".format(output_flood_depth_raster_name, 
-                                                                     master_output_flood_depth_raster_name)
-                                                                     
-                job.set('transfer_output_remaps',"\"{0}\"" .format(transfer_output_remaps))
-                                                                      
-                job.set('executable', os.path.join(local_scripts_location,'multicore_worker_process.py'))
-                job.set('transfer_input_files', "{0}".format(master_watershed_autoroute_input_directory))
-                job.set('initialdir', run_log_directory)
-                    
-                job.set('arguments', '{0} {1} {2} {3} {4} {5} {6}' % (autoroute_executable_location,
-                                                                      autoroute_manager,
-                                                                      directory,
-                                                                      output_flood_map_raster_name,
-                                                                      output_flood_depth_raster_name,
-                                                                      output_shapefile_shp_name,
-                                                                      delete_flood_map_raster))
-                                                              
-                autoroute_job_info['htcondor_job_list'].append(job)
-                autoroute_job_info['htcondor_job_info'].append({ 'output_shapefile_base_name': output_shapefile_base_name,
-                                                                 'autoroute_job_name': autoroute_job_name})
-
-            else: #mode == "multiprocess":
-                autoroute_job_info['multiprocess_job_list'].append((autoroute_executable_location,
-                                                                    autoroute_manager,
-                                                                    master_watershed_autoroute_input_directory,
-                                                                    master_output_flood_map_raster_name,
-                                                                    master_output_flood_depth_raster_name,
-                                                                    master_output_shapefile_shp_name,
-                                                                    delete_flood_map_raster,
-                                                                    autoroute_job_name,
-                                                                    run_log_directory
-                                                                    ))
-                #For testing function serially
-                """
-                run_autoroute_multiprocess_worker((autoroute_executable_location,
-                                                   autoroute_manager,
-                                                   master_watershed_autoroute_input_directory,
-                                                   master_output_flood_map_raster_name,
-                                                   master_output_flood_depth_raster_name,
-                                                   master_output_shapefile_shp_name,
-                                                   delete_flood_map_raster,
-                                                   autoroute_job_name,
-                                                   run_log_directory))
-                """
-    if PREPARE_MODE > 0:
+        streamflow_job_list = []
+        for (master_watershed_autoroute_input_directory, stream_info_file, autoroute_job_name), \
+                stream_info_stages in zip(streamflow_folder_list, stream_info_stage_list):
+            streamflow_job_list.append((PREPARE_MODE,
+                                        master_watershed_autoroute_input_directory,
+                                        stream_info_file,
+                                        rapid_output_directory,
+                                        return_period_file,
+                                        return_period,
+                                        rapid_output_file,
+                                        date_peak_search_start,
+                                        date_peak_search_end,
+                                        river_id,
+                                        streamflow_id,
+                                        stream_network_shapefile,
+                                        peak_flow_cache_directory,
+                                        shared_streamflow_info,
+                                        stream_info_stages,
+                                        autoroute_job_name,
+                                        prepare_log_directory,
+                                        ))
+    if PREPARE_MODE > 0 and not pipeline_streamflow:
         #generate streamflow
-        streamflow_job_list = pool_streamflow.imap_unordered(prepare_autoroute_streamflow_multiprocess_worker,
-                                                             streamflow_job_list,
-                                                             chunksize=1)
-        for streamflow_job_output in streamflow_job_list:
-            print("STREAMFLOW READY: {0}".format(streamflow_job_output))
-        pool_streamflow.close()
-        pool_streamflow.join()
+        try:
+            streamflow_job_list = pool_streamflow.imap_unordered(prepare_autoroute_streamflow_multiprocess_worker,
+                                                                 streamflow_job_list,
+                                                                 chunksize=1)
+            for streamflow_job_output in streamflow_job_list:
+                print("STREAMFLOW READY: {0}".format(streamflow_job_output))
+            pool_streamflow.close()
+            pool_streamflow.join()
+        finally:
+            if shared_streamflow is not None:
+                shared_streamflow.close()
+                shared_streamflow.unlink()
         
     print("Running AutoRoute simulations ...")
     #submit jobs to run
-    if mode == "multiprocess":
+    if pipeline_streamflow:
+        def remove_shared_streamflow():
+            if shared_streamflow is not None:
+                shared_streamflow.close()
+                shared_streamflow.unlink()
+        #streamflow is prepared in the same pool as each simulation is submitted
+        try:
+            autoroute_job_info['multiprocess_worker_list'] = \
+                iter_in_background(run_autoroute_pipeline(pool_main,
+                                                          num_cpus,
+                                                          streamflow_job_list,
+                                                          autoroute_job_info['multiprocess_job_list']),
+                                   remove_shared_streamflow)
+        except Exception:
+            #the pipeline did not start
+            remove_shared_streamflow()
+            raise
+    elif mode == "multiprocess" and memory_budget:
+        memory_aware_scheduler = MemoryAwareScheduler(pool_main, num_cpus, memory_budget)
+        autoroute_job_info['multiprocess_worker_list'] = memory_aware_scheduler.imap(run_autoroute_multiprocess_worker,
+                                                                                    autoroute_job_info['multiprocess_job_list'],
+                                                                                    autoroute_job_info['multiprocess_job_size_list'])
+    elif mode == "multiprocess":
         autoroute_job_info['multiprocess_worker_list'] = pool_main.imap_unordered(run_autoroute_multiprocess_worker, 
                                                                                  autoroute_job_info['multiprocess_job_list'], 
                                                                                  chunksize=1)
@@ -319,8 +541,11 @@ def run_autoroute_multiprocess(autoroute_input_directory, #path to AutoRoute inp
     if wait_for_all_processes_to_finish:
         #wait for all of the jobs to complete
         if mode == "multiprocess":
+            multiprocess_job_output_list = []
             for multi_job_output in autoroute_job_info['multiprocess_worker_list']:
                 print("JOB FINISHED: {0}".format(multi_job_output[3]))
+                multiprocess_job_output_list.append(multi_job_output)
+            autoroute_job_info['multiprocess_worker_list'] = multiprocess_job_output_list
             #just in case ...
             pool_main.close()
             pool_main.join()
@@ -330,6 +555,151 @@ def run_autoroute_multiprocess(autoroute_input_directory, #path to AutoRoute inp
                 print("JOB FINISHED: {0}".format(autoroute_job_info['htcondor_job_info'][htcondor_job_index]['autoroute_job_name']))
     
         print("Time to complete entire AutoRoute process: {0}".format(datetime.utcnow()-time_start_all))
-    else:       
-        return autoroute_job_info
 
+    return autoroute_job_info
+
+def run_autoroute_return_periods_multiprocess(autoroute_watershed_list, #list of (AutoRoute input directory, output directory, return period file)
+                                              return_period_list, #return periods to run
+                                              log_directory, #path to multiprocessing logs
+                                              autoroute_executable_location="", #location of AutoRoute executable
+                                              autoroute_manager=None, #AutoRoute manager with default parameters
+                                              generate_flood_map_raster=True, #generate flood raster
+                                              generate_flood_depth_raster=False, #generate flood raster
+                                              generate_flood_map_shapefile=False, #generate a flood map shapefile
+                                              num_cpus=-17, #number of processes to use on computer
+                                              memory_budget=None, #bytes for AutoRoute simulations to run at once (memory-aware scheduling if set)
+                                              use_stage_cache=False, #skip simulations with outputs written from the same inputs
+                                              ):
+    """
+    Runs AutoRoute for multiple return periods in one batch. Each return
+    period file is read once per sub-directory to write a stream info file
+    for every return period (e.g. stream_info_return_period_20.txt). Then, all
+    (sub-directory, return period) simulations run in one pool.
+
+    Outputs go to a folder named after the return period in the output
+    directory of the watershed. Returns a list with a dictionary of the
+    outputs of each simulation.
+
+    If memory_budget is set, simulations are only started while their
+    estimated memory fits in the budget (see MemoryAwareScheduler).
+    """
+    time_start_all = datetime.utcnow()
+    if not generate_flood_depth_raster and not generate_flood_map_raster and not generate_flood_map_shapefile:
+        raise Exception("ERROR: Must set generate_flood_depth_raster, generate_flood_map_raster, or generate_flood_map_shapefile to True to proceed ...")
+
+    prepare_log_directory = os.path.join(log_directory, "prepare")
+    run_log_directory = os.path.join(log_directory, "run")
+    for multiprocess_log_directory in (prepare_log_directory, run_log_directory):
+        try:
+            os.makedirs(multiprocess_log_directory)
+        except OSError:
+            pass
+    print("Streamflow preparation logs can be found here: {0}".format(prepare_log_directory))
+    print("AutoRoute simulation logs can be found here: {0}".format(run_log_directory))
+
+    delete_flood_map_raster = False
+    if generate_flood_map_shapefile and not generate_flood_map_raster:
+        generate_flood_map_raster = True
+        delete_flood_map_raster = True
+
+    scenario_job_list = []
+    scenario_job_size_list = []
+    scenario_job_info = {}
+    prepare_job_list = []
+    prepare_job_size_list = []
+    for autoroute_input_directory, autoroute_output_directory, return_period_file in autoroute_watershed_list:
+        autoroute_watershed_name = os.path.basename(autoroute_input_directory)
+        for directory, master_watershed_autoroute_input_directory, stream_info_file, job_size in \
+                get_autoroute_input_subdirectories(autoroute_input_directory):
+            autoroute_job_name = "{0}-{1}".format(autoroute_watershed_name, directory)
+            prepare_job_list.append((master_watershed_autoroute_input_directory,
+                                     stream_info_file,
+                                     return_period_file,
+                                     return_period_list,
+                                     autoroute_job_name,
+                                     prepare_log_directory))
+            prepare_job_size_list.append(job_size)
+
+            output_shapefile_base_name = '{0}_{1}'.format(autoroute_watershed_name, directory)
+            for return_period in return_period_list:
+                master_watershed_autoroute_output_directory = os.path.join(autoroute_output_directory,
+                                                                           return_period)
+                try:
+                    os.makedirs(master_watershed_autoroute_output_directory)
+                except OSError:
+                    pass
+
+                master_output_flood_map_raster_name = ""
+                if generate_flood_map_raster:
+                    master_output_flood_map_raster_name = os.path.join(master_watershed_autoroute_output_directory,
+                                                                       'flood_map_raster_{0}.tif'.format(output_shapefile_base_name))
+                master_output_flood_depth_raster_name = ""
+                if generate_flood_depth_raster:
+                    master_output_flood_depth_raster_name = os.path.join(master_watershed_autoroute_output_directory,
+                                                                         'flood_depth_raster_{0}.tif'.format(output_shapefile_base_name))
+                master_output_shapefile_shp_name = ""
+                if generate_flood_map_shapefile:
+                    master_output_shapefile_shp_name = os.path.join(master_watershed_autoroute_output_directory,
+                                                                    '{0}.shp'.format(output_shapefile_base_name))
+
+                scenario_job_name = "{0}-{1}".format(autoroute_job_name, return_period)
+                scenario_job_list.append((autoroute_executable_location,
+                                          autoroute_manager,
+                                          master_watershed_autoroute_input_directory,
+                                          master_output_flood_map_raster_name,
+                                          master_output_flood_depth_raster_name,
+                                          master_output_shapefile_shp_name,
+                                          delete_flood_map_raster,
+                                          return_period,
+                                          use_stage_cache,
+                                          scenario_job_name,
+                                          run_log_directory))
+                scenario_job_size_list.append(job_size)
+                scenario_job_info[scenario_job_name] = {
+                                                         'autoroute_input_directory': autoroute_input_directory,
+                                                         'return_period': return_period,
+                                                         'output_directory': master_watershed_autoroute_output_directory,
+                                                         'output_flood_map_raster': master_output_flood_map_raster_name,
+                                                         'output_flood_depth_raster': master_output_flood_depth_raster_name,
+                                                         'output_shapefile': master_output_shapefile_shp_name,
+                                                         'job_name': scenario_job_name,
+                                                       }
+
+    #largest jobs of all watersheds first
+    prepare_job_list = sort_jobs_by_cost(prepare_job_list,
+                                         [get_estimated_job_cost(job_size) for job_size in prepare_job_size_list])
+    scenario_job_cost_list = [get_estimated_job_cost(job_size) for job_size in scenario_job_size_list]
+    scenario_job_list = sort_jobs_by_cost(scenario_job_list, scenario_job_cost_list)
+    scenario_job_size_list = sort_jobs_by_cost(scenario_job_size_list, scenario_job_cost_list)
+
+    if memory_budget:
+        num_cpus = get_valid_num_cpus(num_cpus, memory_per_cpu=None)
+        #one job per worker to measure the peak memory of each job
+        pool_main = multiprocessing.Pool(num_cpus, maxtasksperchild=1)
+    else:
+        num_cpus = get_valid_num_cpus(num_cpus)
+        pool_main = multiprocessing.Pool(num_cpus)
+
+    #write stream info file of each return period
+    for prepare_job_output in pool_main.imap_unordered(prepare_return_period_scenarios_multiprocess_worker,
+                                                       prepare_job_list,
+                                                       chunksize=1):
+        print("STREAMFLOW READY: {0}".format(prepare_job_output))
+
+    print("Running AutoRoute simulations ...")
+    if memory_budget:
+        scenario_worker_list = MemoryAwareScheduler(pool_main, num_cpus, memory_budget) \
+            .imap(run_autoroute_multiprocess_worker, scenario_job_list, scenario_job_size_list)
+    else:
+        scenario_worker_list = pool_main.imap_unordered(run_autoroute_multiprocess_worker,
+                                                        scenario_job_list,
+                                                        chunksize=1)
+    scenario_job_output_list = []
+    for multi_job_output in scenario_worker_list:
+        print("JOB FINISHED: {0}".format(multi_job_output[3]))
+        scenario_job_output_list.append(scenario_job_info[multi_job_output[3]])
+    pool_main.close()
+    pool_main.join()
+
+    print("Time to complete entire AutoRoute process: {0}".format(datetime.utcnow()-time_start_all))
+    return scenario_job_output_list
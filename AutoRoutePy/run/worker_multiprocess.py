@@ -8,12 +8,17 @@
 ##  License BSD 3-Clause
 
 import os
+from shutil import copy
 import sys
 
 #local imports
 from ..autoroute import AutoRoute 
+from ..prepare.stream_info import get_scenario_stream_info_file
 from ..utilities import case_insensitive_file_search
 
+#the whole file name must match so that side car files (e.g. .aux.xml) are not used
+VALID_RASTER_EXTENSIONS = "asc|bmp|dt2|img|jp2|j2c|j2k|jpeg|jpg2|jpg|png|tif|tiff"
+
 #------------------------------------------------------------------------------
 #MAIN PROCESS
 #------------------------------------------------------------------------------
@@ -23,10 +28,15 @@ def run_AutoRoute(autoroute_executable_location,
                   out_flood_map_raster_name,
                   out_flood_depth_raster_name,
                   out_shapefile_name="",
-                  delete_flood_raster=False):
+                  delete_flood_raster=False,
+                  scenario_name=""):
                       
     """
     Run AutoRoute with searching for inputs in directory
+
+    If scenario_name is set, the scenario stream info file is used and the
+    AutoRoute input file is written for the scenario so that scenarios of
+    the same directory can run at the same time.
     """
     #change working directory for python (this is for the input file produced to
     # prevent overwriting)
@@ -35,11 +45,9 @@ def run_AutoRoute(autoroute_executable_location,
     if not autoroute_manager:
         autoroute_manager = AutoRoute(autoroute_executable_location)
 
-    valid_raster_extensions = "asc|bmp|dt2|img|jp2|j2c|j2k|jpeg|jpg2|jpg|png|tif|tiff"
-    
     #get the raster for elevation    
     try:
-        elevation_raster = case_insensitive_file_search(autoroute_input_path, r'elevation\.(?:{})'.format(valid_raster_extensions))
+        elevation_raster = case_insensitive_file_search(autoroute_input_path, r'elevation\.(?:{0})$'.format(VALID_RASTER_EXTENSIONS))
     except IndexError:
         try:
             elevation_raster = case_insensitive_file_search(os.path.join(autoroute_input_path, 'elevation'), r'hdr\.adf')
@@ -50,30 +58,41 @@ def run_AutoRoute(autoroute_executable_location,
 
     #get the manning n raster
     try:
-        manning_n_raster = case_insensitive_file_search(autoroute_input_path, r'manning_n\.(?:{})'.format(valid_raster_extensions))
+        manning_n_raster = case_insensitive_file_search(autoroute_input_path, r'manning_n\.(?:{0})$'.format(VALID_RASTER_EXTENSIONS))
     except IndexError:
         manning_n_raster = ""
         print("Manning n raster not found. Ignoring this file ...")
         pass
 
     #autoroute input file
+    autoroute_run_input_file = ""
+    if scenario_name:
+        autoroute_run_input_file = os.path.join(autoroute_input_path,
+                                                "AUTOROUTE_INPUT_FILE_{0}.txt".format(scenario_name))
     try:
         autoroute_input_file = case_insensitive_file_search(autoroute_input_path, r'AUTOROUTE_INPUT_FILE\.TXT')
+        if autoroute_run_input_file:
+            #leave the shared input file as is for the other scenarios
+            copy(autoroute_input_file, autoroute_run_input_file)
+            autoroute_input_file = autoroute_run_input_file
         autoroute_manager.update_input_file(autoroute_input_file)
     except IndexError:
         print("AUTOROUTE_INPUT_FILE.txt not found. Ignoring this file ...")
         pass
 
+    stream_info_file = case_insensitive_file_search(autoroute_input_path, r'stream_info\.txt')
+    if scenario_name:
+        stream_info_file = get_scenario_stream_info_file(stream_info_file, scenario_name)
         
     autoroute_manager.update_parameters(dem_raster_file_path=elevation_raster,
-                                        stream_info_file_path=case_insensitive_file_search(autoroute_input_path, r'stream_info\.txt'),
+                                        stream_info_file_path=stream_info_file,
                                         out_flood_map_raster_path=out_flood_map_raster_name,
                                         out_flood_depth_raster_path=out_flood_depth_raster_name,
                                         out_flood_map_shapefile_path=out_shapefile_name,
                                         manning_n_raster_file_path=manning_n_raster
                                         )
                          
-    autoroute_manager.run_autoroute()
+    autoroute_manager.run_autoroute(autoroute_run_input_file)
 
     if delete_flood_raster:
         try:
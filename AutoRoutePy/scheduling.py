@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+##
+##  scheduling.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+from collections import deque
+import os
+import sys
+import threading
+import traceback
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+RESOURCE_ENABLED = False
+try:
+    from resource import getrusage, RUSAGE_CHILDREN, RUSAGE_SELF
+    RESOURCE_ENABLED = True
+except ImportError:
+    print("resource unable to be imported. Memory use of jobs will not be"
+          " measured to calibrate the memory estimates (not available on Windows).")
+    pass
+
+import numpy as np
+from osgeo import gdal
+
+#local imports
+from .utilities import get_available_memory
+
+#----------------------------------------------------------------------------------------
+# JOB COST FUNCTIONS
+#----------------------------------------------------------------------------------------
+def get_raster_num_cells(raster_file):
+    """
+    Gets the number of cells in the raster from its header (0 if unreadable)
+    """
+    try:
+        raster_ds = gdal.Open(raster_file)
+    except RuntimeError:
+        return 0
+    if raster_ds is None:
+        return 0
+    num_cells = raster_ds.RasterXSize * raster_ds.RasterYSize
+    raster_ds = None
+    return num_cells
+
+def get_stream_info_num_cells(stream_info_file, sample_size=65536):
+    """
+    Gets the number of stream cells in the stream info file
+    (from the binary sidecar if current, otherwise estimated
+    from the line length of the start of the file; 0 if missing)
+    """
+    if not stream_info_file or not os.path.exists(stream_info_file):
+        return 0
+    #binary sidecar of StreamInfoTable (imported here to avoid a circular import)
+    from .prepare.stream_info import StreamInfoTable
+    if StreamInfoTable.sidecar_is_current(stream_info_file):
+        return len(np.load(StreamInfoTable.get_sidecar_file(stream_info_file), mmap_mode='r'))
+
+    with open(stream_info_file, 'rb') as infile:
+        sample = infile.read(sample_size)
+    num_sample_lines = sample.count(b'\n')
+    if len(sample) < sample_size or num_sample_lines <= 1:
+        #whole file read (minus header)
+        return max(0, num_sample_lines - 1)
+    return int(os.path.getsize(stream_info_file) * num_sample_lines / float(len(sample)))
+
+def get_job_size(dem_file, stream_info_file=""):
+    """
+    Gets the size of an AutoRoute job as (DEM cells, stream cells)
+    """
+    return get_raster_num_cells(dem_file), get_stream_info_num_cells(stream_info_file)
+
+def get_estimated_job_cost(job_size, stream_cell_weight=100):
+    """
+    Gets the estimated cost of an AutoRoute job from the number of DEM cells
+    and stream cells (each stream cell samples a cross section of the DEM)
+    """
+    num_dem_cells, num_stream_cells = job_size
+    return num_dem_cells + stream_cell_weight * num_stream_cells
+
+def sort_jobs_by_cost(job_list, job_cost_list):
+    """
+    Sorts jobs with the largest estimated cost first so the longest jobs
+    do not start last (ties keep their order)
+    """
+    job_order = sorted(range(len(job_list)), key=lambda job_index: -job_cost_list[job_index])
+    return [job_list[job_index] for job_index in job_order]
+
+#----------------------------------------------------------------------------------------
+# MEMORY-AWARE SCHEDULING
+#----------------------------------------------------------------------------------------
+def get_peak_memory():
+    """
+    Gets the peak resident memory in bytes of this process and its
+    finished child processes (e.g. the AutoRoute executable)
+    """
+    if not RESOURCE_ENABLED:
+        return 0
+    peak_memory = max(getrusage(RUSAGE_SELF).ru_maxrss,
+                      getrusage(RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == 'darwin':
+        #already in bytes
+        return peak_memory
+    return peak_memory * 1024
+
+def run_job_with_peak_memory(args):
+    """
+    Runs the job in a pool worker and returns (output, peak memory, error)
+    (the worker is only used for one job to measure its peak memory)
+    """
+    job_function, job_args = args
+    try:
+        return job_function(job_args), get_peak_memory(), None
+    except Exception:
+        return None, get_peak_memory(), traceback.format_exc()
+
+def apply_job_async(pool, job_function, job_args, finished_queue, job_key):
+    """
+    Submit the job to the pool and put (job_key, (output, peak memory, error))
+    in the finished queue when it finishes
+    """
+    apply_kwargs = {}
+    if sys.version_info[0] >= 3:
+        apply_kwargs['error_callback'] = lambda job_exception: \
+            finished_queue.put((job_key, (None, 0, repr(job_exception))))
+    pool.apply_async(run_job_with_peak_memory,
+                     ((job_function, job_args),),
+                     callback=lambda job_output: finished_queue.put((job_key, job_output)),
+                     **apply_kwargs)
+
+class MemoryAwareScheduler(object):
+    """
+    This class runs jobs in a multiprocessing pool only while the estimated
+    memory of the running jobs fits in the memory budget. The estimate
+    from the number of DEM and stream cells of a job is calibrated with
+    the peak memory of finished jobs.
+
+    The pool should be created with maxtasksperchild=1 so the peak memory
+    of each worker is the peak memory of one job.
+    """
+    def __init__(self, pool, max_num_jobs, memory_budget=None,
+                 base_memory=200e6, memory_per_dem_cell=24.0,
+                 memory_per_stream_cell=2000.0, num_calibration_jobs=20):
+        """
+        Initialize the class with variables given by the user
+        (memory_budget in bytes defaults to 80% of the available memory)
+        """
+        self.pool = pool
+        self.max_num_jobs = max_num_jobs
+        if not memory_budget:
+            memory_budget = 0.8 * get_available_memory()
+        self.memory_budget = memory_budget
+        self.base_memory = base_memory
+        self.memory_per_dem_cell = memory_per_dem_cell
+        self.memory_per_stream_cell = memory_per_stream_cell
+        self.num_calibration_jobs = num_calibration_jobs
+        self.calibration_ratios = []
+
+    @property
+    def calibration_factor(self):
+        """
+        Largest ratio of peak memory to estimated memory of recent jobs
+        """
+        if not self.calibration_ratios:
+            return 1.0
+        return max(self.calibration_ratios[-self.num_calibration_jobs:])
+
+    def get_uncalibrated_memory(self, job_size):
+        """
+        Estimated memory of a job of size (DEM cells, stream cells)
+        before calibration
+        """
+        num_dem_cells, num_stream_cells = job_size
+        return self.base_memory + \
+            self.memory_per_dem_cell * num_dem_cells + \
+            self.memory_per_stream_cell * num_stream_cells
+
+    def get_estimated_memory(self, job_size):
+        """
+        Estimated memory of a job of size (DEM cells, stream cells)
+        """
+        return self.calibration_factor * self.get_uncalibrated_memory(job_size)
+
+    def calibrate(self, job_size, peak_memory):
+        """
+        Calibrate the memory estimate with the peak memory of a finished job
+        """
+        if peak_memory > 0:
+            self.calibration_ratios.append(peak_memory / float(self.get_uncalibrated_memory(job_size)))
+
+    def imap(self, job_function, job_list, job_size_list):
+        """
+        Run the jobs (in order of the list when they fit) and yield the
+        output of each job as it finishes
+        """
+        finished_queue = Queue()
+        pending_jobs = list(zip(job_list, job_size_list))
+        running_jobs = {}
+        job_id = 0
+        while pending_jobs or running_jobs:
+            #admit the first pending jobs that fit in the memory budget
+            running_memory = sum([self.get_estimated_memory(job_size)
+                                  for job_size in running_jobs.values()])
+            pending_index = 0
+            while pending_index < len(pending_jobs) and len(running_jobs) < self.max_num_jobs:
+                job_args, job_size = pending_jobs[pending_index]
+                job_memory = self.get_estimated_memory(job_size)
+                if running_jobs and running_memory + job_memory > self.memory_budget:
+                    pending_index += 1
+                    continue
+                if job_memory > self.memory_budget:
+                    print("WARNING: Estimated memory of job ({0:.2f} GB) exceeds memory " \
+                          "budget ({1:.2f} GB). Running it alone ...".format(job_memory*1e-9,
+                                                                            self.memory_budget*1e-9))
+                del pending_jobs[pending_index]
+                job_id += 1
+                running_jobs[job_id] = job_size
+                running_memory += job_memory
+                apply_job_async(self.pool, job_function, job_args, finished_queue, job_id)
+
+            #wait for a job to finish
+            finished_job_id, (job_output, peak_memory, job_error) = finished_queue.get()
+            self.calibrate(running_jobs.pop(finished_job_id), peak_memory)
+            if job_error is not None:
+                raise Exception("ERROR: Job failed ...\n{0}".format(job_error))
+            yield job_output
+
+#----------------------------------------------------------------------------------------
+# PIPELINED SCHEDULING
+#----------------------------------------------------------------------------------------
+def imap_pipeline(pool, max_num_jobs, prepare_function, prepare_job_list,
+                  run_function, run_job_list):
+    """
+    Run the prepare stage and then the run stage of each job in the pool
+    without waiting for the prepare stage of the other jobs and yield
+    ('prepare', output) or ('run', output) as each stage finishes
+
+    At most max_num_jobs stages are in the pool at once and jobs ready
+    to run are submitted before the prepare stage of new jobs.
+    """
+    if len(prepare_job_list) != len(run_job_list):
+        raise Exception("ERROR: Number of prepare jobs and run jobs must match ...")
+
+    finished_queue = Queue()
+    pending_prepare_jobs = deque(range(len(prepare_job_list)))
+    ready_run_jobs = deque()
+    num_running_jobs = 0
+    while pending_prepare_jobs or ready_run_jobs or num_running_jobs > 0:
+        while num_running_jobs < max_num_jobs and (ready_run_jobs or pending_prepare_jobs):
+            if ready_run_jobs:
+                job_index = ready_run_jobs.popleft()
+                apply_job_async(pool, run_function, run_job_list[job_index],
+                                finished_queue, ('run', job_index))
+            else:
+                job_index = pending_prepare_jobs.popleft()
+                apply_job_async(pool, prepare_function, prepare_job_list[job_index],
+                                finished_queue, ('prepare', job_index))
+            num_running_jobs += 1
+
+        #wait for a stage to finish
+        (job_stage, job_index), (job_output, peak_memory, job_error) = finished_queue.get()
+        num_running_jobs -= 1
+        if job_error is not None:
+            raise Exception("ERROR: Job failed ...\n{0}".format(job_error))
+        if job_stage == 'prepare':
+            ready_run_jobs.append(job_index)
+        yield job_stage, job_output
+
+def iter_in_background(job_iterator, finish_function=None):
+    """
+    Iterate over the job iterator (e.g. imap_pipeline) in a background
+    thread so its jobs are scheduled right away and return an iterator
+    over its outputs as they are ready. finish_function is called when
+    the job iterator is done (or fails) even if the outputs are never read.
+    """
+    output_queue = Queue()
+
+    def run_job_iterator():
+        try:
+            for job_output in job_iterator:
+                output_queue.put((True, job_output, None))
+            output_queue.put((False, None, None))
+        except Exception as ex:
+            output_queue.put((False, None, ex))
+        finally:
+            if finish_function is not None:
+                finish_function()
+
+    job_thread = threading.Thread(target=run_job_iterator)
+    job_thread.start()
+
+    def iter_outputs():
+        while True:
+            has_output, job_output, job_error = output_queue.get()
+            if job_error is not None:
+                raise job_error
+            if not has_output:
+                break
+            yield job_output
+        job_thread.join()
+
+    return iter_outputs()
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+##
+##  stage_cache.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License: BSD-3 Clause
+
+from glob import glob
+import hashlib
+import json
+import os
+
+#local imports
+from .utilities import get_cache_key, get_file_identity
+
+#name of the stage record next to the first output of a stage (hidden so
+#searches for input files and globs of output shapefiles skip it)
+STAGE_RECORD_FILE_NAME = ".{0}_stages.json"
+
+#files read with a shapefile
+SHAPEFILE_EXTENSIONS = ('.shp', '.shx', '.dbf', '.prj')
+
+#content digests by file identity (path, size, modification time) in this process
+_FILE_DIGESTS = {}
+
+#----------------------------------------------------------------------------------------
+# DIGEST FUNCTIONS
+#----------------------------------------------------------------------------------------
+def get_file_paths_to_digest(file_path):
+    """
+    Gets the files holding the content of the input
+    (all files of a directory, the files of a shapefile)
+    """
+    if os.path.isdir(file_path):
+        return sorted([os.path.join(root_directory, file_name)
+                       for root_directory, directory_names, file_names in os.walk(file_path)
+                       for file_name in file_names])
+    file_base, file_extension = os.path.splitext(file_path)
+    if file_extension.lower() == '.shp':
+        return sorted([shapefile_file for shapefile_file in glob("{0}.*".format(file_base))
+                       if os.path.splitext(shapefile_file)[1].lower() in SHAPEFILE_EXTENSIONS])
+    return [file_path]
+
+def get_file_digest(file_path, block_size=2**20):
+    """
+    Gets the digest of the content of the file (or directory, or shapefile)
+    ("" if it does not exist). The digest is computed once per process
+    while the files keep the same size and modification time.
+    """
+    if not file_path or not os.path.exists(file_path):
+        return ""
+    file_paths = get_file_paths_to_digest(file_path)
+    file_identities = tuple([get_file_identity(path) for path in file_paths])
+    if file_identities not in _FILE_DIGESTS:
+        file_hash = hashlib.sha1()
+        for path in file_paths:
+            file_hash.update(os.path.relpath(path, os.path.dirname(file_path)).encode("utf-8"))
+            with open(path, 'rb') as infile:
+                for file_block in iter(lambda: infile.read(block_size), b''):
+                    file_hash.update(file_block)
+        _FILE_DIGESTS[file_identities] = file_hash.hexdigest()
+    return _FILE_DIGESTS[file_identities]
+
+def get_input_digests(input_files):
+    """
+    Gets the {input file: digest} of inputs shared by many stages
+    (computed once in the main process and passed to the workers
+    so large inputs are not read again by each worker)
+    """
+    return dict([(input_file, get_file_digest(input_file))
+                 for input_file in input_files if input_file])
+
+def get_stage_digest(stage_name, previous_stage_digest="", input_files=(), parameters=(),
+                     input_digests=None):
+    """
+    Gets the digest of a stage from the digest of the stage before it,
+    the content of its input files and its parameters
+    (the digests in input_digests are used for the input files in it)
+    """
+    if input_digests is None:
+        input_digests = {}
+    return get_cache_key(stage_name,
+                         previous_stage_digest,
+                         [input_digests[input_file] if input_file in input_digests
+                          else get_file_digest(input_file)
+                          for input_file in input_files],
+                         parameters)
+
+def get_output_digest(output_file):
+    """
+    Gets the digest of the last stage that wrote the output file if its
+    record is current (otherwise the digest of the content of the file)
+    """
+    stage_list = StageRecord([output_file]).read()
+    if stage_list:
+        return stage_list[-1][1]
+    return get_file_digest(output_file)
+
+#----------------------------------------------------------------------------------------
+# STAGE RECORD CLASS
+#----------------------------------------------------------------------------------------
+class StageRecord(object):
+    """
+    This class records the (stage name, digest) of the stages that wrote
+    the outputs of a step next to the first output (.<output name>_stages.json)
+    with the size and modification time of each output. Stages that write
+    to the same file (e.g. slope and streamflow in the stream info file)
+    are recorded in order, so the stages after the last current stage
+    are the only ones to run again.
+    """
+    def __init__(self, output_files):
+        """
+        Initialize the class with variables given by the user
+        """
+        self.output_files = [output_file for output_file in output_files if output_file]
+        if not self.output_files:
+            raise Exception("ERROR: Stage record needs at least one output file ...")
+        output_directory, output_file_name = os.path.split(self.output_files[0])
+        self.record_file = os.path.join(output_directory,
+                                        STAGE_RECORD_FILE_NAME.format(os.path.splitext(output_file_name)[0]))
+
+    def get_output_identities(self):
+        """
+        Gets the [size, modification time] of each output
+        (None if an output is missing)
+        """
+        output_identities = []
+        for output_file in self.output_files:
+            try:
+                file_stat = os.stat(output_file)
+            except OSError:
+                return None
+            output_identities.append([file_stat.st_size, file_stat.st_mtime])
+        return output_identities
+
+    def read(self):
+        """
+        Reads the [(stage name, digest), ...] of the outputs
+        (empty if there is no record or the outputs changed after it)
+        """
+        try:
+            with open(self.record_file) as record:
+                stage_record = json.load(record)
+        except (IOError, OSError, ValueError):
+            return []
+        if stage_record.get('outputs') != self.get_output_identities():
+            return []
+        return [tuple(stage) for stage in stage_record.get('stages', [])]
+
+    def get_num_current_stages(self, stage_list):
+        """
+        Gets the number of stages at the start of the stage list
+        that match the record of the outputs (the stages after them run
+        again and must write over the other recorded stages, otherwise
+        no stage is current)
+        """
+        recorded_stage_list = self.read()
+        stage_list = [tuple(stage) for stage in stage_list]
+        num_current_stages = 0
+        for recorded_stage, stage in zip(recorded_stage_list, stage_list):
+            if recorded_stage != stage:
+                break
+            num_current_stages += 1
+        stage_names_to_run = set([stage_name for stage_name, digest
+                                  in stage_list[num_current_stages:]])
+        for stage_name, digest in recorded_stage_list[num_current_stages:]:
+            if stage_name not in stage_names_to_run:
+                return 0
+        return num_current_stages
+
+    def is_current(self, stage_list):
+        """
+        Checks if the outputs were written by the stages in the list
+        """
+        return self.read() == [tuple(stage) for stage in stage_list]
+
+    def invalidate(self):
+        """
+        Removes the record before the outputs are written again
+        """
+        try:
+            os.remove(self.record_file)
+        except OSError:
+            pass
+
+    def write(self, stage_list):
+        """
+        Records the stages that wrote the outputs
+        """
+        output_identities = self.get_output_identities()
+        if output_identities is None:
+            print("Outputs missing. Skipping stage record: {0}".format(self.record_file))
+            return
+        temp_record_file = "{0}_{1}_temp".format(self.record_file, os.getpid())
+        with open(temp_record_file, 'w') as record:
+            json.dump({'stages': [list(stage) for stage in stage_list],
+                       'outputs': output_identities}, record)
+        os.rename(temp_record_file, self.record_file)
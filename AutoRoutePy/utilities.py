@@ -7,6 +7,8 @@
 ##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
 ##  License: BSD-3 Clause
 
+from glob import glob
+import hashlib
 from multiprocessing import cpu_count
 import os
 import re
@@ -47,6 +49,43 @@ def case_insensitive_file_search(directory, pattern):
         print(pattern, "not found")
         raise
 
+def get_file_identity(file_path):
+    """
+    Gets the identity of a file (absolute path, size, modification time)
+    """
+    file_stat = os.stat(file_path)
+    return (os.path.abspath(file_path), file_stat.st_size, file_stat.st_mtime)
+
+def get_cache_key(*key_parts):
+    """
+    Gets a hash digest to name a cache entry from the parts of its key
+    """
+    return hashlib.sha1(repr(key_parts).encode("utf-8")).hexdigest()
+
+def evict_cache_files(cache_directory, max_cache_size, pattern="*"):
+    """
+    Removes the least recently used files matching the pattern
+    until the cache directory is within max_cache_size bytes
+    """
+    cache_files = []
+    for cache_file in glob(os.path.join(cache_directory, pattern)):
+        try:
+            cache_file_stat = os.stat(cache_file)
+        except OSError:
+            continue
+        cache_files.append((cache_file_stat.st_mtime, cache_file_stat.st_size, cache_file))
+
+    cache_size = sum([cache_file[1] for cache_file in cache_files])
+    for cache_file_mtime, cache_file_size, cache_file in sorted(cache_files):
+        if cache_size <= max_cache_size:
+            break
+        try:
+            os.remove(cache_file)
+            cache_size -= cache_file_size
+            print("Removed from cache: {0}".format(cache_file))
+        except OSError:
+            pass
+
 def get_valid_watershed_list(input_directory):
     """
     Get a list of folders formatted correctly for watershed-subbasin
@@ -69,14 +108,26 @@ def get_watershed_subbasin_from_folder(folder_name):
     subbasin = input_folder_split[1].lower()
     return watershed, subbasin
     
-def get_valid_num_cpus(num_cpus):
+def get_available_memory(default_memory=2e9):
+    """
+    Retrieves the available memory in bytes (default_memory if psutil is not installed)
+    """
+    try:
+        return virtual_memory().available
+    except NameError:
+        return default_memory
+
+def get_valid_num_cpus(num_cpus, memory_per_cpu=3e9):
     """
     Retrieves the valid number of cpus based on computer specs
+    (memory_per_cpu=None when memory is managed by a MemoryAwareScheduler)
     """
     #set number of cpus to use (recommended 3 GB per cpu)
     total_cpus = cpu_count()
-    mem = virtual_memory()
-    recommended_max_num_cpus = max(1, int(mem.total  * 1e-9 / 3))
+    recommended_max_num_cpus = total_cpus
+    if memory_per_cpu:
+        mem = virtual_memory()
+        recommended_max_num_cpus = max(1, int(mem.total / memory_per_cpu))
     if num_cpus <= 0:
         num_cpus = total_cpus
         num_cpus = min(recommended_max_num_cpus, total_cpus)
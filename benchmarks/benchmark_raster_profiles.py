@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+##
+##  benchmark_raster_profiles.py
+##  AutoRoutePy
+##
+##  Created by Alan D. Snow.
+##  Copyright © 2015-2016 Alan D Snow. All rights reserved.
+##  License BSD 3-Clause
+"""
+Benchmark the write time and file size of the raster creation profiles
+on DEM tile sizes (e.g. 1201 and 3601 for 3 and 1 arc-second tiles).
+
+    python benchmarks/benchmark_raster_profiles.py --tile_sizes 1201 3601
+"""
+from argparse import ArgumentParser
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+import time
+
+import numpy as np
+from osgeo import gdal
+
+from AutoRoutePy.prepare.raster_profiles import (get_raster_creation_options,
+                                                 RASTER_CREATION_PROFILES)
+
+def get_benchmark_arrays(tile_size):
+    ''' Synthetic rasters written by the package for a DEM tile
+
+        @rtype:  C{list}
+        @return: [(name, GDAL data type, array), ...]
+        '''
+    random_state = np.random.RandomState(0)
+    #stream raster: sparse stream ids on nodata
+    stream_raster = np.full((tile_size, tile_size), -9999, dtype=np.int32)
+    num_stream_cells = tile_size * tile_size // 50
+    stream_raster.flat[random_state.randint(0, tile_size*tile_size, num_stream_cells)] = \
+        random_state.randint(1, 10000, num_stream_cells)
+    #land use: patches of land use classes
+    num_patches = max(1, tile_size // 32)
+    land_use_raster = np.kron(random_state.randint(11, 95, (num_patches, num_patches)),
+                              np.ones((32, 32))).astype(np.int32)
+    land_use_raster = np.pad(land_use_raster,
+                             ((0, tile_size - land_use_raster.shape[0]),
+                              (0, tile_size - land_use_raster.shape[1])),
+                             mode='edge')
+    #Manning's n: patches of Manning's n values
+    manning_n_raster = (land_use_raster / 1000.0).astype(np.float32)
+    return [("stream", gdal.GDT_Int32, stream_raster),
+            ("land_use", gdal.GDT_Int32, land_use_raster),
+            ("manning_n", gdal.GDT_Float32, manning_n_raster)]
+
+def benchmark_raster_write(raster_path, data_type, array, creation_options):
+    ''' Write the array to a GeoTIFF
+
+        @rtype:  C{tuple}
+        @return: (write time in seconds, file size in bytes)
+        '''
+    time_start = time.time()
+    target_ds = gdal.GetDriverByName('GTiff').Create(raster_path,
+                                                     array.shape[1],
+                                                     array.shape[0],
+                                                     1, data_type,
+                                                     options=creation_options)
+    target_ds.SetGeoTransform((-90.0, 1.0/array.shape[1], 0, 35.0, 0, -1.0/array.shape[0]))
+    band = target_ds.GetRasterBand(1)
+    band.SetNoDataValue(-9999)
+    band.WriteArray(array)
+    target_ds.FlushCache()
+    target_ds = None
+    return time.time() - time_start, os.path.getsize(raster_path)
+
+def run_benchmark(tile_sizes, num_threads=1, block_size=256):
+    '''
+    Print the write time and file size of each raster and profile
+    '''
+    output_directory = mkdtemp()
+    try:
+        print("{0:>9} {1:>10} {2:>13} {3:>10} {4:>12}".format("tile_size", "raster",
+                                                             "profile", "time_s", "size_MB"))
+        for tile_size in tile_sizes:
+            for raster_name, data_type, array in get_benchmark_arrays(tile_size):
+                for profile in sorted(RASTER_CREATION_PROFILES):
+                    if profile == 'float' and data_type != gdal.GDT_Float32:
+                        continue
+                    if profile == 'integer' and data_type == gdal.GDT_Float32:
+                        continue
+                    raster_path = os.path.join(output_directory,
+                                               "{0}_{1}_{2}.tif".format(raster_name,
+                                                                        profile,
+                                                                        tile_size))
+                    creation_options = get_raster_creation_options(profile,
+                                                                   block_size=block_size,
+                                                                   num_threads=num_threads)
+                    write_time, file_size = benchmark_raster_write(raster_path, data_type,
+                                                                   array, creation_options)
+                    print("{0:>9} {1:>10} {2:>13} {3:>10.3f} {4:>12.2f}".format(tile_size,
+                                                                               raster_name,
+                                                                               profile,
+                                                                               write_time,
+                                                                               file_size/1e6))
+                    os.remove(raster_path)
+    finally:
+        rmtree(output_directory)
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark raster creation profiles")
+    parser.add_argument('--tile_sizes', type=int, nargs='+', default=[1201, 3601],
+                        help="Number of rows and columns of the DEM tiles")
+    parser.add_argument('--num_threads', default=1,
+                        help="Threads used to compress (e.g. 4 or ALL_CPUS)")
+    parser.add_argument('--block_size', type=int, default=256,
+                        help="Width and height of the tiles")
+    args = parser.parse_args()
+    run_benchmark(args.tile_sizes, args.num_threads, args.block_size)
@@ -8,13 +8,47 @@
 ##
 
 from filecmp import cmp as fcmp
-from nose.tools import ok_
+from netCDF4 import Dataset
+from nose.tools import assert_raises, ok_
+import multiprocessing
+import numpy as np
 import numpy.testing as npt
 import os
-from osgeo import gdal
-from shutil import copy
+import threading
+from osgeo import gdal, osr
+from shutil import copy, rmtree
 
-from AutoRoutePy.prepare import AutoRoutePrepare
+from AutoRoutePy.prepare import AutoRoutePrepare, StreamInfoTable
+from AutoRoutePy.scheduling import (get_stream_info_num_cells,
+                                   imap_pipeline,
+                                   iter_in_background,
+                                   MemoryAwareScheduler,
+                                   sort_jobs_by_cost)
+from AutoRoutePy.stage_cache import (get_file_digest, get_input_digests,
+                                    get_stage_digest, StageRecord)
+from AutoRoutePy.prepare import prepare as prepare_module
+from AutoRoutePy.prepare.prepare import (EnsembleStatistic,
+                                         get_river_chunk_size,
+                                         iter_ecmwf_ensemble_hydrographs,
+                                         remove_raster,
+                                         RunningEnsembleStatistic,
+                                         VALID_STATISTIC_METHODS)
+from AutoRoutePy.prepare.footprint import get_densified_extent
+from AutoRoutePy.prepare.land_use_cache import LAND_USE_CACHE_FILE_PREFIX, LandUseWarpCache
+from AutoRoutePy.prepare.manning_n import get_manning_n_lookup, read_manning_n_table
+from AutoRoutePy.prepare.organize_dem import get_balanced_tile_windows
+from AutoRoutePy.prepare.peak_flow_cache import PeakFlowCache
+from AutoRoutePy.prepare.prepare_multiprocess import (get_streamflow_stage_digest,
+                                                      get_streamflow_stages)
+from AutoRoutePy.prepare.raster_profiles import get_raster_creation_options
+from AutoRoutePy.prepare.reproject_raster import reproject_lu_raster, warp_land_use_raster
+from AutoRoutePy.prepare.shared_streamflow import SharedStreamflow
+from AutoRoutePy.prepare.stream_direction import get_stream_info_block
+from AutoRoutePy.prepare.stream_info import render_stream_info_file
+from AutoRoutePy.prepare.stream_network_index import StreamNetworkIndex
+from AutoRoutePy.prepare.stream_network_partition import (get_tile_stream_network_file,
+                                                          TILE_STREAM_NETWORK_FILE_NAME)
+from AutoRoutePy.run.run_multiprocess import get_elevation_dem_file
 
 def test_rasterize_stream_shapefile():
     """
@@ -54,6 +88,580 @@ def test_rasterize_stream_shapefile():
     except OSError:
         pass
 
+def test_rasterize_stream_shapefile_in_memory():
+    """
+    Checks rasterizing stream shapefile to GDAL memory
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    
+    original_data_path = os.path.join(main_tests_folder, 'original')
+
+    arp = AutoRoutePrepare("autoroute_exe_path_dummy",
+                           os.path.join(original_data_path, 'elevation.asc'),
+                           "dummy_stream_info_path",
+                           os.path.join(original_data_path, 'drainage_line.shp'))
+    
+    out_rasterized_streamfile = '/vsimem/rasterized_streamfile.tif'
+    arp.rasterize_stream_shapefile(out_rasterized_streamfile, 'COMID',
+                                   creation_options=get_raster_creation_options('scratch'))
+    
+    original_rasterized_streamfile = os.path.join(original_data_path, 'rasterized_streamfile_solution.tif')
+    npt.assert_almost_equal(gdal.Open(original_rasterized_streamfile).ReadAsArray(),
+                            gdal.Open(out_rasterized_streamfile).ReadAsArray())
+
+    remove_raster(out_rasterized_streamfile)
+
+
+def test_generate_stream_info_file_from_raster():
+    """
+    Checks generating stream info file from stream raster without the
+    AutoRoute prepare executable
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    
+    original_data_path = os.path.join(main_tests_folder, 'original')
+    output_data_path = os.path.join(main_tests_folder, 'output')
+
+    stream_info_file = os.path.join(output_data_path, 'stream_info.txt')
+    arp = AutoRoutePrepare("", "", stream_info_file)
+    arp.generate_stream_info_file_from_raster(os.path.join(original_data_path,
+                                                           'rasterized_streamfile_solution.tif'),
+                                              search_radius=1,
+                                              block_size=100)
+
+    original_stream_info_table = StreamInfoTable.read(os.path.join(original_data_path,
+                                                                   'stream_info.txt'))
+    stream_info_table = StreamInfoTable.read(stream_info_file)
+    for column_name in ('DEM_1D_Index', 'Row', 'Col', 'StreamID'):
+        npt.assert_array_equal(original_stream_info_table.table[column_name],
+                               stream_info_table.table[column_name])
+    npt.assert_almost_equal(original_stream_info_table.table['StreamDirection'],
+                            stream_info_table.table['StreamDirection'],
+                            decimal=6)
+
+    try:
+        os.remove(stream_info_file)
+    except OSError:
+        pass
+
+def test_get_stream_info_block():
+    """
+    Checks stream direction of stream cells in block of stream raster
+    """
+    stream_id_block = np.zeros((5, 5), dtype=np.int32)
+    stream_id_block[0, :] = 1
+    stream_id_block[range(1, 5), range(3, -1, -1)] = 2
+    stream_id_block[2:, 4] = 3
+
+    stream_info_table = get_stream_info_block(stream_id_block, search_radius=1,
+                                              block_first_row=10, first_row=1)
+    npt.assert_array_equal(stream_info_table.table['Row'], [11, 12, 12, 13, 13, 14, 14])
+    npt.assert_array_equal(stream_info_table.table['Col'], [3, 2, 4, 1, 4, 0, 4])
+    npt.assert_array_equal(stream_info_table.table['DEM_1D_Index'],
+                           stream_info_table.table['Row'] * 5 + stream_info_table.table['Col'])
+    npt.assert_array_equal(stream_info_table.stream_id, [2, 2, 3, 2, 3, 2, 3])
+    npt.assert_almost_equal(stream_info_table.table['StreamDirection'],
+                            [np.pi/4, np.pi/4, 0, np.pi/4, 0, np.pi/4, 0],
+                            decimal=5)
+
+
+def test_manning_n_lookup():
+    """
+    Checks reading Manning's n table into lookup array
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    manning_n_table = os.path.join(main_tests_folder, 'output', 'manning_n_table.txt')
+    with open(manning_n_table, 'w') as outfile:
+        outfile.write("LC_ID\tDescription\tManning_n\n"
+                      "11\tOpen Water\t0.030\n"
+                      "21\tDeveloped, Open Space\t0.013\n"
+                      "41\tDeciduous Forest\t0.100\n")
+
+    land_use_classes, manning_n_values = read_manning_n_table(manning_n_table)
+    npt.assert_array_equal(land_use_classes, [11, 21, 41])
+    npt.assert_almost_equal(manning_n_values, [0.03, 0.013, 0.1])
+
+    lookup, min_land_use_class = get_manning_n_lookup(land_use_classes,
+                                                      manning_n_values,
+                                                      0.035)
+    ok_(min_land_use_class == 11)
+    npt.assert_almost_equal(np.take(lookup, np.array([11, 21, 31, 41]) - min_land_use_class),
+                            [0.03, 0.013, 0.035, 0.1])
+
+    os.remove(manning_n_table)
+
+
+def test_raster_creation_options():
+    """
+    Checks raster creation profiles
+    """
+    creation_options = get_raster_creation_options('float', block_size=512, num_threads=4)
+    ok_("TILED=YES" in creation_options)
+    ok_("BLOCKXSIZE=512" in creation_options)
+    ok_("BLOCKYSIZE=512" in creation_options)
+    ok_("BIGTIFF=IF_SAFER" in creation_options)
+    ok_("PREDICTOR=3" in creation_options)
+    ok_("NUM_THREADS=4" in creation_options)
+    ok_(not any(option.startswith("COMPRESS")
+                for option in get_raster_creation_options('uncompressed')))
+    assert_raises(Exception, get_raster_creation_options, 'invalid')
+    assert_raises(Exception, get_raster_creation_options, 'float', block_size=100)
+
+
+def test_balanced_tile_windows():
+    """
+    Checks splitting DEM blocks into tiles by stream cell count
+    """
+    stream_cell_counts = np.zeros((8, 8), dtype=np.int64)
+    stream_cell_counts[0:2, 0:2] = 100
+    stream_cell_counts[5, 6] = 50
+
+    ok_(get_balanced_tile_windows(stream_cell_counts, 1000) == [(0, 8, 0, 8)])
+
+    tile_windows = get_balanced_tile_windows(stream_cell_counts, 120)
+    tile_coverage = np.zeros(stream_cell_counts.shape, dtype=np.int64)
+    for row_start, row_end, col_start, col_end in tile_windows:
+        tile_coverage[row_start:row_end, col_start:col_end] += 1
+        ok_(stream_cell_counts[row_start:row_end, col_start:col_end].sum() <= 120)
+    #each block in exactly one tile
+    npt.assert_array_equal(tile_coverage, 1)
+
+
+def test_stream_network_index_query():
+    """
+    Checks querying the stream network grid index
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    output_data_path = os.path.join(main_tests_folder, 'output')
+    stream_network_index = StreamNetworkIndex(os.path.join(output_data_path,
+                                                           'drainage_line.shp'),
+                                              index_directory=output_data_path,
+                                              features_per_cell=1)
+    ok_(not stream_network_index.is_current())
+    bbox_table = np.array([(3, 0.0, 1.0, 0.0, 1.0),
+                           (1, 0.5, 2.5, 2.0, 3.0),
+                           (0, 2.0, 3.0, 0.5, 1.5),
+                           (2, 4.0, 5.0, 0.0, 1.0)],
+                          dtype=StreamNetworkIndex.BBOX_DTYPE)
+    stream_network_index.write_index(bbox_table)
+
+    npt.assert_array_equal(stream_network_index.get_intersecting_fids((0.8, 0.8, 2.2, 1.2)),
+                           [0, 3])
+    npt.assert_array_equal(stream_network_index.get_intersecting_fids((0.0, 0.0, 5.0, 5.0)),
+                           [0, 1, 2, 3])
+    npt.assert_array_equal(stream_network_index.get_intersecting_fids((6.0, 0.0, 7.0, 1.0)),
+                           [])
+
+    #a query only visits the features in the grid cells under it
+    grid_x, grid_y = np.meshgrid(np.arange(100, dtype=np.float64),
+                                 np.arange(100, dtype=np.float64))
+    bbox_table = np.empty(grid_x.size, dtype=StreamNetworkIndex.BBOX_DTYPE)
+    bbox_table['fid'] = np.arange(grid_x.size)
+    bbox_table['min_x'] = grid_x.ravel()
+    bbox_table['max_x'] = grid_x.ravel() + 0.5
+    bbox_table['min_y'] = grid_y.ravel()
+    bbox_table['max_y'] = grid_y.ravel() + 0.5
+    stream_network_index.write_index(bbox_table)
+    query_bounds = (10.2, 20.2, 11.8, 21.8)
+    ok_(len(stream_network_index.get_candidate_rows(query_bounds)) < 50)
+    npt.assert_array_equal(stream_network_index.get_intersecting_fids(query_bounds),
+                           [2010, 2011, 2110, 2111])
+
+    stream_network_index._index_arrays = {}
+    rmtree(stream_network_index.index_folder)
+
+
+def test_get_tile_stream_network_file():
+    """
+    Checks using the tile stream network only if partitioned after
+    the last change to the stream network
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    output_data_path = os.path.join(main_tests_folder, 'output')
+    stream_network_shapefile = os.path.join(main_tests_folder, 'original', 'drainage_line.shp')
+    tile_stream_network_file = os.path.join(output_data_path, TILE_STREAM_NETWORK_FILE_NAME)
+
+    ok_(get_tile_stream_network_file(output_data_path, stream_network_shapefile) == stream_network_shapefile)
+
+    open(tile_stream_network_file, 'w').close()
+    stream_network_mtime = os.path.getmtime(stream_network_shapefile)
+    os.utime(tile_stream_network_file, (stream_network_mtime + 10, stream_network_mtime + 10))
+    ok_(get_tile_stream_network_file(output_data_path, stream_network_shapefile) == tile_stream_network_file)
+    os.utime(tile_stream_network_file, (stream_network_mtime - 10, stream_network_mtime - 10))
+    ok_(get_tile_stream_network_file(output_data_path, stream_network_shapefile) == stream_network_shapefile)
+
+    os.remove(tile_stream_network_file)
+
+
+def test_densified_extent():
+    """
+    Checks densifying the edges of a raster extent
+    """
+    densified_extent = get_densified_extent((10.0, 2.0, 0, 20.0, 0, -1.0), 5, 4,
+                                            num_points_per_edge=3)
+    npt.assert_almost_equal(densified_extent,
+                            [[10, 20], [15, 20], [20, 20], [20, 18], [20, 16],
+                             [15, 16], [10, 16], [10, 18], [10, 20]])
+
+
+def test_job_cost_ordering():
+    """
+    Checks counting stream cells and ordering jobs largest first
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    stream_info_file = os.path.join(main_tests_folder, 'original', 'stream_info.txt')
+
+    ok_(get_stream_info_num_cells(stream_info_file) == 764)
+    #estimated from the start of the file
+    ok_(abs(get_stream_info_num_cells(stream_info_file, sample_size=4096) - 764) < 764*0.1)
+    ok_(get_stream_info_num_cells("") == 0)
+
+    ok_(sort_jobs_by_cost(['a', 'b', 'c', 'd'], [1, 30, 2, 30]) == ['b', 'd', 'c', 'a'])
+
+
+def test_get_elevation_dem_file():
+    """
+    Checks finding the elevation raster and not its side car files
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    original_data_path = os.path.join(main_tests_folder, 'original')
+    output_data_path = os.path.join(main_tests_folder, 'output')
+
+    ok_(get_elevation_dem_file(original_data_path) == os.path.join(original_data_path, 'elevation.asc'))
+
+    #only side car files of the elevation raster
+    copy(os.path.join(original_data_path, 'elevation.asc.aux.xml'), output_data_path)
+    copy(os.path.join(original_data_path, 'elevation.prj'), output_data_path)
+    assert_raises(Exception, get_elevation_dem_file, output_data_path)
+
+    os.remove(os.path.join(output_data_path, 'elevation.asc.aux.xml'))
+    os.remove(os.path.join(output_data_path, 'elevation.prj'))
+
+
+def test_memory_aware_scheduler():
+    """
+    Checks jobs only run while they fit in the memory budget
+    """
+    class SerialPool(object):
+        """
+        Runs each job when it is submitted
+        """
+        def apply_async(self, function, args, callback=None, error_callback=None):
+            callback(function(*args))
+
+    scheduler = MemoryAwareScheduler(SerialPool(), 2, memory_budget=10,
+                                     base_memory=0, memory_per_dem_cell=1,
+                                     memory_per_stream_cell=0)
+    ok_(scheduler.get_estimated_memory((4, 100)) == 4)
+    #job over the budget runs alone
+    job_outputs = list(scheduler.imap(sum, [[1], [2], [3]], [(4, 0), (8, 0), (20, 0)]))
+    ok_(sorted(job_outputs) == [1, 2, 3])
+
+    scheduler.calibration_ratios = []
+    scheduler.calibrate((4, 0), 8)
+    ok_(scheduler.calibration_factor == 2)
+    ok_(scheduler.get_estimated_memory((4, 0)) == 8)
+
+    assert_raises(Exception, list, scheduler.imap(int, ["not a number"], [(1, 0)]))
+
+def test_imap_pipeline():
+    """
+    Checks each job runs after its prepare stage in one pool
+    """
+    pool = multiprocessing.Pool(2)
+    try:
+        job_stages = list(imap_pipeline(pool, 2, abs, [-1, -2, -3], str, [1, 2, 3]))
+    finally:
+        pool.close()
+        pool.join()
+    ok_(len(job_stages) == 6)
+    for job_index in range(1, 4):
+        ok_(job_stages.index(('prepare', job_index)) < job_stages.index(('run', str(job_index))))
+    assert_raises(Exception, list, imap_pipeline(None, 1, abs, [1], str, []))
+
+    #jobs run in the background without reading the outputs
+    pool = multiprocessing.Pool(2)
+    pipeline_finished = threading.Event()
+    try:
+        job_outputs = iter_in_background(imap_pipeline(pool, 2, abs, [-1, -2], str, [1, 2]),
+                                         pipeline_finished.set)
+        ok_(pipeline_finished.wait(60))
+        ok_(len(list(job_outputs)) == 4)
+    finally:
+        pool.close()
+        pool.join()
+    pipeline_finished.clear()
+    job_outputs = iter_in_background(imap_pipeline(None, 1, abs, [1], str, []),
+                                     pipeline_finished.set)
+    assert_raises(Exception, list, job_outputs)
+    ok_(pipeline_finished.wait(60))
+
+
+def test_stage_record():
+    """
+    Checks skipping stages with outputs written from the same inputs
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    original_stream_info_file = os.path.join(main_tests_folder, 'original', 'stream_info.txt')
+    stream_info_file = os.path.join(main_tests_folder, 'output', 'stream_info.txt')
+    copy(original_stream_info_file, stream_info_file)
+
+    ok_(get_file_digest(stream_info_file) == get_file_digest(original_stream_info_file))
+    ok_(get_file_digest("") == "")
+
+    stream_info_stage = ("stream_info", get_stage_digest("stream_info", "",
+                                                         [original_stream_info_file], (1,)))
+    slope_stage = ("slope", get_stage_digest("slope", stream_info_stage[1], (), ("SLOPE",)))
+    streamflow_stage = ("streamflow", get_stage_digest("streamflow", slope_stage[1]))
+    ok_(slope_stage[1] != get_stage_digest("slope", stream_info_stage[1], (), ("slope",)))
+
+    #shared input digests computed once are used instead of reading the input
+    input_digests = get_input_digests([original_stream_info_file, ""])
+    ok_(list(input_digests) == [original_stream_info_file])
+    ok_(stream_info_stage[1] == get_stage_digest("stream_info", "", [original_stream_info_file],
+                                                 (1,), input_digests))
+    ok_(stream_info_stage[1] != get_stage_digest("stream_info", "", [original_stream_info_file],
+                                                 (1,), {original_stream_info_file: "other"}))
+
+    stage_record = StageRecord([stream_info_file])
+    ok_(not os.path.basename(stage_record.record_file).startswith("stream_info."))
+    ok_(stage_record.get_num_current_stages([stream_info_stage]) == 0)
+    stage_record.write([stream_info_stage, slope_stage])
+    ok_(stage_record.is_current([stream_info_stage, slope_stage]))
+    ok_(stage_record.get_num_current_stages([stream_info_stage, slope_stage, streamflow_stage]) == 2)
+    #recorded slope stage would not be written over
+    ok_(stage_record.get_num_current_stages([stream_info_stage]) == 0)
+
+    #outputs changed after the record
+    with open(stream_info_file, 'a') as outfile:
+        outfile.write("\n")
+    ok_(stage_record.read() == [])
+
+    stage_record.invalidate()
+    ok_(not os.path.exists(stage_record.record_file))
+    os.remove(stream_info_file)
+
+
+def test_streamflow_stages_tile_stream_network():
+    """
+    Checks the streamflow recorded by prepare from the tile stream network
+    is current when the run checks it with the global stream network
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    output_data_path = os.path.join(main_tests_folder, 'output')
+    stream_network_shapefile = os.path.join(main_tests_folder, 'original', 'drainage_line.shp')
+    stream_info_file = os.path.join(output_data_path, 'stream_info.txt')
+    tile_stream_network_file = os.path.join(output_data_path, TILE_STREAM_NETWORK_FILE_NAME)
+    copy(os.path.join(main_tests_folder, 'original', 'stream_info.txt'), stream_info_file)
+    copy(stream_network_shapefile, tile_stream_network_file)
+    stream_network_mtime = os.path.getmtime(stream_network_shapefile)
+    os.utime(tile_stream_network_file, (stream_network_mtime + 10, stream_network_mtime + 10))
+    #the tile has other content than the global stream network
+    with open(tile_stream_network_file, 'ab') as outfile:
+        outfile.write(b"tile")
+
+    #stages recorded by prepare in mode 4 from the tile stream network
+    slope_stage = ("slope", get_stage_digest("slope", "", [tile_stream_network_file], ("COMID", "SLOPE")))
+    streamflow_stage = ("streamflow", get_streamflow_stage_digest(4, slope_stage[1], "", "", "", "",
+                                                                  None, None, "COMID", "Flow",
+                                                                  tile_stream_network_file))
+    StageRecord([stream_info_file]).write([slope_stage, streamflow_stage])
+
+    #the run checks the streamflow before the simulation (Streamflow current)
+    stream_info_stages = get_streamflow_stages(stream_info_file, 4, "", "", "", "",
+                                               None, None, "COMID", "Flow",
+                                               stream_network_shapefile)
+    ok_(stream_info_stages == [slope_stage, streamflow_stage])
+    ok_(StageRecord([stream_info_file]).is_current(stream_info_stages))
+
+    #the tile is older than the global stream network
+    os.utime(tile_stream_network_file, (stream_network_mtime - 10, stream_network_mtime - 10))
+    ok_(not StageRecord([stream_info_file]).is_current(get_streamflow_stages(stream_info_file, 4, "", "", "", "",
+                                                                             None, None, "COMID", "Flow",
+                                                                             stream_network_shapefile)))
+
+    StageRecord([stream_info_file]).invalidate()
+    os.remove(tile_stream_network_file)
+    os.remove(stream_info_file)
+
+
+class QoutArrayDataset(object):
+    """
+    RAPID Qout dataset read from a (river, time) array
+    """
+    def __init__(self, river_ids, qout_array, river_chunk_size):
+        self.river_ids = np.array(river_ids)
+        self.qout_array = np.array(qout_array, dtype=np.float32)
+        self.size_time = self.qout_array.shape[1]
+        self.q_var_name = 'Qout'
+        self.river_id_dimension = 'rivid'
+        qout_chunking = [river_chunk_size, self.size_time]
+        qout_var = type('QoutVariable', (object,),
+                        {'dtype': self.qout_array.dtype,
+                         'dimensions': ('rivid', 'time'),
+                         'chunking': lambda qout_var: qout_chunking})()
+        self.qout_nc = type('QoutNetCDF', (object,), {'variables': {'Qout': qout_var}})()
+        self.num_reads = 0
+
+    def __call__(self, rapid_output_file):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def get_time_index_range(self, **kwargs):
+        return None
+
+    def get_subset_riverid_index_list(self, stream_ids):
+        valid_stream_ids = [stream_id for stream_id in stream_ids if stream_id in self.river_ids]
+        return ([int(np.nonzero(self.river_ids == stream_id)[0][0]) for stream_id in valid_stream_ids],
+                valid_stream_ids,
+                [stream_id for stream_id in stream_ids if stream_id not in self.river_ids])
+
+    def get_qout_index(self, river_index_array, time_index_array=None):
+        self.num_reads += 1
+        return self.qout_array[river_index_array]
+
+def test_river_chunk_size():
+    """
+    Checks the number of rivers read at once from RAPID output
+    """
+    time_length = 100
+    #memory for 25 rivers
+    max_memory_fraction = 25.5 * time_length * 13 / float(prepare_module.get_available_memory())
+
+    #aligned to the NetCDF chunks if they fit in memory
+    data_nc = QoutArrayDataset(range(5), np.zeros((5, time_length)), 10)
+    ok_(get_river_chunk_size(data_nc, time_length, max_memory_fraction) == 20)
+    #RAPID Qout files chunked (1, number of rivers)
+    data_nc = QoutArrayDataset(range(5), np.zeros((5, time_length)), 100000)
+    ok_(get_river_chunk_size(data_nc, time_length, max_memory_fraction) == 25)
+
+def test_peak_streamflow_chunked_read():
+    """
+    Checks peak streamflow read in chunks matches reading all rivers at once
+    """
+    river_ids = np.arange(100, 0, -1)
+    qout_array = np.random.RandomState(0).rand(len(river_ids), 12) * 100
+    stream_ids = [7, 500, 93, 1, 50]
+    arp = AutoRoutePrepare("", "", "")
+
+    original_rapid_dataset = prepare_module.RAPIDDataset
+    try:
+        prepare_module.RAPIDDataset = QoutArrayDataset(river_ids, qout_array, 1)
+        all_stream_ids, all_peak_flows = \
+            arp.get_peak_streamflow_from_rapid_output("", stream_ids, max_memory_fraction=1)
+        ok_(prepare_module.RAPIDDataset.num_reads == 1)
+
+        prepare_module.RAPIDDataset = QoutArrayDataset(river_ids, qout_array, 1)
+        chunk_stream_ids, chunk_peak_flows = \
+            arp.get_peak_streamflow_from_rapid_output("", stream_ids, max_memory_fraction=1e-15)
+        ok_(prepare_module.RAPIDDataset.num_reads == 4)
+    finally:
+        prepare_module.RAPIDDataset = original_rapid_dataset
+
+    npt.assert_array_equal(chunk_stream_ids, all_stream_ids)
+    npt.assert_array_equal(chunk_peak_flows, all_peak_flows)
+    peak_flows = dict(zip(all_stream_ids, all_peak_flows))
+    npt.assert_almost_equal(peak_flows[93], qout_array[np.nonzero(river_ids == 93)[0][0]].max(), 4)
+    ok_(peak_flows[500] == 0)
+
+
+def test_ecmwf_streamflow_missing_river():
+    """
+    Checks the ECMWF streamflow matches reading each reach on its own
+    with zero flow for the rivers missing in the ensembles
+    """
+    river_ids = np.arange(20, 0, -1)
+    random_state = np.random.RandomState(0)
+    ensemble_datasets = {
+        'Qout_1.nc': QoutArrayDataset(river_ids, random_state.rand(len(river_ids), 85) * 100, 1),
+        'Qout_52.nc': QoutArrayDataset(river_ids, random_state.rand(len(river_ids), 125) * 100, 1),
+    }
+    stream_ids = [7, 500, 13, 1]
+    prediction_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'output', 'ecmwf')
+    try:
+        os.makedirs(prediction_folder)
+    except OSError:
+        pass
+    for prediction_file in ensemble_datasets:
+        open(os.path.join(prediction_folder, prediction_file), 'w').close()
+
+    original_rapid_dataset = prepare_module.RAPIDDataset
+    try:
+        prepare_module.RAPIDDataset = \
+            lambda prediction_file: ensemble_datasets[os.path.basename(prediction_file)]
+        ecmwf_stream_ids, ecmwf_streamflows = \
+            AutoRoutePrepare("", "", "").get_streamflow_from_ecmwf_rapid_output(prediction_folder,
+                                                                                 "mean", "max",
+                                                                                 stream_ids)
+    finally:
+        prepare_module.RAPIDDataset = original_rapid_dataset
+        rmtree(prediction_folder)
+
+    #per reach loop
+    reach_streamflows = []
+    for stream_id in stream_ids:
+        reach_first_half = np.zeros((2, 65))
+        reach_second_half = np.zeros((2, 20))
+        if stream_id in river_ids:
+            river_index = np.nonzero(river_ids == stream_id)[0][0]
+            low_res_qout = ensemble_datasets['Qout_1.nc'].qout_array[river_index]
+            high_res_qout = ensemble_datasets['Qout_52.nc'].qout_array[river_index]
+            reach_first_half[0] = low_res_qout[:65]
+            reach_second_half[0] = low_res_qout[65:]
+            reach_first_half[1] = np.concatenate([high_res_qout[:90:3], high_res_qout[90:]])
+        reach_streamflows.append(np.concatenate([reach_first_half.mean(axis=0),
+                                                 reach_second_half.mean(axis=0)]).max())
+
+    npt.assert_array_equal(ecmwf_stream_ids, stream_ids)
+    npt.assert_almost_equal(ecmwf_streamflows, reach_streamflows, 4)
+    ok_(ecmwf_streamflows[1] == 0)
+    ok_((ecmwf_streamflows[[0, 2, 3]] > 0).all())
+
+
+def test_iter_ecmwf_ensemble_hydrographs():
+    """
+    Checks reading the ECMWF ensembles at the same time matches
+    reading them one after another
+    """
+    river_ids = np.arange(10, 0, -1)
+    random_state = np.random.RandomState(0)
+    ensemble_datasets = dict([("Qout_{0}.nc".format(ensemble_index),
+                               QoutArrayDataset(river_ids, random_state.rand(len(river_ids), 61), 1))
+                              for ensemble_index in range(1, 6)])
+    #unreadable ensemble is zero flow
+    prediction_files = sorted(ensemble_datasets) + ["Qout_6.nc"]
+    river_index_list = [2, 5, 9]
+
+    original_rapid_dataset = prepare_module.RAPIDDataset
+    try:
+        prepare_module.RAPIDDataset = lambda prediction_file: ensemble_datasets[prediction_file]
+        serial_hydrographs = list(iter_ecmwf_ensemble_hydrographs(prediction_files, river_index_list,
+                                                                  len(river_index_list), 41))
+        concurrent_hydrographs = list(iter_ecmwf_ensemble_hydrographs(prediction_files, river_index_list,
+                                                                      len(river_index_list), 41,
+                                                                      num_readers=3))
+    finally:
+        prepare_module.RAPIDDataset = original_rapid_dataset
+
+    ok_(sorted([hydrographs[0] for hydrographs in concurrent_hydrographs]) ==
+        list(range(len(prediction_files))))
+    for file_index, first_half_data, second_half_data in sorted(concurrent_hydrographs,
+                                                                key=lambda hydrographs: hydrographs[0]):
+        ok_(serial_hydrographs[file_index][0] == file_index)
+        npt.assert_array_equal(first_half_data, serial_hydrographs[file_index][1])
+        npt.assert_array_equal(second_half_data, serial_hydrographs[file_index][2])
+        if file_index < 5:
+            qout_array = ensemble_datasets[prediction_files[file_index]].qout_array[river_index_list]
+            npt.assert_almost_equal(np.concatenate([first_half_data, second_half_data], axis=1),
+                                    qout_array, 4)
+        else:
+            ok_(not first_half_data.any() and not second_half_data.any())
+
 
 def test_append_slope_to_stream_info_file():
     """
@@ -82,6 +690,372 @@ def test_append_slope_to_stream_info_file():
     except OSError:
         pass
 
+def test_enrich_stream_info_file():
+    """
+    Checks adding slope to stream info file in chunks
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    
+    original_data_path = os.path.join(main_tests_folder, 'original')
+    output_data_path = os.path.join(main_tests_folder, 'output')
+
+    original_stream_info_file = os.path.join(original_data_path, 'stream_info.txt')
+    stream_info_file = os.path.join(output_data_path, 'stream_info.txt')
+    copy(original_stream_info_file, stream_info_file)
+    
+    arp = AutoRoutePrepare("autoroute_exe_path_dummy",
+                           os.path.join(original_data_path, 'elevation.asc'),
+                           stream_info_file,
+                           os.path.join(original_data_path, 'drainage_line.shp'))
+
+    arp.enrich_stream_info_file([("slope", dict(stream_id_field="COMID",
+                                                slope_field="slope"))],
+                                chunk_size=100)
+
+    #rows keep the original order
+    enriched_table = StreamInfoTable.read(stream_info_file).table
+    solution_table = StreamInfoTable.read(os.path.join(original_data_path,
+                                                       'stream_info_solution.txt')).table
+    solution_table = solution_table[np.argsort(solution_table['DEM_1D_Index'])]
+    npt.assert_array_equal(enriched_table['DEM_1D_Index'],
+                           StreamInfoTable.read(original_stream_info_file).table['DEM_1D_Index'])
+    npt.assert_array_equal(enriched_table[np.argsort(enriched_table['DEM_1D_Index'])],
+                           solution_table)
+
+    #streamflow is read once for all chunks
+    streamflow_stream_id_list = []
+    def get_streamflow_by_stream_id(stream_ids, **kwargs):
+        streamflow_stream_id_list.append(stream_ids)
+        return stream_ids, stream_ids * 0.5
+    arp.get_streamflow_from_return_period_file = get_streamflow_by_stream_id
+    arp.enrich_stream_info_file([("return_period", dict(return_period_file="",
+                                                        return_period="return_period_20"))],
+                                chunk_size=100)
+    enriched_table = StreamInfoTable.read(stream_info_file).table
+    ok_(len(streamflow_stream_id_list) == 1)
+    npt.assert_array_equal(streamflow_stream_id_list[0], np.unique(enriched_table['StreamID']))
+    npt.assert_allclose(enriched_table['Flow'], enriched_table['StreamID'] * 0.5)
+
+    try:
+        os.remove(stream_info_file)
+    except OSError:
+        pass
+
+
+def test_stream_info_table_join():
+    """
+    Checks joining reach values onto the stream info table
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    
+    original_data_path = os.path.join(main_tests_folder, 'original')
+
+    stream_info_table = StreamInfoTable.read(os.path.join(original_data_path, 'stream_info.txt'))
+    unique_stream_ids = stream_info_table.unique_stream_ids
+    ok_(len(stream_info_table) == 764)
+
+    #missing stream ids are dropped without a fill value
+    joined_table = stream_info_table.join(unique_stream_ids[:2], [5.0, 6.0], "Flow")
+    ok_(set(joined_table.stream_id) == set(unique_stream_ids[:2]))
+    npt.assert_array_equal(joined_table.table['Flow'][joined_table.stream_id == unique_stream_ids[0]], 5.0)
+    ok_(joined_table.column_names[-1] == "Flow")
+
+    #missing stream ids are filled and ordered by the input reaches
+    joined_table = stream_info_table.join(unique_stream_ids[::-1][:2], [5.0, 6.0], "Flow",
+                                          fill_value=0)
+    ok_(len(joined_table) == len(stream_info_table))
+    ok_(joined_table.stream_id[0] == unique_stream_ids[-1])
+    npt.assert_array_equal(joined_table.table['Flow'][~np.isin(joined_table.stream_id,
+                                                               unique_stream_ids[-2:])], 0)
+
+def test_stream_info_table_sidecar():
+    """
+    Checks writing and reading stream info binary sidecar
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    
+    original_data_path = os.path.join(main_tests_folder, 'original')
+    output_data_path = os.path.join(main_tests_folder, 'output')
+
+    original_stream_info_file = os.path.join(original_data_path, 'stream_info_solution.txt')
+    stream_info_file = os.path.join(output_data_path, 'stream_info.txt')
+    copy(original_stream_info_file, stream_info_file)
+
+    stream_info_table = StreamInfoTable.read(stream_info_file, use_sidecar=True)
+    sidecar_file = StreamInfoTable.get_sidecar_file(stream_info_file)
+    ok_(os.path.exists(sidecar_file))
+    ok_(StreamInfoTable.sidecar_is_current(stream_info_file))
+
+    sidecar_table = StreamInfoTable.read(stream_info_file, use_sidecar=True)
+    ok_(isinstance(sidecar_table.table, np.memmap))
+    npt.assert_array_equal(stream_info_table.table, sidecar_table.table)
+    sidecar_table = None
+
+    #stream ids read from only the StreamID column of the text file or sidecar
+    for use_sidecar in (False, True):
+        npt.assert_array_equal(StreamInfoTable.read_unique_stream_ids(stream_info_file,
+                                                                      chunk_size=100,
+                                                                      use_sidecar=use_sidecar),
+                               stream_info_table.unique_stream_ids)
+
+    os.remove(stream_info_file)
+    render_stream_info_file(stream_info_file)
+    ok_(fcmp(original_stream_info_file, stream_info_file))
+
+    for output_file in (stream_info_file, sidecar_file):
+        try:
+            os.remove(output_file)
+        except OSError:
+            pass
+
+def test_running_ensemble_statistic():
+    """
+    Checks running ensemble statistics match statistics of all ensembles
+    """
+    ensemble_data = np.random.RandomState(0).rand(52, 10, 41) * 100
+    for method in VALID_STATISTIC_METHODS:
+        ensemble_statistic = EnsembleStatistic(method, (10, 52, 41))
+        running_ensemble_statistic = RunningEnsembleStatistic(method)
+        for ensemble_index, ensemble_array in enumerate(ensemble_data):
+            ensemble_statistic.add(ensemble_index, ensemble_array)
+            running_ensemble_statistic.add(ensemble_index, ensemble_array)
+        npt.assert_almost_equal(ensemble_statistic.get_statistic(),
+                                running_ensemble_statistic.get_statistic())
+
+def test_peak_flow_cache_file():
+    """
+    Checks writing and reading peak flow cache entries
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    cache_directory = os.path.join(main_tests_folder, 'output', 'peak_flow_cache')
+
+    peak_flow_cache = PeakFlowCache(cache_directory)
+    cache_file = os.path.join(cache_directory, "peak_flow_test.npz")
+    peak_flow_cache.write_cache_file(cache_file, [30, 10, 20], [3.0, 1.0, 2.0])
+    ok_(os.path.exists(cache_file))
+
+    stream_ids, peak_flows = peak_flow_cache.read_cache_file(cache_file)
+    npt.assert_array_equal(stream_ids, [10, 20, 30])
+    npt.assert_array_equal(peak_flows, [1.0, 2.0, 3.0])
+    ok_(peak_flow_cache.read_cache_file(os.path.join(cache_directory, "missing.npz")) is None)
+
+    #older entries are evicted to make room and the new entry is kept
+    peak_flow_cache.max_cache_size = os.path.getsize(cache_file)
+    new_cache_file = os.path.join(cache_directory, "peak_flow_new.npz")
+    peak_flow_cache.write_cache_file(new_cache_file, [40, 50], [4.0, 5.0])
+    ok_(os.listdir(cache_directory) == [os.path.basename(new_cache_file)])
+
+    os.remove(new_cache_file)
+    os.rmdir(cache_directory)
+
+def create_test_raster(raster_file, epsg_code, geotransform, raster_array, data_type):
+    """
+    Writes a single band GeoTIFF in the projection of the EPSG code
+    """
+    raster_srs = osr.SpatialReference()
+    raster_srs.ImportFromEPSG(epsg_code)
+    raster_ds = gdal.GetDriverByName('GTiff').Create(raster_file,
+                                                     raster_array.shape[1],
+                                                     raster_array.shape[0],
+                                                     1, data_type)
+    raster_ds.SetGeoTransform(geotransform)
+    raster_ds.SetProjection(raster_srs.ExportToWkt())
+    raster_ds.GetRasterBand(1).WriteArray(raster_array)
+    raster_ds = None
+
+def test_reproject_lu_raster():
+    """
+    Checks reprojecting the land use raster to the DEM grid
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    output_data_path = os.path.join(main_tests_folder, 'output')
+    dem_raster = os.path.join(output_data_path, 'reproject_dem.tif')
+    land_use_raster = os.path.join(output_data_path, 'reproject_land_use.tif')
+    land_use_classes = [11, 21, 42, 90]
+
+    #UTM 15N DEM inside of a geographic land use raster
+    dem_geotransform = (500000.0, 30.0, 0.0, 4000000.0, 0.0, -30.0)
+    create_test_raster(dem_raster, 32615, dem_geotransform,
+                       np.zeros((30, 40), dtype=np.float32), gdal.GDT_Float32)
+    create_test_raster(land_use_raster, 4326, (-93.05, 0.001, 0.0, 36.2, 0.0, -0.001),
+                       np.random.RandomState(0).choice(land_use_classes, (100, 100)).astype(np.uint8),
+                       gdal.GDT_Byte)
+    dem_srs = osr.SpatialReference()
+    dem_srs.ImportFromEPSG(32615)
+
+    reprojected_land_use_rasters = [os.path.join(output_data_path, 'reproject_land_use_dem.tif'),
+                                    os.path.join(output_data_path, 'reproject_land_use_dem.vrt')]
+    try:
+        for reprojected_land_use_raster, output_format in zip(reprojected_land_use_rasters,
+                                                              ('GTiff', 'VRT')):
+            reproject_lu_raster(dem_raster, land_use_raster, reprojected_land_use_raster)
+            reprojected_ds = gdal.Open(reprojected_land_use_raster)
+            ok_(reprojected_ds.GetDriver().ShortName == output_format)
+            npt.assert_almost_equal(reprojected_ds.GetGeoTransform(), dem_geotransform)
+            ok_(reprojected_ds.RasterXSize == 40)
+            ok_(reprojected_ds.RasterYSize == 30)
+            reprojected_srs = osr.SpatialReference()
+            reprojected_srs.ImportFromWkt(reprojected_ds.GetProjection())
+            ok_(reprojected_srs.IsSame(dem_srs))
+            #nearest neighbor keeps the land use classes
+            ok_(np.isin(reprojected_ds.ReadAsArray(), land_use_classes).all())
+            reprojected_ds = None
+
+        #grid from the bounds and resolution
+        warp_land_use_raster(land_use_raster, reprojected_land_use_rasters[0],
+                             dem_srs.ExportToWkt(), (500000.0, 3999100.0, 501200.0, 4000000.0),
+                             xRes=60.0, yRes=60.0)
+        reprojected_ds = gdal.Open(reprojected_land_use_rasters[0])
+        npt.assert_almost_equal(reprojected_ds.GetGeoTransform(),
+                                (500000.0, 60.0, 0.0, 4000000.0, 0.0, -60.0))
+        ok_(reprojected_ds.RasterXSize == 20)
+        ok_(reprojected_ds.RasterYSize == 15)
+        ok_(np.isin(reprojected_ds.ReadAsArray(), land_use_classes).all())
+        reprojected_ds = None
+    finally:
+        for raster_file in [dem_raster, land_use_raster] + reprojected_land_use_rasters:
+            remove_raster(raster_file)
+
+
+def test_land_use_warp_cache():
+    """
+    Checks the land use cache key, reusing cache entries and
+    the window of the DEM in a cache entry
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    cache_directory = os.path.join(main_tests_folder, 'output', 'land_use_cache')
+    land_use_raster = os.path.join(main_tests_folder, 'original', 'elevation.asc')
+    grid_definition = ('PROJECTION', 30.0, 30.0, 0.5, 0.0)
+
+    #bounds snapped outward to the grid lines (offset half a cell in x)
+    cache_bounds = LandUseWarpCache.get_grid_bounds(grid_definition, (20.0, 10.0, 100.0, 50.0))
+    npt.assert_almost_equal(cache_bounds, (15.0, 0.0, 105.0, 60.0))
+    npt.assert_almost_equal(LandUseWarpCache.get_union_bounds([cache_bounds, (-15.0, 30.0, 45.0, 90.0)]),
+                            (-15.0, 0.0, 105.0, 90.0))
+
+    land_use_warp_cache = LandUseWarpCache(cache_directory, lock_timeout=0)
+    cache_file = land_use_warp_cache.get_cache_file(land_use_raster, grid_definition, cache_bounds)
+    ok_(os.path.basename(cache_file).startswith(LAND_USE_CACHE_FILE_PREFIX))
+    ok_(cache_file == land_use_warp_cache.get_cache_file(land_use_raster, grid_definition, cache_bounds))
+    ok_(cache_file != land_use_warp_cache.get_cache_file(land_use_raster, grid_definition,
+                                                         (15.0, 0.0, 135.0, 60.0)))
+    ok_(cache_file != land_use_warp_cache.get_cache_file(land_use_raster,
+                                                         ('PROJECTION', 30.0, 30.0, 0.0, 0.0),
+                                                         cache_bounds))
+
+    #warped once and reused after the stale lock is removed
+    written_cache_files = []
+    def write_cache_file(cache_file, land_use_raster, grid_definition, cache_bounds):
+        written_cache_files.append(cache_file)
+        open(cache_file, 'w').close()
+    land_use_warp_cache.write_cache_file = write_cache_file
+    open("{0}.lock".format(cache_file), 'w').close()
+    try:
+        for repeat in range(2):
+            ok_(land_use_warp_cache.get_cached_land_use_raster(land_use_raster, grid_definition,
+                                                               cache_bounds) == cache_file)
+        ok_(written_cache_files == [cache_file])
+        ok_(not os.path.exists("{0}.lock".format(cache_file)))
+    finally:
+        rmtree(cache_directory)
+
+    #[col offset, row offset, columns, rows] of the DEM in the cache entry
+    ok_(LandUseWarpCache.get_window((15.0, 30.0, 0, 60.0, 0, -30.0),
+                                    (75.0, 30.0, 0, 30.0, 0, -30.0), 4, 2) == [2, 1, 4, 2])
+
+
+def test_shared_streamflow():
+    """
+    Checks looking up streamflow from shared memory
+    """
+    shared_streamflow = SharedStreamflow.create([30, 10, 20], [3.0, 1.0, 2.0])
+    try:
+        with SharedStreamflow.attach(shared_streamflow.info) as attached_streamflow:
+            stream_ids, streamflows = attached_streamflow.get_streamflow([20, 40, 10])
+        npt.assert_array_equal(stream_ids, [20, 40, 10])
+        npt.assert_array_equal(streamflows, [2.0, 0.0, 1.0])
+    finally:
+        shared_streamflow.close()
+        shared_streamflow.unlink()
+
+    #streamflow keeps the type of the source (same digits in the stream info file)
+    shared_streamflow = SharedStreamflow.create([30, 10, 20], np.array([0.3, 0.1, 0.2], dtype=np.float32))
+    try:
+        with SharedStreamflow.attach(shared_streamflow.info) as attached_streamflow:
+            stream_ids, streamflows = attached_streamflow.get_streamflow([20, 40, 10])
+        ok_(streamflows.dtype == np.float32)
+        ok_(list(streamflows.astype(str)) == ['0.2', '0.0', '0.1'])
+    finally:
+        shared_streamflow.close()
+        shared_streamflow.unlink()
+
+def test_get_streamflow_from_return_period_file():
+    """
+    Checks looking up streamflow of stream ids in return period file
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    return_period_file = os.path.join(main_tests_folder, 'output', 'return_periods.nc')
+
+    river_ids = np.array([50, 10, 40, 20, 30])
+    with Dataset(return_period_file, 'w') as return_period_nc:
+        return_period_nc.createDimension('rivid', len(river_ids))
+        return_period_nc.createVariable('rivid', 'i4', ('rivid',))[:] = river_ids
+        for return_period_index, return_period in enumerate(('return_period_2',
+                                                             'return_period_10',
+                                                             'return_period_20')):
+            return_period_nc.createVariable(return_period, 'f8', ('rivid',))[:] = \
+                river_ids * 10 + return_period_index
+
+    arp = AutoRoutePrepare("", "", "")
+    stream_ids, peak_flows = arp.get_streamflow_from_return_period_file(return_period_file,
+                                                                        'return_period_10',
+                                                                        [30, 60, 10, 50])
+    npt.assert_array_equal(stream_ids, [30, 60, 10, 50])
+    npt.assert_array_equal(peak_flows, [301, 0, 101, 501])
+
+    stream_ids, peak_flows = arp.get_streamflow_from_return_period_file(return_period_file,
+                                                                        'return_period_20',
+                                                                        [20])
+    npt.assert_array_equal(peak_flows, [202])
+
+    os.remove(return_period_file)
+
+def test_write_return_period_scenario_files():
+    """
+    Checks writing stream info file of each return period
+    """
+    main_tests_folder = os.path.dirname(os.path.abspath(__file__))
+    
+    original_data_path = os.path.join(main_tests_folder, 'original')
+    output_data_path = os.path.join(main_tests_folder, 'output')
+
+    stream_info_file = os.path.join(output_data_path, 'stream_info.txt')
+    copy(os.path.join(original_data_path, 'stream_info_solution.txt'), stream_info_file)
+    return_period_file = os.path.join(output_data_path, 'return_periods.nc')
+
+    river_ids = StreamInfoTable.read(stream_info_file).unique_stream_ids
+    return_period_list = ['return_period_20', 'return_period_2']
+    with Dataset(return_period_file, 'w') as return_period_nc:
+        return_period_nc.createDimension('rivid', len(river_ids))
+        return_period_nc.createVariable('rivid', 'i8', ('rivid',))[:] = river_ids
+        for return_period_index, return_period in enumerate(return_period_list):
+            return_period_nc.createVariable(return_period, 'f8', ('rivid',))[:] = \
+                np.arange(len(river_ids)) + 100 * return_period_index
+
+    arp = AutoRoutePrepare("", "", stream_info_file)
+    scenario_stream_info_files = arp.write_return_period_scenario_files(return_period_file,
+                                                                        return_period_list)
+    for return_period_index, scenario_stream_info_file in enumerate(scenario_stream_info_files):
+        ok_(os.path.basename(scenario_stream_info_file) == \
+            "stream_info_{0}.txt".format(return_period_list[return_period_index]))
+        scenario_table = StreamInfoTable.read(scenario_stream_info_file)
+        npt.assert_array_equal(scenario_table.table['Flow'],
+                               np.searchsorted(river_ids, scenario_table.stream_id) \
+                               + 100 * return_period_index)
+        os.remove(scenario_stream_info_file)
+
+    os.remove(stream_info_file)
+    os.remove(return_period_file)
 
         
 if __name__ == '__main__':